@@ -0,0 +1,150 @@
+import math
+import random
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+
+# SSIM statistics over uniform 7x7 windows with the constants of Wang et al. for 8-bit data
+SSIM_WINDOW = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+# Identical images have an infinite PSNR; JSON cannot hold it, so it is capped here
+PSNR_MAX = 100.0
+
+# Rows compared at once, so the float intermediates stay small even for 48 MP images
+BAND_ROWS = 256
+
+# BT.601 luma, which is what JPEG encodes at full resolution
+LUMA = np.array([0.299, 0.587, 0.114])
+
+
+class AuditSampler:
+    """
+    Picks the conversions of a batch that are audited, and keeps a uniform sample of their results
+
+    Only successful conversions are picked, and how many there will be is not known while
+    the batch runs: files are skipped because their target exists, fail, or are still being
+    scanned. They are sampled like a reservoir: the n-th conversion is audited with
+    probability size/n and takes a random slot of the sample, which always holds a uniform
+    sample of the conversions so far. That costs about size * (1 + ln(n / size)) audits in
+    total. Safe to use from worker threads.
+    """
+
+    def __init__(self, size: int, rng: Optional[random.Random] = None):
+        """
+        :param size: number of conversions in the sample
+        :param rng: source of randomness, e.g. seeded for tests
+        """
+        self.size = size
+        self.rng = rng or random.Random()
+        self.seen = 0
+        self.audits = 0
+        # (index, psnr, ssim) of the latest conversion audited for each slot
+        self._sample = {}
+        self._lock = threading.Lock()
+
+    def pick(self) -> Optional[Tuple[int, int]]:
+        """
+        Decide whether the next successful conversion is audited
+
+        :return: its index and its slot in the sample, None if it is not audited
+        """
+        with self._lock:
+            index = self.seen
+            self.seen += 1
+            slot = index if index < self.size else self.rng.randrange(self.seen)
+            if slot >= self.size:
+                return None
+            self.audits += 1
+            return index, slot
+
+    def record(self, picked: Tuple[int, int], psnr_value: float, ssim_value: float) -> None:
+        """
+        Put the results of an audit into its slot, unless a later conversion took it already
+        """
+        index, slot = picked
+        with self._lock:
+            if slot not in self._sample or self._sample[slot][0] < index:
+                self._sample[slot] = (index, psnr_value, ssim_value)
+
+    def summary(self) -> dict:
+        with self._lock:
+            sample = list(self._sample.values())
+            audits = self.audits
+        if not sample:
+            return {"audited": 0, "audits": audits}
+        psnr_values = [psnr_value for _, psnr_value, _ in sample]
+        ssim_values = [ssim_value for _, _, ssim_value in sample]
+        return {"audited": len(sample), "audits": audits,
+                "psnr_mean": round(sum(psnr_values) / len(sample), 3), "psnr_min": min(psnr_values),
+                "ssim_mean": round(sum(ssim_values) / len(sample), 5), "ssim_min": min(ssim_values)}
+
+
+def psnr(reference: np.ndarray, result: np.ndarray) -> float:
+    """
+    Get the peak signal-to-noise ratio of two 8-bit images in dB, over all channels
+
+    :param reference: uint8 array of the decoded source
+    :param result: uint8 array of the decoded target, of the same shape
+    :return: the PSNR, PSNR_MAX for identical images
+    """
+    if reference.shape != result.shape:
+        raise ValueError(f"Cannot compare images of shapes {reference.shape} and {result.shape}")
+    squared_error = 0
+    for top in range(0, reference.shape[0], BAND_ROWS):
+        difference = reference[top:top + BAND_ROWS].astype(np.int32) - result[top:top + BAND_ROWS]
+        squared_error += int(np.square(difference).sum(dtype=np.int64))
+    if squared_error == 0:
+        return PSNR_MAX
+    mse = squared_error / reference.size
+    return min(PSNR_MAX, 10 * math.log10(255 ** 2 / mse))
+
+
+def _window_sums(values: np.ndarray) -> np.ndarray:
+    """
+    Sum values over all SSIM windows that fit into the array, from its summed-area table
+    """
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    np.cumsum(np.cumsum(values, axis=0), axis=1, out=table[1:, 1:])
+    w = SSIM_WINDOW
+    return table[w:, w:] - table[:-w, w:] - table[w:, :-w] + table[:-w, :-w]
+
+
+def ssim(reference: np.ndarray, result: np.ndarray) -> float:
+    """
+    Get the mean structural similarity of the luma of two 8-bit images
+
+    The statistics of all 7x7 windows come from summed-area tables, a band of rows at a time,
+    with the sample covariance like scikit-image's default.
+
+    :param reference: uint8 array of the decoded source, (height, width) or (height, width, 3)
+    :param result: uint8 array of the decoded target, of the same shape
+    :return: the mean SSIM, 1.0 for identical images
+    """
+    if reference.shape != result.shape:
+        raise ValueError(f"Cannot compare images of shapes {reference.shape} and {result.shape}")
+    height, width = reference.shape[:2]
+    w = SSIM_WINDOW
+    if height < w or width < w:
+        raise ValueError(f"Cannot compare images smaller than {w}x{w} pixels")
+    n = w * w
+    covariance_scale = n / (n - 1)
+
+    total = 0.0
+    for top in range(0, height - w + 1, BAND_ROWS):
+        rows = slice(top, min(top + BAND_ROWS + w - 1, height))
+        x = reference[rows] @ LUMA if reference.ndim == 3 else reference[rows].astype(np.float64)
+        y = result[rows] @ LUMA if result.ndim == 3 else result[rows].astype(np.float64)
+
+        mean_x = _window_sums(x) / n
+        mean_y = _window_sums(y) / n
+        variance_x = (_window_sums(x * x) / n - mean_x * mean_x) * covariance_scale
+        variance_y = (_window_sums(y * y) / n - mean_y * mean_y) * covariance_scale
+        covariance = (_window_sums(x * y) / n - mean_x * mean_y) * covariance_scale
+
+        similarity = ((2 * mean_x * mean_y + SSIM_C1) * (2 * covariance + SSIM_C2) /
+                      ((mean_x * mean_x + mean_y * mean_y + SSIM_C1) * (variance_x + variance_y + SSIM_C2)))
+        total += float(similarity.sum())
+    return total / ((height - w + 1) * (width - w + 1))
@@ -0,0 +1,88 @@
+import hashlib
+import threading
+from typing import Optional
+
+COLOR_MODES = ('none', 'srgb', 'embed')
+
+# Pillow modes that LittleCMS transforms from RGB profiles in place
+TRANSFORM_MODES = ('RGB', 'RGBA', 'RGBX')
+
+
+class TransformCache:
+    """
+    Builds the transforms from the ICC profiles of the sources to sRGB once per profile and mode
+
+    Phones write the same few profiles into every image, so a run of any size builds only a
+    handful of transforms. Profiles are keyed by a hash of their bytes; sRGB profiles and the
+    ones that cannot be used map to None and are left alone. The cache is safe to use from
+    worker threads, and the transforms are shared between them.
+    """
+
+    def __init__(self):
+        self._transforms = {}
+        self._lock = threading.Lock()
+        self._srgb = None
+        self.built = 0
+        self.hits = 0
+        self.errors = 0
+
+    def summary(self) -> dict:
+        return {"color_transforms_built": self.built, "color_transform_hits": self.hits,
+                "color_profile_errors": self.errors}
+
+    def get(self, icc: bytes, mode: str):
+        """
+        Get the transform of a profile for images of a mode, building it on first use
+
+        :param icc: the ICC profile of the source
+        :param mode: the Pillow mode of the decoded image, one of TRANSFORM_MODES
+        :return: the ImageCms transform, None if the image is to be left as it is
+        """
+        key = (hashlib.sha1(icc).digest(), mode)
+        with self._lock:
+            if key in self._transforms:
+                self.hits += 1
+                return self._transforms[key]
+            # Building under the lock keeps parallel jobs from building the same transform
+            self._transforms[key] = transform = self._build(icc, mode)
+            return transform
+
+    def _build(self, icc: bytes, mode: str):
+        import io
+
+        from PIL import ImageCms
+
+        if self._srgb is None:
+            self._srgb = ImageCms.createProfile("sRGB")
+        try:
+            profile = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+            if profile.profile.xcolor_space.strip() != "RGB" or "sRGB" in ImageCms.getProfileDescription(profile):
+                return None
+            transform = ImageCms.buildTransform(profile, self._srgb, mode, mode,
+                                                ImageCms.Intent.PERCEPTUAL)
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            self.errors += 1
+            return None
+        self.built += 1
+        return transform
+
+
+def to_srgb(image, icc: Optional[bytes], cache: TransformCache) -> bool:
+    """
+    Convert the pixels of a decoded image from its ICC profile to sRGB, in place
+
+    :param image: the Pillow image
+    :param icc: the ICC profile of the image, if it has one
+    :param cache: the transforms built so far
+    :return: True if the pixels were converted, False if the image was left as it is
+    """
+    if not icc or image.mode not in TRANSFORM_MODES:
+        return False
+    transform = cache.get(icc, image.mode)
+    if transform is None:
+        return False
+    from PIL import ImageCms
+
+    image.load()
+    ImageCms.applyTransform(image, transform, inPlace=True)
+    return True
@@ -1,27 +1,174 @@
+import importlib
+import io
 import os
+import queue
 import re
-from PIL import Image, ExifTags, UnidentifiedImageError
-from pillow_heif import register_heif_opener
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-import piexif
 import fnmatch
-from typing import List, Callable, Optional, Union, Tuple
-from tqdm.auto import tqdm
+from itertools import chain, islice
+from typing import Iterable, Iterator, List, Optional, Pattern, Set, Tuple, Union
 
-register_heif_opener(allow_incorrect_headers=True)
+from color import COLOR_MODES, TransformCache, to_srgb
+from prefetch import PREFETCH_BUDGET, PREFETCH_DEPTH, Prefetcher
+from progress import ProgressCallback, ProgressEvent, ProgressKind, ProgressTracker
+from report import ReportWriter
+from schedule import HEADER_BYTES, prioritize, read_header
+from storage import LocalStorage, Storage, get_storage
+from throttle import ConcurrencyTuner, LoadGovernor, TokenBucket, available_cpus, read_throttled, write_throttled
+from verify import check_target
 
+# PIL, pillow_heif and piexif are imported on the first conversion, so that the CLI's --help and
+# the GUI window come up without loading any codec
+_CODEC_MODULES = {"Image": "PIL.Image", "ExifTags": "PIL.ExifTags", "pillow_heif": "pillow_heif", "piexif": "piexif"}
+_codecs_lock = threading.Lock()
+_codecs_loaded = False
 
-def generate_unique_filename(target_file: str) -> str:
+# Options of the tone mapping in tonemap, defined here so choosing them does not load NumPy
+TONE_MAP_CURVES = ('clip', 'reinhard', 'hable')
+DITHER_MODES = ('none', 'ordered', 'blue-noise')
+
+# Extensions of HEIF images with HEVC content
+HEIC_PATTERN = re.compile(r"\.(heic|heif|hif)$", re.IGNORECASE)
+JPEG_PATTERN = re.compile(r"\.(jpg|jpeg|jpe)$", re.IGNORECASE)
+
+# Formats converted to: JPEG from HEIC sources, or HEIC from JPEG sources
+OUTPUT_FORMATS = ('jpeg', 'heic')
+
+# HEIC encoder speeds and the x265 presets they select; slower ones give smaller files
+ENCODER_SPEEDS = {'fastest': 'ultrafast', 'fast': 'veryfast', 'medium': 'medium', 'slow': 'slow',
+                  'slowest': 'veryslow'}
+
+# HEIC qualities by purpose, HEVC keeps the detail of JPEG quality 95 at far lower settings
+HEIC_QUALITY_PRESETS = {'archive': 90, 'high': 80, 'balanced': 65, 'compact': 50}
+
+# Directories of thumbnails, snapshots and recycle bins created by NAS systems and file managers
+DEFAULT_EXCLUDES = ("@eaDir", "#recycle", "#snapshot", ".snapshot", ".snapshots", ".thumbnails", ".Trash-*")
+
+# HEIC images from phones are grids of 512x512 HEVC tiles, libheif decodes tiles in parallel
+HEIF_TILE_PIXELS = 512 * 512
+
+# Number of headers read to estimate the image sizes of a batch
+DECODE_THREADS_SAMPLE = 8
+
+# Number of recent results of the --max-bytes quality search that the next search starts from
+QUALITY_HISTORY = 16
+
+# Defaults of the buffer pool: a few full-resolution images per sensor size, kept for half a minute
+BUFFER_POOL_BUDGET = 256 * 1024 * 1024
+BUFFER_POOL_IDLE = 30.0
+
+# Pillow's block cache limit is global to the process, so the pools that use it are counted: the first one saves
+# the limit and the last one to let go restores it
+_block_cache_lock = threading.Lock()
+_block_cache_users = 0
+_block_cache_previous = None
+
+# Images above this many pixels, e.g. stitched panoramas, are converted one at a time
+LARGE_IMAGE_PIXELS = 64_000_000
+
+# Targets checked at the same time by verify_tree; the checks wait for disk or network, not the CPU
+VERIFY_THREADS = 8
+
+
+def load_codecs() -> None:
+    """
+    Import the image codecs and register the HEIF opener with PIL, once per process
+
+    Conversions call this themselves; calling it early, e.g. from a background thread, only
+    moves the start-up cost out of the first conversion.
+    """
+    global _codecs_loaded
+    if _codecs_loaded:
+        return
+    with _codecs_lock:
+        if not _codecs_loaded:
+            from pillow_heif import register_heif_opener
+            register_heif_opener(allow_incorrect_headers=True)
+            _codecs_loaded = True
+
+
+def __getattr__(name: str):
+    """
+    Resolve the codec modules that used to be imported at module level, e.g. converter.Image
+    """
+    if name in _CODEC_MODULES:
+        load_codecs()
+        return importlib.import_module(_CODEC_MODULES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def balance_decode_threads(
+        jobs: int,
+        files_total: Optional[int],
+        pixel_counts: List[int],
+        cpu_count: Optional[int] = None
+) -> Tuple[int, int]:
+    """
+    Split the cores between images converted in parallel and libheif decode threads per image
+
+    Parallel images are limited by the number of files, and threads within an image are only
+    useful up to its number of tiles, so a few large panoramas get many threads each while
+    a batch of small images gets one thread per image.
+
+    :param jobs: the requested number of parallel images
+    :param files_total: number of files in the batch, None if it is a stream of unknown length
+    :param pixel_counts: pixel counts of a sample of the batch's images
+    :param cpu_count: number of cores, the ones available to the process if None
+    :return: the number of parallel images and the number of decode threads per image
+    """
+    cores = cpu_count or available_cpus()
+    jobs = max(1, min(jobs, files_total) if files_total is not None else jobs)
+    threads = max(1, cores // jobs)
+
+    if pixel_counts:
+        median_pixels = sorted(pixel_counts)[len(pixel_counts) // 2]
+        tiles = -(-median_pixels // HEIF_TILE_PIXELS)
+        threads = max(1, min(threads, tiles))
+
+    return jobs, threads
+
+
+def _sample_pixel_counts(sources: List[str]) -> List[int]:
+    """
+    Read the image size from the headers of a sample of the sources, without decoding them
+
+    Only the first HEADER_BYTES of each source are read, so remote sources are not downloaded.
+
+    :param sources: the source files or URLs
+    :return: the pixel counts of the readable sources in the sample
+    """
+    step = max(1, len(sources) // DECODE_THREADS_SAMPLE)
+    pixel_counts = []
+    for source in sources[::step][:DECODE_THREADS_SAMPLE]:
+        storage = get_storage(source)
+        try:
+            with storage.open(source, "rb") as f:
+                pixels = read_header(f, capture_time=False).pixels
+        except Exception:
+            continue
+        if pixels:
+            pixel_counts.append(pixels)
+    return pixel_counts
+
+
+def generate_unique_filename(target_file: str, taken: Optional[Set[str]] = None) -> str:
     """
     Generate a unique filename by adding (n) suffix if file exists
 
     :param target_file: The target file path
+    :param taken: Paths that count as existing even if they are not written yet
     :return: A unique file path that doesn't exist
     """
-    if not os.path.exists(target_file):
+    storage = get_storage(target_file)
+    taken = taken or set()
+    if target_file not in taken and not storage.exists(target_file):
         return target_file
 
-    directory = os.path.dirname(target_file)
+    directory = storage.dirname(target_file)
     filename, extension = os.path.splitext(os.path.basename(target_file))
 
     # Check if filename already has (n) pattern
@@ -36,151 +183,1725 @@ def generate_unique_filename(target_file: str) -> str:
     # Find an available filename
     while True:
         new_filename = f"{base_name}({counter}){extension}"
-        new_path = os.path.join(directory, new_filename)
-        if not os.path.exists(new_path):
+        new_path = storage.join(directory, new_filename)
+        if new_path not in taken and not storage.exists(new_path):
             return new_path
         counter += 1
 
 
-def get_file_list(dir_of_interest: str, recursive: bool) -> List[List[str]]:
+class FileFilter:
     """
-    Get a list of all HEIC files in the directory of interest
+    Selects the files and directories of a scan
+
+    Globs are matched against the name and against the path relative to the scanned directory
+    (with / separators), and are compiled into one regular expression each. Excluded directories
+    are pruned before the scan descends into them. Size and modification time are read from
+    the stat data of the scan entries, and only if such a limit is set.
+    """
+
+    def __init__(
+            self,
+            include: Optional[Iterable[str]] = None,
+            exclude: Optional[Iterable[str]] = None,
+            min_size: Optional[int] = None,
+            max_size: Optional[int] = None,
+            newer_than: Optional[datetime] = None
+    ):
+        """
+        :param include: globs a file has to match, all HEIC files if None
+        :param exclude: globs of files and directories to skip, e.g. DEFAULT_EXCLUDES
+        :param min_size: minimum file size in bytes
+        :param max_size: maximum file size in bytes
+        :param newer_than: only files modified after this time
+        """
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.newer_than = newer_than.timestamp() if newer_than else None
+
+    @staticmethod
+    def _compile(globs: Optional[Iterable[str]]):
+        globs = list(globs or [])
+        if not globs:
+            return None
+        return re.compile("|".join(fnmatch.translate(glob) for glob in globs), re.IGNORECASE)
+
+    @staticmethod
+    def _matches(pattern, name: str, relative_path: str) -> bool:
+        return bool(pattern.match(name) or pattern.match(relative_path))
+
+    def accepts_dir(self, name: str, relative_path: str) -> bool:
+        """
+        Check whether the scan should descend into a directory
+        """
+        return self.exclude is None or not self._matches(self.exclude, name, relative_path)
+
+    def accepts_file(self, entry, relative_path: str) -> bool:
+        """
+        Check whether a HEIC file entry of the scan is selected
+        """
+        if self.include is not None and not self._matches(self.include, entry.name, relative_path):
+            return False
+        if self.exclude is not None and self._matches(self.exclude, entry.name, relative_path):
+            return False
+        if self.min_size is None and self.max_size is None and self.newer_than is None:
+            return True
+
+        stat = entry.stat()
+        if self.min_size is not None and stat.st_size < self.min_size:
+            return False
+        if self.max_size is not None and stat.st_size > self.max_size:
+            return False
+        if self.newer_than is not None and stat.st_mtime <= self.newer_than:
+            return False
+        return True
+
+
+class _WalkGuard:
+    """
+    Keeps a walk that follows symlinks out of loops and out of trees it already walks, and if
+    asked, off other devices
+
+    A symlinked directory is only entered if its real path is outside the walked tree and
+    outside the targets of the symlinks entered so far, which costs a realpath per symlink.
+    Staying on one device costs a stat per directory.
+    """
+
+    def __init__(self, top: str, one_device: bool = False):
+        """
+        :param top: the directory the walk starts from
+        :param one_device: skip directories on other devices than top, e.g. mounted shares
+        """
+        self.roots = [os.path.realpath(top)]
+        self.device = os.stat(top).st_dev if one_device else None
+
+    def accepts(self, entry: os.DirEntry) -> bool:
+        """
+        Check a directory entry while its directory is listed, possibly by a worker thread
+        """
+        return self.device is None or entry.stat().st_dev == self.device
+
+    def enters(self, path: str) -> bool:
+        """
+        Check a symlinked directory when the walk reaches it, which keeps the choice between
+        two links to the same target in walk order
+        """
+        target = os.path.realpath(path)
+        if any(os.path.commonpath((target, root)) == root for root in self.roots):
+            return False
+        self.roots.append(target)
+        return True
+
+
+def _scan_dir(
+        storage: Storage,
+        root: str,
+        relative_root: str,
+        recursive: bool,
+        file_filter: Optional[FileFilter],
+        guard: Optional[_WalkGuard],
+        follow_symlinks: bool = False
+) -> Tuple[List[Tuple[str, str, bool]], List[os.DirEntry]]:
+    """
+    List one directory of a walk
+
+    :param follow_symlinks: walk symlinked directories too, otherwise they are skipped like os.walk does
+    :return: the (path, relative path, is symlink) triples of the subdirectories to walk and the file entries
+    """
+    dirs = []
+    files = []
+    for entry in storage.scandir(root):
+        if entry.is_dir(follow_symlinks=follow_symlinks):
+            if recursive:
+                relative_path = f"{relative_root}{entry.name}"
+                if ((file_filter is None or file_filter.accepts_dir(entry.name, relative_path)) and
+                        (guard is None or guard.accepts(entry))):
+                    dirs.append((entry.path, relative_path + "/", entry.is_symlink()))
+        elif not entry.is_dir():
+            files.append(entry)
+    return dirs, files
+
+
+def _walk_guard(storage: Storage, top: str, one_device: bool) -> Optional[_WalkGuard]:
+    # Object stores have neither symlinks nor mounts
+    return _WalkGuard(top, one_device) if isinstance(storage, LocalStorage) else None
+
+
+def _subdirs(dirs: List[Tuple[str, str, bool]], guard: Optional[_WalkGuard]) -> Iterator[Tuple[str, str]]:
+    """
+    Get the subdirectories to push on a walk's stack, in reverse so the first one is walked next
+    """
+    for path, relative_path, is_symlink in reversed(dirs):
+        if not is_symlink or guard is None or guard.enters(path):
+            yield path, relative_path
+
+
+def _walk(
+        storage: Storage,
+        top: str,
+        recursive: bool,
+        file_filter: Optional[FileFilter] = None,
+        one_device: bool = False,
+        follow_symlinks: bool = False
+):
+    """
+    Walk a directory tree top-down like os.walk, using the storage's scandir
+
+    :param storage: the storage serving the tree
+    :param top: the directory to start from
+    :param recursive: descend into subdirectories
+    :param file_filter: prunes the directories it does not accept
+    :param one_device: skip directories on other devices than top
+    :param follow_symlinks: walk symlinked directories, each target once and never in a loop
+    :return: a generator of (root, relative root, file entries) triples
+    """
+    guard = _walk_guard(storage, top, one_device)
+    pending = [(top, "")]
+    while pending:
+        root, relative_root = pending.pop()
+        dirs, files = _scan_dir(storage, root, relative_root, recursive, file_filter, guard, follow_symlinks)
+        yield root, relative_root, files
+        pending.extend(_subdirs(dirs, guard))
+
+
+def _walk_parallel(
+        storage: Storage,
+        top: str,
+        recursive: bool,
+        file_filter: Optional[FileFilter] = None,
+        one_device: bool = False,
+        workers: int = 8,
+        ordered: bool = True,
+        follow_symlinks: bool = False
+):
+    """
+    Walk a directory tree like _walk, listing several directories at the same time
+
+    On network filesystems and object stores every listing waits for a round trip, which the
+    workers overlap. At most 4 listings per worker are started ahead of the walk.
+
+    :param workers: number of directories listed at the same time
+    :param ordered: yield the directories in the order of _walk, rather than as their listings finish
+    :return: a generator of (root, relative root, file entries) triples
+    """
+    guard = _walk_guard(storage, top, one_device)
+    ahead = 4 * workers
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="heic-walk")
+
+    def submit(root, relative_root):
+        return executor.submit(_scan_dir, storage, root, relative_root, recursive, file_filter, guard,
+                               follow_symlinks)
 
-    :param dir_of_interest: the directory to search
+    try:
+        if ordered:
+            # The stack of _walk, where the next directories to be yielded are listed ahead
+            pending = [[top, "", None]]
+            while pending:
+                for item in pending[-ahead:]:
+                    if item[2] is None:
+                        item[2] = submit(item[0], item[1])
+                root, relative_root, future = pending.pop()
+                dirs, files = future.result()
+                yield root, relative_root, files
+                pending.extend([path, relative_path, None] for path, relative_path in _subdirs(dirs, guard))
+        else:
+            pending = [(top, "")]
+            in_flight = {}
+            while pending or in_flight:
+                while pending and len(in_flight) < ahead:
+                    root, relative_root = pending.pop()
+                    in_flight[submit(root, relative_root)] = (root, relative_root)
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    root, relative_root = in_flight.pop(future)
+                    dirs, files = future.result()
+                    yield root, relative_root, files
+                    pending.extend(_subdirs(dirs, guard))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def scan_tree(
+        dir_of_interest: str,
+        recursive: bool = True,
+        file_filter: Optional[FileFilter] = None,
+        pattern: Pattern = HEIC_PATTERN,
+        workers: int = 1,
+        ordered: bool = True,
+        one_device: bool = False,
+        follow_symlinks: bool = False
+) -> Iterator[Tuple[str, os.DirEntry]]:
+    """
+    Yield the HEIC files in the directory of interest as the scan finds them
+
+    Every directory is read with a single scandir call and its files are yielded before the
+    next directory is read, so the first file is available right away and the memory needed
+    depends on the largest directory rather than on the size of the tree.
+
+    :param dir_of_interest: the directory or URL to search
     :param recursive: search subdirectories
-    :return: a list of files as [path, filename] pairs
+    :param file_filter: optional selection of files and directories
+    :param pattern: the extensions of the files to yield, JPEG_PATTERN for the reverse direction
+    :param workers: number of directories listed at the same time
+    :param ordered: keep the order of a sequential walk when listing several directories at the same time
+    :param one_device: skip directories on other devices, e.g. mounted shares
+    :param follow_symlinks: also search symlinked directories, each target once and never in a loop
+    :return: a generator of (root, entry) pairs, the entries carry the stat data of the scan
     """
-    file_list = []
+    storage = get_storage(dir_of_interest)
+    if not storage.isdir(dir_of_interest):
+        print("Path {} is not a valid directory.".format(dir_of_interest))
+        return
 
-    if os.path.isdir(dir_of_interest):
-        for root, dirs, files in os.walk(dir_of_interest):
-            if not recursive:
-                dirs.clear()
-            for file in files:
-                if fnmatch.fnmatch(file.lower(), '*.heic'):
-                    file_list.append([os.path.normpath(root), file])
-        return file_list
+    top = storage.normpath(dir_of_interest)
+    if workers > 1:
+        walk = _walk_parallel(storage, top, recursive, file_filter, one_device, workers, ordered, follow_symlinks)
     else:
-        print("Path {} is not a valid directory.".format(dir_of_interest))
-        return []
+        walk = _walk(storage, top, recursive, file_filter, one_device, follow_symlinks)
+    for root, relative_root, files in walk:
+        root = storage.normpath(root)
+        for entry in files:
+            if not pattern.search(entry.name):
+                continue
+            if file_filter is None or file_filter.accepts_file(entry, relative_root + entry.name):
+                yield root, entry
 
 
-def convert_heic_file(
-        source_file: str,
-        target_file: str,
-        overwrite: bool,
-        remove: bool,
-        quality: int,
-        progress_callback: Optional[Callable[[str], None]] = None,
-        verbose: bool = False
-) -> bool:
+def _list_heic_entries(
+        dir_of_interest: str,
+        recursive: bool,
+        file_filter: Optional[FileFilter] = None,
+        pattern: Pattern = HEIC_PATTERN,
+        workers: int = 1,
+        one_device: bool = False,
+        follow_symlinks: bool = False
+) -> list:
     """
-    Convert a single heic file to jpeg
+    Get the directory entries of all HEIC files in the directory of interest
 
-    :param source_file: the source file
-    :param target_file: the target file
-    :param overwrite: overwrite existing jpeg files
-    :param remove: remove converted heic files
-    :param quality: quality of jpeg files (1-100)
-    :param progress_callback: optional callback for progress updates
-    :param verbose: enable more detailed output
-    :return: True if successful, False otherwise
+    :param dir_of_interest: the directory or URL to search
+    :param recursive: search subdirectories
+    :param file_filter: optional selection of files and directories
+    :param pattern: the extensions of the files to list, JPEG_PATTERN for the reverse direction
+    :param workers: number of directories listed at the same time
+    :param one_device: skip directories on other devices, e.g. mounted shares
+    :param follow_symlinks: also search symlinked directories
+    :return: a list of (path, entry) pairs, the entries carry the stat data of the scan
     """
-    # Validate inputs
-    if not os.path.isfile(source_file):
-        if verbose:
-            print(f"Source file {source_file} does not exist")
-        return False
+    return list(scan_tree(dir_of_interest, recursive, file_filter, pattern, workers, True, one_device,
+                          follow_symlinks))
 
-    if not source_file.lower().endswith('.heic'):
-        if verbose:
-            print(f"Source file {source_file} is not a HEIC file")
-        return False
 
-    # Normalize quality
-    quality = max(1, min(100, quality))
+def get_file_list(
+        dir_of_interest: str,
+        recursive: bool,
+        file_filter: Optional[FileFilter] = None,
+        workers: int = 1,
+        ordered: bool = True,
+        one_device: bool = False,
+        follow_symlinks: bool = False
+) -> List[List[str]]:
+    """
+    Get a list of all HEIC files in the directory of interest
+
+    :param dir_of_interest: the directory or URL to search
+    :param recursive: search subdirectories
+    :param file_filter: optional selection by globs, size and modification time
+    :param workers: number of directories listed at the same time, e.g. 16 for network shares
+    :param ordered: keep the order of a sequential walk when listing several directories at the same time
+    :param one_device: skip directories on other devices, e.g. mounted shares
+    :param follow_symlinks: also search symlinked directories, each target once and never in a loop
+    :return: a list of files as [path, filename] pairs
+    """
+    return [[root, entry.name] for root, entry in scan_tree(dir_of_interest, recursive, file_filter, HEIC_PATTERN,
+                                                               workers, ordered, one_device, follow_symlinks)]
+
 
-    # Report progress if callback provided
-    if progress_callback:
-        progress_callback(f"Converting {os.path.basename(source_file)}")
+# Fields of an output layout template, e.g. {year}/{month}/{day}/{name}.jpg
+OUTPUT_LAYOUT_FIELDS = ("year", "month", "day", "hour", "minute", "second", "name")
 
-    # Check if target folder exists
-    target_folder = os.path.dirname(target_file)
-    if not os.path.exists(target_folder):
-        if verbose:
-            print(f'Creating folder {target_folder}')
-        os.makedirs(target_folder)
 
-    if os.path.exists(target_file) and not overwrite:
-        if verbose:
-            print(f'File {target_file} already exists, skip')
-        return False
+def render_output_layout(template: str, name: str, taken: datetime) -> str:
+    """
+    Fill an output layout template for one file
+
+    Date fields are zero-padded, so the directories sort chronologically.
 
+    :param template: relative target path with fields of OUTPUT_LAYOUT_FIELDS, '/' separated
+    :param name: the source file name without extension
+    :param taken: the capture time of the source
+    :return: the relative target path
+    """
+    fields = {
+        "year": f"{taken.year:04d}",
+        "month": f"{taken.month:02d}",
+        "day": f"{taken.day:02d}",
+        "hour": f"{taken.hour:02d}",
+        "minute": f"{taken.minute:02d}",
+        "second": f"{taken.second:02d}",
+        "name": name,
+    }
     try:
-        image = Image.open(source_file)
-        image_exif = image.getexif()
+        path = template.format(**fields)
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"Invalid output layout '{template}', the fields are "
+                         f"{', '.join('{' + field + '}' for field in OUTPUT_LAYOUT_FIELDS)}: {e}")
+    parts = path.replace("\\", "/").split("/")
+    if not parts[-1] or any(part in ("", ".", "..") for part in parts):
+        raise ValueError(f"Invalid output layout '{template}', it must be a relative file path")
+    return "/".join(parts)
+
+
+# Size of the pieces in which a file list is read by iter_path_list
+PATH_LIST_CHUNK = 64 * 1024
+
+
+def iter_path_list(f) -> Iterator[str]:
+    """
+    Stream the paths of a newline or NUL separated list, e.g. the output of find -print0
+
+    The list is NUL separated if a NUL byte comes before the first newline. Paths are yielded
+    as soon as they are complete, so memory use does not grow with the length of the list.
+
+    :param f: the list opened for binary reading, e.g. sys.stdin.buffer
+    :return: a generator of the paths, without empty entries
+    """
+    separator = None
+    pending = b""
+    while True:
+        chunk = f.read(PATH_LIST_CHUNK)
+        if not chunk:
+            break
+        pending += chunk
+        if separator is None:
+            nul, newline = pending.find(b"\0"), pending.find(b"\n")
+            if nul < 0 and newline < 0:
+                continue
+            separator = b"\0" if newline < 0 or 0 <= nul < newline else b"\n"
+        *paths, pending = pending.split(separator)
+        for path in paths:
+            if separator == b"\n":
+                path = path.rstrip(b"\r")
+            if path:
+                yield os.fsdecode(path)
+    pending = pending.rstrip(b"\r\n")
+    if pending:
+        yield os.fsdecode(pending)
+
+
+class BufferPool:
+    """
+    Reuses the full-resolution buffers of decoding between images of the same size and mode
+
+    Image libraries usually hold only a few distinct sensor sizes, so instead of allocating and
+    freeing hundreds of MB per file, released buffers are kept by (width, height, mode) and handed
+    out again. The pool also turns on the block cache of Pillow's allocator with the same budget,
+    which recycles the memory of decoded images the same way. At most max_bytes are kept, the
+    least recently used sizes go first, and everything is released after idle_seconds without a
+    conversion. Pillow's previous cache limit is restored once no pool uses the block cache anymore.
+    """
+
+    def __init__(self, max_bytes: int = BUFFER_POOL_BUDGET, idle_seconds: float = BUFFER_POOL_IDLE):
+        """
+        :param max_bytes: maximum size of the buffers kept for reuse
+        :param idle_seconds: release all kept buffers after this long without use
+        """
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.allocations = 0
+        self.reuses = 0
+        self._free = {}
+        self._last_used = {}
+        self._held = 0
+        self._timer = None
+        self._block_cache = False
+        self._active = 0
+        self._last_activity = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _shape(width: int, height: int, mode: str) -> Tuple[int, int, int]:
+        return height, width, len(mode)
+
+    def acquire(self, width: int, height: int, mode: str):
+        """
+        Get an uninitialized uint8 array of shape (height, width, channels) for an RGB, RGBX or RGBA image
+        """
+        import numpy as np
+
+        key = (width, height, len(mode))
+        with self._lock:
+            buffers = self._free.get(key)
+            if buffers:
+                buffer = buffers.pop()
+                self._held -= buffer.nbytes
+                self._last_used[key] = self._last_activity = time.monotonic()
+                self.reuses += 1
+                return buffer
+            self.allocations += 1
+        return np.empty(self._shape(width, height, mode), dtype=np.uint8)
+
+    def release(self, buffer) -> None:
+        """
+        Return a buffer from acquire() once nothing refers to its content anymore
+        """
+        height, width, channels = buffer.shape
+        key = (width, height, channels)
+        with self._lock:
+            if buffer.nbytes > self.max_bytes:
+                return
+            # Make room by dropping the sizes that were not used for the longest time
+            while self._held + buffer.nbytes > self.max_bytes:
+                oldest = min((k for k in self._free if self._free[k]), key=self._last_used.__getitem__)
+                self._held -= self._free[oldest].pop().nbytes
+            self._free.setdefault(key, []).append(buffer)
+            self._held += buffer.nbytes
+            self._last_used[key] = self._last_activity = time.monotonic()
+            if self._timer is None:
+                self._schedule_expiry(self.idle_seconds)
+
+    def begin(self) -> None:
+        """
+        Note the start of a conversion: the pool is not emptied while it runs
+        """
+        self.enable_block_cache()
+        with self._lock:
+            self._active += 1
+            self._last_activity = time.monotonic()
+
+    def end(self) -> None:
+        """
+        Note the end of a conversion, from which the idle time is counted
+        """
+        with self._lock:
+            self._active -= 1
+            self._last_activity = time.monotonic()
+            if self._timer is None:
+                self._schedule_expiry(self.idle_seconds)
+
+    def enable_block_cache(self) -> None:
+        """
+        Let Pillow keep freed image blocks for reuse, up to the budget of the pool
+        """
+        global _block_cache_users, _block_cache_previous
+        with self._lock:
+            if self._block_cache:
+                return
+            from PIL import Image
+
+            with _block_cache_lock:
+                if not _block_cache_users:
+                    _block_cache_previous = Image.core.get_blocks_max()
+                _block_cache_users += 1
+                # Pools running side by side share the limit, which covers the largest budget
+                blocks = max(1, self.max_bytes // Image.core.get_block_size())
+                Image.core.set_blocks_max(max(blocks, Image.core.get_blocks_max()))
+            self._block_cache = True
+
+    def clear(self) -> None:
+        """
+        Release all kept buffers, and the blocks cached by Pillow with its cache limit if no other pool uses them
+        """
+        global _block_cache_users
+        with self._lock:
+            self._free.clear()
+            self._last_used.clear()
+            self._held = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._block_cache:
+                from PIL import Image
+
+                with _block_cache_lock:
+                    _block_cache_users -= 1
+                    if not _block_cache_users:
+                        Image.core.set_blocks_max(_block_cache_previous)
+                        Image.core.clear_cache()
+                self._block_cache = False
+
+    @property
+    def held_bytes(self) -> int:
+        return self._held
+
+    def _schedule_expiry(self, delay: float) -> None:
+        self._timer = threading.Timer(delay, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self) -> None:
+        with self._lock:
+            self._timer = None
+            idle = time.monotonic() - self._last_activity
+            if self._active:
+                self._schedule_expiry(self.idle_seconds)
+                return
+            if idle < self.idle_seconds:
+                self._schedule_expiry(self.idle_seconds - idle)
+                return
+        self.clear()
+
+
+class _ConvertedCount:
+    """
+    Stands in for the list of converted targets when only their number is kept
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def append(self, _: str) -> None:
+        self.count += 1
+
+
+class Converter:
+    """
+    Converts HEIC files to JPEG with one configuration
+
+    The converter keeps its worker pool and per-worker scratch buffers between calls, so a
+    long-running service can create it once and feed it files. Use it as a context manager,
+    or call close() when it is no longer needed.
+    """
+
+    def __init__(
+            self,
+            target: Optional[str] = None,
+            overwrite: bool = False,
+            remove: bool = False,
+            quality: int = 95,
+            preserve_folder_structure: bool = True,
+            generate_unique: bool = False,
+            verbose: bool = False,
+            progress_callback: Optional[ProgressCallback] = None,
+            progress_rate: float = 10.0,
+            jobs: Union[int, str] = 1,
+            decode_threads: Union[int, str, None] = None,
+            tone_map: Optional[str] = None,
+            dither: str = 'ordered',
+            file_filter: Optional[FileFilter] = None,
+            max_read_mbps: Optional[float] = None,
+            max_write_mbps: Optional[float] = None,
+            max_load: Optional[float] = None,
+            order: str = 'walk',
+            report: Optional[ReportWriter] = None,
+            mmap_input: bool = False,
+            prefetch: str = 'auto',
+            prefetch_depth: int = PREFETCH_DEPTH,
+            prefetch_budget: int = PREFETCH_BUDGET,
+            output_layout: Optional[str] = None,
+            pool_budget: int = BUFFER_POOL_BUDGET,
+            output_format: str = 'jpeg',
+            encoder_speed: str = 'medium',
+            max_bytes: Optional[int] = None,
+            scan_threads: int = 1,
+            one_device: bool = False,
+            follow_symlinks: bool = False,
+            large_pixels: Optional[int] = LARGE_IMAGE_PIXELS,
+            color: str = 'none',
+            audit_sample: Optional[int] = None
+    ):
+        """
+        :param target: the target directory or URL, if None files are converted next to their source
+        :param overwrite: overwrite existing jpeg files
+        :param remove: remove converted heic files
+        :param quality: quality of jpeg files (1-100)
+        :param preserve_folder_structure: recreate the subfolders of a tree in the target directory
+        :param generate_unique: generate unique filenames when the target exists
+        :param verbose: enable more detailed output
+        :param progress_callback: optional callback for progress events
+        :param progress_rate: maximum number of progress events per second during batches
+        :param jobs: number of files converted in parallel, 'auto' to tune it by the throughput of
+                     each batch, up to the number of available CPUs
+        :param decode_threads: libheif decode threads per image, 'auto' to balance them against
+                               the parallel jobs for each batch, None to keep the libheif default.
+                               The setting applies to the whole process.
+        :param tone_map: curve for converting high bit-depth images to 8 bit ('clip', 'reinhard' or
+                         'hable'), None to let libheif truncate them
+        :param dither: dithering applied by the tone mapping ('none', 'ordered' or 'blue-noise')
+        :param file_filter: selection of the files and directories convert_tree scans
+        :param max_read_mbps: cap of the bytes read from sources in MB/s, shared by all jobs
+        :param max_write_mbps: cap of the bytes written to targets in MB/s, shared by all jobs
+        :param max_load: pause dispatching conversions while the load average is above this
+        :param order: the scheduling policy of batches ('walk', 'largest-first' or 'newest-first')
+        :param report: receives a record of every file that finished, was skipped or failed
+        :param mmap_input: memory-map local sources instead of reading them, except on network mounts
+        :param prefetch: how sources are fetched ahead of the conversion ('auto', 'off', 'read' or 'fadvise')
+        :param prefetch_depth: number of files fetched ahead
+        :param prefetch_budget: maximum bytes held by prefetched files
+        :param output_layout: template of the target paths below the target directory, e.g.
+                              {year}/{month}/{day}/{name}.jpg, filled from the EXIF capture time or
+                              else the modification time; replaces the folder structure of trees
+        :param pool_budget: maximum bytes of decode buffers kept for reuse between images, 0 to
+                            allocate them for every image
+        :param output_format: 'jpeg' to convert HEIC files, 'heic' to compact JPEG files into HEIC
+        :param encoder_speed: speed of the HEIC encoder, one of ENCODER_SPEEDS
+        :param max_bytes: maximum size of a target; the quality is lowered as far as needed to stay
+                          below it, quality is the highest one tried
+        :param scan_threads: number of directories listed at the same time when scanning trees
+        :param one_device: do not scan directories on other devices than the tree, e.g. mounted shares
+        :param follow_symlinks: also scan symlinked directories of trees, each target once and never in a loop
+        :param large_pixels: with parallel jobs, images with more pixels are converted one at a time and
+                             encoded into memory that is freed right after, None to treat all images alike
+        :param color: colour management of sources with an ICC profile, e.g. the Display P3 of phones:
+                      'none' to leave it to the encoder, 'srgb' to convert the pixels to sRGB, 'embed'
+                      to keep the profile in the targets
+        :param audit_sample: number of randomly picked conversions per batch whose targets are decoded
+                             again and compared with the decoded source by PSNR and SSIM
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format}, expected one of {', '.join(OUTPUT_FORMATS)}")
+        if encoder_speed not in ENCODER_SPEEDS:
+            raise ValueError(f"Unknown encoder speed {encoder_speed}, expected one of {', '.join(ENCODER_SPEEDS)}")
+        if color not in COLOR_MODES:
+            raise ValueError(f"Unknown color mode {color}, expected one of {', '.join(COLOR_MODES)}")
+        self.target = target
+        self.overwrite = overwrite
+        self.remove = remove
+        self.quality = max(1, min(100, quality))
+        self.preserve_folder_structure = preserve_folder_structure
+        self.generate_unique = generate_unique
+        self.verbose = verbose
+        self.progress_callback = progress_callback
+        self.progress_rate = progress_rate
+        self.autotune = jobs == 'auto'
+        self.jobs = available_cpus() if self.autotune else max(1, jobs)
+        self.tuned_jobs = None
+        self.decode_threads = decode_threads
+        self.tone_map = tone_map
+        self.dither = dither
+        self.file_filter = file_filter
+        self._read_bucket = TokenBucket(max_read_mbps * 1e6) if max_read_mbps else None
+        self._write_bucket = TokenBucket(max_write_mbps * 1e6) if max_write_mbps else None
+        self._load_governor = LoadGovernor(max_load, verbose=verbose) if max_load else None
+        self.order = order
+        self.report = report
+        self.mmap_input = mmap_input
+        self.prefetch = prefetch
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_budget = prefetch_budget
+        self.prefetch_stats = None
+        self.verify_stats = None
+        self.output_layout = output_layout
+        self._buffer_pool = BufferPool(pool_budget) if pool_budget else None
+        self.output_format = output_format
+        self.encoder_speed = encoder_speed
+        self.source_pattern = JPEG_PATTERN if output_format == 'heic' else HEIC_PATTERN
+        self.target_extension = ".heic" if output_format == 'heic' else ".jpg"
+        self.max_bytes = max_bytes
+        self._quality_history = deque(maxlen=QUALITY_HISTORY)
+        self.scan_threads = max(1, scan_threads)
+        self.one_device = one_device
+        self.follow_symlinks = follow_symlinks
+        self.large_pixels = large_pixels
+        self._large_lock = threading.Lock()
+        self.color = color
+        self.color_transforms = TransformCache() if color == 'srgb' else None
+        self.audit_sample = audit_sample
+        self.audit_stats = None
+        self._auditor = None
+        # Sizes of the sources and targets of the successful conversions
+        self.input_bytes = 0
+        self.output_bytes = 0
+        if output_layout:
+            render_output_layout(output_layout, "name", datetime.now())
+        if isinstance(decode_threads, int):
+            import pillow_heif
+            pillow_heif.options.DECODE_THREADS = max(1, decode_threads)
 
-        exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}}
+        self._executor = None
+        self._scratch = threading.local()
+        self._claimed = set()
+        self._created_dirs = set()
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
 
-        if image_exif:
-            # Make a map with tag names and grab the datetime
-            exif = {ExifTags.TAGS[k]: v for k, v in image_exif.items() if k in ExifTags.TAGS and type(v) is not bytes}
-            if 'DateTime' in exif:
-                date = datetime.strptime(exif['DateTime'], '%Y:%m:%d %H:%M:%S')
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Shut down the worker pool and drop the scratch buffers
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._scratch = threading.local()
+        if self._buffer_pool:
+            self._buffer_pool.clear()
+
+    def cancel(self) -> None:
+        """
+        Stop dispatching conversions, from any thread
+
+        Conversions already running are finished; the running batch and any later one return
+        what was converted so far.
+        """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def convert_file(
+            self,
+            source_file: str,
+            target_file: Optional[str] = None,
+            source_data: Optional[bytes] = None,
+            progress_callback: Optional[ProgressCallback] = None
+    ) -> bool:
+        """
+        Convert a single heic file to jpeg, or a jpeg file to heic in the reverse direction
+
+        :param source_file: the source file or URL
+        :param target_file: the target file or URL, derived from the target directory if None
+        :param source_data: content of the source file if it was already read ahead
+        :param progress_callback: callback receiving a started event and then a finished, skipped
+                                  or failed event, defaults to the converter's callback
+        :return: True if successful, False otherwise
+        """
+        if target_file is None:
+            target_file = self._target_for(source_file)
+        progress_callback = progress_callback or self.progress_callback
+        verbose = self.verbose
+        source_storage = get_storage(source_file)
+        target_storage = get_storage(target_file)
+
+        report_writer = self.report
+
+        def report(kind: ProgressKind, size: int = 0, error: Optional[str] = None, **details):
+            if progress_callback or report_writer:
+                event = ProgressEvent(kind, source_file, target_file, size, time.monotonic() - start, error, **details)
+                if report_writer:
+                    report_writer.write(event)
+                if progress_callback:
+                    progress_callback(event)
+
+        start = time.monotonic()
+
+        # Validate inputs
+        if source_data is None and not source_storage.isfile(source_file):
+            if verbose:
+                print(f"Source file {source_file} does not exist")
+            report(ProgressKind.SKIPPED, error="source file does not exist")
+            return False
+
+        if not self.source_pattern.search(source_file):
+            source_type = "JPEG" if self.output_format == 'heic' else "HEIC"
+            if verbose:
+                print(f"Source file {source_file} is not a {source_type} file")
+            report(ProgressKind.SKIPPED, error=f"not a {source_type} file")
+            return False
+
+        # Only look up the sizes if somebody is interested in them
+        measure = progress_callback or report_writer or self.output_format == 'heic'
+        source_size = 0
+        if measure:
+            source_size = len(source_data) if source_data is not None else source_storage.size(source_file)
+        report(ProgressKind.STARTED, source_size)
+
+        # Check if target folder exists
+        target_folder = target_storage.dirname(target_file)
+        if target_folder:
+            self._ensure_dir(target_storage, target_folder)
+
+        if target_storage.exists(target_file) and not self.overwrite:
+            if verbose:
+                print(f'File {target_file} already exists, skip')
+            report(ProgressKind.SKIPPED, source_size, "target file already exists")
+            return False
+
+        load_codecs()
+        import piexif
+        from PIL import ExifTags, Image, ImageOps
+
+        if self._buffer_pool:
+            self._buffer_pool.begin()
+        mapping = None
+        pooled = None
+        large = False
+        try:
+            if source_data is None and self._read_bucket:
+                with source_storage.open(source_file, "rb") as f:
+                    source_data = read_throttled(f, self._read_bucket)
+            elif source_data is None and self.mmap_input:
+                mapping = source_storage.map(source_file)
+
+            # Parallel jobs decoding several very large images at once would multiply the peak memory; a single
+            # worker has nothing to wait for, so its files are not opened for the header
+            pixels = None
+            if self.large_pixels and self.output_format == 'jpeg' and self.jobs > 1:
+                pixels = self._header_pixels(source_file, source_storage, source_data, mapping)
+            if pixels and pixels > self.large_pixels:
+                self._large_lock.acquire()
+                large = True
+                if verbose:
+                    print(f'Converting large image {source_file} ({pixels / 1e6:.0f} MP) on its own')
+
+            if source_data is not None:
+                image = Image.open(io.BytesIO(source_data))
+            elif mapping is not None:
+                # pillow_heif copies the mapped pages into its input buffer in a single pass
+                image = Image.open(mapping)
+            elif source_storage.remote:
+                image = Image.open(source_storage.open(source_file, "rb"))
+            else:
+                image = Image.open(source_file)
+            if self.output_format == 'heic':
+                # HEIC viewers apply the orientation of the container, not of the EXIF data
+                image = ImageOps.exif_transpose(image)
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGB")
+            image_exif = image.getexif()
+
+            exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}}
+
+            if image_exif:
+                # Make a map with tag names and grab the datetime
+                exif = {ExifTags.TAGS[k]: v for k, v in image_exif.items() if
+                        k in ExifTags.TAGS and type(v) is not bytes}
+                if 'DateTime' in exif:
+                    date = datetime.strptime(exif['DateTime'], '%Y:%m:%d %H:%M:%S')
+                else:
+                    date = datetime.now()
+
+                # Try to load existing exif data via piexif
+                try:
+                    if "exif" in image.info:
+                        exif_dict = piexif.load(image.info["exif"])
+                except:
+                    # If loading fails, use our default structure
+                    pass
             else:
+                # No EXIF data exists, use current datetime
                 date = datetime.now()
+                if verbose:
+                    print(f'No EXIF data found for {source_file}, creating dummy EXIF data')
+
+            # Update exif data with orientation and datetime
+            exif_dict["0th"][piexif.ImageIFD.DateTime] = date.strftime("%Y:%m:%d %H:%M:%S")
+            exif_dict["0th"][piexif.ImageIFD.Orientation] = 1
+
+            # Add dummy author data to ensure EXIF is not empty
+            exif_dict["0th"][piexif.ImageIFD.Artist] = "unknown"
+
+            # Ensure the Exif IFD exists and add a dummy entry if needed
+            if not exif_dict.get("Exif"):
+                exif_dict["Exif"] = {}
+
+            exif_bytes = piexif.dump(exif_dict)
+
+            # Replace the truncated 8-bit decode of high bit-depth images by a tone-mapped one
+            if self.tone_map and image.info.get("bit_depth", 8) > 8:
+                image, pooled = self._decode_high_bit_depth(source_file, source_storage,
+                                                            source_data if mapping is None else mapping)
+                if verbose:
+                    print(f'Tone mapped high bit-depth image {source_file} with {self.tone_map}')
+
+            # Release the mapping as soon as the image is decoded
+            if mapping is not None:
+                image.load()
+                mapping.close()
+                mapping = None
+
+            # Bring wide-gamut sources to sRGB, or keep their profile so viewers can do it
+            icc_profile = None
+            if self.color == 'srgb':
+                if to_srgb(image, image.info.get("icc_profile"), self.color_transforms) and verbose:
+                    print(f'Converted the colours of {source_file} to sRGB')
+            elif self.color == 'embed':
+                icc_profile = image.info.get("icc_profile")
+
+            # Save image as jpeg, remote, rate-limited and size-limited targets get it from the worker's scratch buffer
+            output_size = None
+            save_format, save_options = self._save_options(icc_profile=icc_profile)
+            if target_storage.remote or self._write_bucket or self.max_bytes:
+                if self.max_bytes:
+                    buffer, output_size = self._encode_within_limit(image, exif_bytes, source_file, large,
+                                                                    icc_profile)
+                else:
+                    buffer = self._encode_buffer(transient=large)
+                    image.save(buffer, save_format, exif=exif_bytes, **save_options)
+                    output_size = buffer.tell()
+                with buffer.getbuffer() as view, target_storage.open(target_file, "wb") as f:
+                    if self._write_bucket:
+                        write_throttled(f, view[:output_size], self._write_bucket)
+                    else:
+                        f.write(view[:output_size])
+            else:
+                image.save(target_file, save_format, exif=exif_bytes, **save_options)
+            if verbose:
+                print(f'Converted image: {source_file} -> {target_file}')
+
+            auditor = self._auditor
+            audit = {}
+            picked = auditor.pick() if auditor is not None else None
+            if picked is not None:
+                audit = self._audit(image, target_file, target_storage, buffer if output_size else None, output_size)
+                if audit:
+                    auditor.record(picked, audit["psnr"], audit["ssim"])
+                    if verbose:
+                        print(f'Audited {target_file}: PSNR {audit["psnr"]:.2f} dB, SSIM {audit["ssim"]:.4f}')
+
+            if self.remove:
+                source_storage.remove(source_file)
+                if verbose:
+                    print(f'Removed original: {source_file}')
+
+            details = {}
+            if (report_writer or self.output_format == 'heic') and output_size is None:
+                output_size = target_storage.size(target_file)
+            if output_size is not None:
+                with self._lock:
+                    self.input_bytes += source_size
+                    self.output_bytes += output_size
+            if report_writer:
+                details = {"output_bytes": output_size, "width": image.width, "height": image.height}
+            report(ProgressKind.FINISHED, source_size, **details, **audit)
+            return True
+
+        except Image.UnidentifiedImageError as e:
+            print(f"{source_file} is not a valid image: {e}")
+            error = e
+        except Exception as e:
+            print(f"Unable to convert {source_file}: {e}")
+            error = e
+        finally:
+            if mapping is not None:
+                mapping.close()
+            if pooled is not None:
+                self._buffer_pool.release(pooled)
+            if self._buffer_pool:
+                self._buffer_pool.end()
+            if large:
+                self._large_lock.release()
+
+        report(ProgressKind.FAILED, source_size, f"{type(error).__name__}: {error}",
+               error_class=type(error).__name__)
+        return False
 
-            # Try to load existing exif data via piexif
+    @staticmethod
+    def _header_pixels(
+            source_file: str,
+            source_storage: Storage,
+            source_data: Optional[bytes],
+            mapping
+    ) -> Optional[int]:
+        """
+        Get the pixel count of a HEIF source from its header, without decoding it
+
+        Remote sources are only looked at when they were read ahead, a separate request for the
+        header would cost a round trip per file.
+        """
+        try:
+            if source_data is not None or mapping is not None:
+                data = source_data if source_data is not None else mapping
+                return read_header(io.BytesIO(data[:HEADER_BYTES]), capture_time=False).pixels
+            if source_storage.remote:
+                return None
+            with source_storage.open(source_file, "rb") as f:
+                return read_header(f, capture_time=False).pixels
+        except Exception:
+            return None
+
+    def _decode_high_bit_depth(
+            self,
+            source_file: str,
+            source_storage: Storage,
+            source_data
+    ) -> Tuple["Image.Image", Optional["np.ndarray"]]:
+        """
+        Decode a 10/12-bit HEIC to 16-bit values and tone map it to an 8-bit image
+
+        :param source_file: the source file or URL
+        :param source_storage: the storage serving the source
+        :param source_data: content of the source file if it was already read ahead, or its mapping
+        :return: the 8-bit image, and the pooled buffer holding its pixels that has to be released
+                 once the image is saved, if there is a pool
+        """
+        import numpy as np
+        import pillow_heif
+        from PIL import Image
+        from tonemap import TO_BT709, to_8bit
+
+        if source_data is not None:
+            heif_file = pillow_heif.open_heif(source_data, convert_hdr_to_8bit=False)
+        else:
+            with source_storage.open(source_file, "rb") as f:
+                heif_file = pillow_heif.open_heif(f, convert_hdr_to_8bit=False)
+
+        data = np.asarray(heif_file)
+        height, width, channels = data.shape
+        # Pillow keeps RGB pixels in 4 bytes; RGBX is laid out the same, so the image can share
+        # the array instead of copying it, and the encoder reads the rows from it in place
+        mode = "RGBA" if channels == 4 else "RGBX"
+        pooled = self._buffer_pool.acquire(width, height, mode) if self._buffer_pool else None
+        try:
+            data = to_8bit(data, heif_file.info.get("nclx_profile"), self.tone_map, self.dither,
+                           out=pooled if pooled is not None else np.empty((height, width, 4), dtype=np.uint8))
+        except Exception:
+            if pooled is not None:
+                self._buffer_pool.release(pooled)
+            raise
+        info = heif_file.info
+        del heif_file
+        # The image shares the memory of the array, which is only reused after release
+        image = Image.frombuffer(mode, (width, height), data, "raw", mode, 0, 1)
+        # Known primaries are converted to sRGB by the tone mapping, the profile only fits the others
+        if info.get("icc_profile") and (info.get("nclx_profile") or {}).get("color_primaries") not in TO_BT709:
+            image.info["icc_profile"] = info["icc_profile"]
+        return image, pooled
+
+    def convert_files(self, file_list: Iterable[str]) -> List[str]:
+        """
+        Convert a list of HEIC files into the target directory
+
+        :param file_list: HEIC file paths or URLs
+        :return: the target paths of the successfully converted files
+        """
+        if self.target is None:
+            raise ValueError("convert_files needs a target directory")
+        target_storage = get_storage(self.target)
+
+        valid_files = []
+        bytes_total = 0
+        for source_file in file_list:
+            source_storage = get_storage(source_file)
+            if not source_storage.isfile(source_file) or not self.source_pattern.search(source_file):
+                if self.verbose:
+                    print(f'Skipping invalid file: {source_file}')
+                continue
+            valid_files.append(source_file)
+            if self.progress_callback:
+                bytes_total += source_storage.size(source_file)
+
+        files_total = len(valid_files)
+        jobs = self._balance_threads(valid_files, files_total)
+        if self.order != 'walk':
+            valid_files = prioritize([(source_file, get_storage(source_file).stat(source_file), source_file)
+                                      for source_file in valid_files], self.order)
+        plan = ((source_file, self._target_for(source_file)) for source_file in valid_files)
+        return self._run_batch(plan, files_total, bytes_total, jobs)
+
+    def convert_stream(self, file_list: Iterable[str]) -> int:
+        """
+        Convert HEIC files into the target directory while the list of them is still being read
+
+        Unlike convert_files, the list is consumed lazily and only the number of converted
+        files is kept, so lists of any length need constant memory. The batch has no known
+        total, and is converted in the order of the list.
+
+        :param file_list: HEIC file paths or URLs, e.g. from iter_path_list
+        :return: the number of successfully converted files
+        """
+        if self.target is None:
+            raise ValueError("convert_stream needs a target directory")
+
+        def valid_files():
+            for source_file in file_list:
+                if not self.source_pattern.search(source_file) or not get_storage(source_file).isfile(source_file):
+                    if self.verbose:
+                        print(f'Skipping invalid file: {source_file}')
+                    continue
+                yield source_file
+
+        jobs, sources = self._balance_stream(valid_files())
+        plan = ((source_file, self._target_for(source_file)) for source_file in sources)
+        converted = _ConvertedCount()
+        self._run_batch(plan, None, None, jobs, converted)
+        return converted.count
+
+    def convert_tree(self, dir_of_interest: str, recursive: bool = True) -> List[str]:
+        """
+        Convert all heic files in the directory of interest
+
+        :param dir_of_interest: the directory or URL to search
+        :param recursive: search subdirectories
+        :return: the target paths of the successfully converted files
+        """
+        heic_entries = _list_heic_entries(dir_of_interest, recursive, self.file_filter, self.source_pattern,
+                                          self.scan_threads, self.one_device, self.follow_symlinks)
+
+        if self.verbose:
+            print(f'Found {len(heic_entries)} files to convert in folder {dir_of_interest}')
+
+        bytes_total = 0
+        if self.progress_callback:
+            bytes_total = sum(entry.stat().st_size for _, entry in heic_entries)
+
+        ordered_entries = heic_entries
+        if self.order != 'walk':
+            ordered_entries = prioritize([(entry.path, entry.stat(), (root, entry)) for root, entry in heic_entries],
+                                         self.order)
+
+        jobs = self._balance_threads([entry.path for _, entry in heic_entries], len(heic_entries))
+        return self._run_batch(self._tree_plan(dir_of_interest, ordered_entries), len(heic_entries), bytes_total,
+                               jobs)
+
+    def verify_tree(self, dir_of_interest: str, recursive: bool = True) -> List[str]:
+        """
+        Convert again the heic files in the directory of interest whose targets are missing or broken
+
+        Every source is matched to the target that convert_tree would write, and the target is
+        checked by its markers and headers without decoding it, VERIFY_THREADS at a time. Broken
+        targets are removed and converted again. Names made unique by earlier runs are not
+        recognized, only the plain target of each source is checked.
+
+        :param dir_of_interest: the directory or URL to search
+        :param recursive: search subdirectories
+        :return: the target paths of the files that were converted again
+        """
+        stats = {"verified": 0, "missing": 0, "broken": 0}
+        entries = scan_tree(dir_of_interest, recursive, self.file_filter, self.source_pattern, self.scan_threads, True,
+                            self.one_device, self.follow_symlinks)
+
+        def damaged():
+            for source_file, target_file, problem in self._check_targets(self._tree_plan(dir_of_interest, entries)):
+                stats["verified"] += 1
+                if problem is None:
+                    continue
+                if problem == "missing":
+                    stats["missing"] += 1
+                else:
+                    stats["broken"] += 1
+                    get_storage(target_file).remove(target_file)
+                if self.verbose:
+                    print(f'{target_file}: {problem}')
+                yield source_file, target_file
+
+        converted = self._run_batch(damaged(), None, None, self.jobs)
+        self.verify_stats = stats
+        if self.report:
+            self.report.add_summary(stats)
+        return converted
+
+    @staticmethod
+    def _check_targets(plan: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str, Optional[str]]]:
+        """
+        Check planned targets on a thread pool, keeping the order of the plan
+
+        :return: a generator of (source, target, problem) triples, problem is None for good targets
+        """
+        window = deque()
+        with ThreadPoolExecutor(max_workers=VERIFY_THREADS, thread_name_prefix="heic-verify") as executor:
+            for source_file, target_file in plan:
+                window.append((source_file, target_file, executor.submit(check_target, target_file)))
+                if len(window) >= 2 * VERIFY_THREADS:
+                    source_file, target_file, future = window.popleft()
+                    yield source_file, target_file, future.result()
+            while window:
+                source_file, target_file, future = window.popleft()
+                yield source_file, target_file, future.result()
+
+    def iter_tree(self, dir_of_interest: str, recursive: bool = True) -> Iterator[ProgressEvent]:
+        """
+        Convert all heic files in the directory of interest while it is still being scanned
+
+        The first conversion starts as soon as the scan finds the first file, and a result is
+        yielded for every file as it finishes, in the order the files finish. Only the files in
+        flight are held, so trees of any size need constant memory. The progress total is
+        unknown until the scan is done. Orders other than 'walk' rank the whole tree and only
+        start converting once it is scanned.
+
+        Closing the generator early stops the batch after the conversions in flight and the files
+        already read ahead.
+
+        :param dir_of_interest: the directory or URL to search
+        :param recursive: search subdirectories
+        :return: a generator of the finished, skipped or failed event of every file
+        """
+        tracker = None
+        if self.progress_callback:
+            tracker = ProgressTracker(self.progress_callback, None, None, self.progress_rate)
+        stopped = threading.Event()
+
+        def scan():
+            files_total = bytes_total = 0
+            for root, entry in scan_tree(dir_of_interest, recursive, self.file_filter, self.source_pattern,
+                                         self.scan_threads, True, self.one_device, self.follow_symlinks):
+                if stopped.is_set():
+                    return
+                files_total += 1
+                if tracker:
+                    bytes_total += entry.stat().st_size
+                yield root, entry
+            if tracker:
+                tracker.set_totals(files_total, bytes_total)
+
+        entries = scan()
+        if self.order != 'walk':
+            entries = prioritize([(entry.path, entry.stat(), (root, entry)) for root, entry in entries], self.order)
+        jobs, entries = self._balance_stream(entries, lambda item: item[1].path)
+        plan = self._tree_plan(dir_of_interest, entries)
+
+        # Bounded, so the batch waits for a consumer that falls behind instead of piling up results
+        results = queue.Queue(maxsize=2 * jobs)
+        finished = object()
+        errors = []
+
+        def on_result(event: ProgressEvent):
+            if not stopped.is_set():
+                results.put(event)
+
+        def run():
             try:
-                if "exif" in image.info:
-                    exif_dict = piexif.load(image.info["exif"])
-            except:
-                # If loading fails, use our default structure
-                pass
+                self._run_batch(plan, None, None, jobs, _ConvertedCount(), tracker, on_result)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                results.put(finished)
+
+        worker = threading.Thread(target=run, name="heic-tree", daemon=True)
+        worker.start()
+        try:
+            while True:
+                event = results.get()
+                if event is finished:
+                    break
+                yield event
+        finally:
+            if worker.is_alive():
+                stopped.set()
+                # Unblock the batch, which may be waiting for room in the queue
+                while results.get() is not finished:
+                    pass
+            worker.join()
+        if errors:
+            raise errors[0]
+
+    def _tree_plan(self, dir_of_interest: str, entries: Iterable[Tuple[str, os.DirEntry]]) -> Iterator[Tuple[str, str]]:
+        """
+        Plan the conversions of scanned (root, entry) pairs of the directory of interest
+
+        :return: a generator of (source, target) pairs
+        """
+        source_storage = get_storage(dir_of_interest)
+        dir_of_interest = source_storage.normpath(dir_of_interest)
+        target = self.target if self.target is not None else dir_of_interest
+        target_storage = get_storage(target)
+
+        for root, entry in entries:
+            if self.output_layout:
+                yield entry.path, self._layout_target(target, entry.path, entry.stat())
+                continue
+            dir_prefix = ''
+            if self.preserve_folder_structure:
+                dir_prefix = source_storage.relpath(root, dir_of_interest)
+                if dir_prefix != '.':
+                    self._ensure_dir(target_storage, target_storage.join(target, dir_prefix))
+                else:
+                    dir_prefix = ''
+
+            target_filename = os.path.splitext(entry.name)[0] + self.target_extension
+            if dir_prefix:
+                target_filename = target_storage.join(dir_prefix, target_filename)
+            yield entry.path, target_storage.join(target, target_filename)
+
+    def _balance_threads(self, sources: List[str], files_total: Optional[int]) -> int:
+        """
+        Apply the 'auto' decode thread policy to a batch
+
+        :param sources: the sources of the batch, or a sample of them
+        :param files_total: number of files in the batch, None if unknown
+        :return: the number of parallel jobs to use for the batch
+        """
+        if self.decode_threads != 'auto' or not sources:
+            return self.jobs
+
+        import pillow_heif
+
+        jobs, threads = balance_decode_threads(self.jobs, files_total, _sample_pixel_counts(sources))
+        pillow_heif.options.DECODE_THREADS = threads
+        if self.verbose:
+            print(f'Converting {jobs} images in parallel with {threads} decode threads each')
+        return jobs
+
+    def _balance_stream(self, items: Iterator, source_of=None) -> Tuple[int, Iterator]:
+        """
+        Apply the 'auto' decode thread policy to a stream of files from the headers of its first files
+
+        :param items: the items of the stream
+        :param source_of: gets the source path of an item, the items are the paths if None
+        :return: the number of parallel jobs, and an iterator over all items of the stream
+        """
+        if self.decode_threads != 'auto':
+            return self.jobs, items
+        head = list(islice(items, DECODE_THREADS_SAMPLE))
+        sources = [source_of(item) for item in head] if source_of else head
+        # Only a stream that ended within the sample has a known length to limit the jobs
+        files_total = len(head) if len(head) < DECODE_THREADS_SAMPLE else None
+        return self._balance_threads(sources, files_total), chain(head, items)
+
+    def _target_for(self, source_file: str) -> str:
+        """
+        Get the default target of a source file: same name with the target extension in the target directory
+        """
+        if self.output_layout:
+            target = self.target
+            if target is None:
+                target = get_storage(source_file).dirname(source_file)
+            return self._layout_target(target, source_file)
+        target_filename = os.path.basename(source_file).split('.')[0] + self.target_extension
+        if self.target is None:
+            source_storage = get_storage(source_file)
+            return source_storage.join(source_storage.dirname(source_file), target_filename)
+        return get_storage(self.target).join(self.target, target_filename)
+
+    def _layout_target(self, target: str, source_file: str, stat=None) -> str:
+        """
+        Get the target of a source file below target by the output layout
+
+        The capture time is read from the Exif item found via the HEIF header, without decoding
+        the image; files without one are placed by their modification time.
+        """
+        source_storage = get_storage(source_file)
+        try:
+            with source_storage.open(source_file, "rb") as f:
+                taken = read_header(f).taken
+        except Exception:
+            taken = None
+        if taken is None:
+            taken = (stat or source_storage.stat(source_file)).st_mtime
+        name = os.path.splitext(os.path.basename(source_file))[0]
+        relative = render_output_layout(self.output_layout, name, datetime.fromtimestamp(taken))
+        return get_storage(target).join(target, *relative.split("/"))
+
+    def _ensure_dir(self, storage: Storage, directory: str) -> None:
+        """
+        Create a target directory unless this converter created or found it before
+        """
+        with self._lock:
+            if directory in self._created_dirs:
+                return
+        if not storage.exists(directory):
+            if self.verbose:
+                print(f'Creating folder {directory}')
+            storage.makedirs(directory)
+        with self._lock:
+            self._created_dirs.add(directory)
+
+    def _save_options(self, quality: Optional[int] = None, icc_profile: Optional[bytes] = None) -> Tuple[str, dict]:
+        """
+        Get the Pillow format and the encoder options of the targets
+
+        :param quality: overrides the quality of the converter
+        :param icc_profile: ICC profile embedded into the target
+        """
+        quality = quality or self.quality
+        if self.output_format == 'heic':
+            options = {"quality": quality, "enc_params": {"preset": ENCODER_SPEEDS[self.encoder_speed]}}
         else:
-            # No EXIF data exists, use current datetime
-            date = datetime.now()
-            if verbose:
-                print(f'No EXIF data found for {source_file}, creating dummy EXIF data')
+            options = {"quality": quality}
+        if icc_profile:
+            options["icc_profile"] = icc_profile
+        return "HEIF" if self.output_format == 'heic' else "jpeg", options
 
-        # Update exif data with orientation and datetime
-        exif_dict["0th"][piexif.ImageIFD.DateTime] = date.strftime("%Y:%m:%d %H:%M:%S")
-        exif_dict["0th"][piexif.ImageIFD.Orientation] = 1
+    def _encode_buffer(self, name: str = "encode_buffer", transient: bool = False) -> io.BytesIO:
+        """
+        Get one of this worker's scratch buffers for encoding, rewound but keeping its capacity
 
-        # Add dummy author data to ensure EXIF is not empty
-        exif_dict["0th"][piexif.ImageIFD.Artist] = "unknown"
+        :param transient: get a new buffer instead, so a large image does not leave a worker
+                          holding its size for the rest of the run
+        """
+        if transient:
+            return io.BytesIO()
+        buffer = getattr(self._scratch, name, None)
+        if buffer is None:
+            buffer = io.BytesIO()
+            setattr(self._scratch, name, buffer)
+        buffer.seek(0)
+        return buffer
 
-        # Ensure the Exif IFD exists and add a dummy entry if needed
-        if not exif_dict.get("Exif"):
-            exif_dict["Exif"] = {}
+    def _encode_within_limit(
+            self,
+            image: "Image.Image",
+            exif_bytes: bytes,
+            source_file: str,
+            transient: bool = False,
+            icc_profile: Optional[bytes] = None
+    ) -> Tuple[io.BytesIO, int]:
+        """
+        Encode at the highest quality up to the converter's whose output fits max_bytes
 
-        exif_bytes = piexif.dump(exif_dict)
+        The search starts at the median quality of the recent files and first tries its
+        neighbour, so files like the earlier ones take one or two encodes; otherwise it
+        bisects. The attempts alternate between two scratch buffers, so the best one is
+        never encoded twice.
 
-        # Save image as jpeg
-        image.save(target_file, "jpeg", exif=exif_bytes, quality=quality)
-        if verbose:
-            print(f'Converted image: {source_file} -> {target_file}')
-        if remove:
-            os.remove(source_file)
-            if verbose:
-                print(f'Removed original: {source_file}')
+        :param transient: encode into new buffers instead of the worker's scratch buffers
+        :param icc_profile: ICC profile embedded into the target
+        :return: the buffer holding the encoded image, and its size
+        :raises ValueError: if even quality 1 exceeds the limit
+        """
+        with self._lock:
+            history = sorted(self._quality_history)
+        quality = min(history[len(history) // 2], self.quality) if history else self.quality
+        low, high = 1, self.quality
+        best = None
+        spare = self._encode_buffer("encode_buffer", transient)
+        other = self._encode_buffer("spare_encode_buffer", transient)
+        attempts = 0
+        while low <= high:
+            save_format, save_options = self._save_options(quality, icc_profile)
+            spare.seek(0)
+            image.save(spare, save_format, exif=exif_bytes, **save_options)
+            size = spare.tell()
+            attempts += 1
+            if size <= self.max_bytes:
+                best = (spare, size, quality)
+                spare, other = other, spare
+                low = quality + 1
+            else:
+                high = quality - 1
+            if attempts == 1:
+                quality = low if best else high
+            else:
+                quality = (low + high + 1) // 2
 
-        # Report success if callback provided
-        if progress_callback:
-            progress_callback(f"Successfully converted {os.path.basename(source_file)}")
+        if best is None:
+            raise ValueError(f"cannot encode below {self.max_bytes} bytes even at quality 1")
+        buffer, size, quality = best
+        with self._lock:
+            self._quality_history.append(quality)
+        if self.verbose:
+            print(f'Encoded {source_file} at quality {quality} into {size} bytes, {attempts} attempts')
+        return buffer, size
 
-        return True
+    @staticmethod
+    def _audit(
+            image: "Image.Image",
+            target_file: str,
+            target_storage: Storage,
+            buffer: Optional[io.BytesIO],
+            output_size: Optional[int]
+    ) -> dict:
+        """
+        Decode a written target again and compare it with the image it was encoded from
+
+        :param image: the decoded source as it was encoded
+        :param target_file: the target file or URL
+        :param target_storage: the storage serving the target
+        :param buffer: the buffer the target was encoded into, if it was
+        :param output_size: the size of the encoded target in the buffer
+        :return: the psnr and ssim of the target, nothing if it could not be compared
+        """
+        import numpy as np
+        from PIL import Image
+        from audit import psnr, ssim
+
+        try:
+            if buffer is not None:
+                with buffer.getbuffer() as view:
+                    encoded = io.BytesIO(bytes(view[:output_size]))
+            else:
+                encoded = io.BytesIO(target_storage.read_bytes(target_file))
+            with Image.open(encoded) as written:
+                result = np.asarray(written.convert("RGB"))
+            reference = np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+            return {"psnr": round(psnr(reference, result), 3), "ssim": round(ssim(reference, result), 5)}
+        except Exception as e:
+            print(f"Unable to audit {target_file}: {e}")
+            return {}
 
-    except UnidentifiedImageError as e:
-        print(f"{source_file} is not a valid image: {e}")
-    except Exception as e:
-        print(f"Unable to convert {source_file}: {e}")
+    def _claim_target(self, target_file: str) -> str:
+        """
+        Reserve the target of a conversion that is about to be dispatched
 
-    # Report failure if callback provided
-    if progress_callback:
-        progress_callback(f"Failed to convert {os.path.basename(source_file)}")
+        Unique names take the targets of conversions still in flight into account, so
+        parallel workers never pick the same name.
+        """
+        with self._lock:
+            if self.generate_unique and not self.overwrite:
+                unique_file = generate_unique_filename(target_file, self._claimed)
+                if unique_file != target_file and self.verbose:
+                    print(f'Generated unique name: {os.path.basename(unique_file)}')
+                target_file = unique_file
+            self._claimed.add(target_file)
+            return target_file
+
+    def _release_target(self, target_file: str) -> None:
+        with self._lock:
+            self._claimed.discard(target_file)
+
+    def _read_source(self, source_file: str) -> bytes:
+        """
+        Read a whole source, within the read bandwidth limit if one is set
+        """
+        storage = get_storage(source_file)
+        if self._read_bucket:
+            with storage.open(source_file, "rb") as f:
+                return read_throttled(f, self._read_bucket)
+        return storage.read_bytes(source_file)
+
+    def _wait_for_load(self) -> None:
+        """
+        Hold back the next dispatch while the system is busy, if a maximum load is set
+        """
+        if self._load_governor:
+            self._load_governor.wait()
+
+    def _run_batch(
+            self,
+            plan: Iterable[Tuple[str, str]],
+            files_total: Optional[int],
+            bytes_total: Optional[int],
+            jobs: int,
+            success_files: Optional[List[str]] = None,
+            tracker: Optional[ProgressTracker] = None,
+            on_result: Optional[ProgressCallback] = None
+    ) -> List[str]:
+        """
+        Convert planned (source, target) pairs, in parallel if there are several jobs
+
+        :param plan: the conversions to run
+        :param files_total: number of planned conversions if known, for progress reporting
+        :param bytes_total: size of all sources if known, for progress reporting
+        :param jobs: number of conversions to run in parallel
+        :param success_files: collects the converted targets, a new list by default
+        :param tracker: reports the batch progress, created from the progress callback by default
+        :param on_result: receives the finished, skipped or failed event of every file
+        :return: success_files with the target paths of the successfully converted files
+        """
+        if tracker is None and self.progress_callback:
+            tracker = ProgressTracker(self.progress_callback, files_total, bytes_total, self.progress_rate)
+        tuner = None
+        if self.autotune and jobs > 1:
+            tuner = ConcurrencyTuner(jobs, verbose=self.verbose)
+        callback = tracker
+        if on_result or tuner:
+            def callback(event: ProgressEvent):
+                if tracker:
+                    tracker(event)
+                if event.kind is not ProgressKind.STARTED and on_result:
+                    on_result(event)
+                # Skipped files would make the throughput look better than it is
+                if event.kind in (ProgressKind.FINISHED, ProgressKind.FAILED) and tuner:
+                    tuner.record(event.bytes)
+        # Directories may have been removed since the last batch
+        with self._lock:
+            self._created_dirs.clear()
+        if self.audit_sample:
+            from audit import AuditSampler
+            self._auditor = AuditSampler(self.audit_sample)
+
+        prefetcher = Prefetcher(self.prefetch, self.prefetch_depth, self.prefetch_budget, self._read_source)
+        prefetched = prefetcher.iterate(plan)
+
+        if success_files is None:
+            success_files = []
+        try:
+            if jobs == 1:
+                for source_file, target_file, source_data in prefetched:
+                    if self.cancelled:
+                        break
+                    self._wait_for_load()
+                    target_file = self._claim_target(target_file)
+                    try:
+                        if self.convert_file(source_file, target_file, source_data, callback):
+                            success_files.append(target_file)
+                    finally:
+                        self._release_target(target_file)
+            else:
+                self._run_parallel(prefetched, callback, jobs, success_files, tuner)
+        finally:
+            prefetched.close()
+            if tracker:
+                tracker.flush()
+            if tuner:
+                tuner.finish()
+                self.tuned_jobs = tuner.best_limit
+
+        self.prefetch_stats = prefetcher.summary()
+        if self.report:
+            self.report.add_summary(self.prefetch_stats)
+        if self._auditor is not None:
+            self.audit_stats = self._auditor.summary()
+            self._auditor = None
+            if self.report:
+                self.report.add_summary(self.audit_stats)
+        if self.verbose and prefetcher.hit_rate is not None:
+            print(f'Prefetch hit rate: {prefetcher.hit_rate:.0%} of {prefetcher.hits + prefetcher.misses} files')
+
+        return success_files
+
+    def _run_parallel(
+            self,
+            plan: Iterable[Tuple[str, str, Optional[bytes]]],
+            callback: Optional[ProgressCallback],
+            jobs: int,
+            success_files: List[str],
+            tuner: Optional[ConcurrencyTuner] = None
+    ) -> None:
+        """
+        Feed the worker pool from the prefetched plan, keeping at most one conversion per worker in flight
+
+        With a tuner, only as many conversions as its current limit are kept in flight.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="heic-converter")
+
+        in_flight = {}
+
+        def collect(futures):
+            for future in futures:
+                target_file = in_flight.pop(future)
+                self._release_target(target_file)
+                if future.result():
+                    success_files.append(target_file)
+
+        for source_file, target_file, source_data in plan:
+            # Without unique names, a second conversion to the same target waits for the first one
+            while in_flight and (len(in_flight) >= (tuner.limit if tuner else jobs) or
+                                 (not self.generate_unique and target_file in self._claimed)):
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            if self.cancelled:
+                break
+            self._wait_for_load()
+            target_file = self._claim_target(target_file)
+            future = self._executor.submit(self.convert_file, source_file, target_file, source_data, callback)
+            in_flight[future] = target_file
+
+        collect(wait(in_flight).done)
+
+
+def convert_heic_file(
+        source_file: str,
+        target_file: str,
+        overwrite: bool,
+        remove: bool,
+        quality: int,
+        progress_callback: Optional[ProgressCallback] = None,
+        verbose: bool = False,
+        source_data: Optional[bytes] = None,
+        max_bytes: Optional[int] = None,
+        color: str = 'none'
+) -> bool:
+    """
+    Convert a single heic file to jpeg
 
-    return False
+    :param source_file: the source file or URL
+    :param target_file: the target file or URL
+    :param overwrite: overwrite existing jpeg files
+    :param remove: remove converted heic files
+    :param quality: quality of jpeg files (1-100)
+    :param progress_callback: optional callback receiving a started event and then a finished,
+                              skipped or failed event
+    :param verbose: enable more detailed output
+    :param source_data: content of the source file if it was already read ahead
+    :param max_bytes: maximum size of the jpeg file, the quality is lowered as needed to stay below it
+    :param color: 'srgb' to convert the colours of an image with an ICC profile to sRGB, 'embed' to
+                  keep its profile in the jpeg file
+    :return: True if successful, False otherwise
+    """
+    # A single file has nothing to reuse buffers for
+    with Converter(overwrite=overwrite, remove=remove, quality=quality, verbose=verbose,
+                   progress_callback=progress_callback, max_bytes=max_bytes, color=color,
+                   pool_budget=0) as converter:
+        return converter.convert_file(source_file, target_file, source_data)
 
 
 def convert_multiple_heic_files(
@@ -189,9 +1910,12 @@ def convert_multiple_heic_files(
         remove: bool,
         quality: int,
         target: str,
-        progress_callback: Optional[Callable[[str], None]] = None,
+        progress_callback: Optional[ProgressCallback] = None,
         generate_unique: bool = False,
-        verbose: bool = False
+        verbose: bool = False,
+        progress_rate: float = 10.0,
+        jobs: Union[int, str] = 1,
+        decode_threads: Union[int, str, None] = None
 ) -> List[str]:
     """
     Convert a list of HEIC files to JPEG
@@ -201,44 +1925,22 @@ def convert_multiple_heic_files(
     :param remove: Remove converted HEIC files
     :param quality: Quality of JPEG files
     :param target: Target directory
-    :param progress_callback: Optional callback for progress updates
+    :param progress_callback: Optional callback for progress events with batch totals and throughput
     :param generate_unique: Generate unique filenames when target exists
     :param verbose: Enable more detailed output
+    :param progress_rate: Maximum number of progress events per second
+    :param jobs: Number of files converted in parallel, 'auto' to tune it by the throughput
+    :param decode_threads: libheif decode threads per image, 'auto' to balance them against jobs
     
     :return: List of successfully converted files
     """
-    success_files = []
-
     if verbose:
         print(f'Processing {len(file_list)} files')
 
-    for source_file in file_list:
-        if not os.path.isfile(source_file) or not source_file.lower().endswith('.heic'):
-            if verbose:
-                print(f'Skipping invalid file: {source_file}')
-            continue
-
-        target_filename = os.path.basename(source_file).split('.')[0] + ".jpg"
-        target_file = os.path.join(target, target_filename)
-
-        # Generate unique filename if requested and not overwriting
-        if generate_unique and not overwrite and os.path.exists(target_file):
-            target_file = generate_unique_filename(target_file)
-            if verbose:
-                print(f'Generated unique name: {os.path.basename(target_file)}')
-
-        if convert_heic_file(
-                source_file,
-                target_file,
-                overwrite,
-                remove,
-                quality,
-                progress_callback,
-                verbose
-        ):
-            success_files.append(os.path.basename(target_file))
-
-    return success_files
+    with Converter(target, overwrite, remove, quality, generate_unique=generate_unique, verbose=verbose,
+                   progress_callback=progress_callback, progress_rate=progress_rate, jobs=jobs,
+                   decode_threads=decode_threads) as converter:
+        return [os.path.basename(target_file) for target_file in converter.convert_files(file_list)]
 
 
 def convert_heic_to_jpeg(
@@ -249,55 +1951,76 @@ def convert_heic_to_jpeg(
         quality: int,
         target: str,
         preserve_folder_structure: bool = True,
-        progress_callback: Optional[Callable[[str], None]] = None,
+        progress_callback: Optional[ProgressCallback] = None,
         generate_unique: bool = False,
         verbose: bool = False,
+        progress_rate: float = 10.0,
+        jobs: Union[int, str] = 1,
+        decode_threads: Union[int, str, None] = None,
+        verify: bool = False
 ) -> List[str]:
     """
     Convert all heic files in the directory of interest to jpeg
 
-    :param dir_of_interest: The directory to search
+    :param dir_of_interest: The directory or URL to search
     :param recursive: search subdirectories
     :param overwrite: overwrite existing jpeg files
     :param remove: remove converted heic files
     :param quality: quality of jpeg files
-    :param target: the target directory
-    :param progress_callback: Optional callback for progress updates
+    :param target: the target directory or URL
+    :param progress_callback: Optional callback for progress events with batch totals and throughput
     :param generate_unique: Generate unique filenames when target exists
     :param verbose: Enable more detailed output
+    :param progress_rate: Maximum number of progress events per second
+    :param jobs: Number of files converted in parallel, 'auto' to tune it by the throughput
+    :param decode_threads: libheif decode threads per image, 'auto' to balance them against jobs
+    :param verify: only convert the files whose jpeg file is missing or broken
     
     :return: a list of successfully converted files
     """
-    heic_files = get_file_list(dir_of_interest, recursive)
-
-    # Extract files of interest
-    success_files = []
-
-    if verbose:
-        print(f'Found {len(heic_files)} files to convert in folder {dir_of_interest}')
+    with Converter(target, overwrite, remove, quality, preserve_folder_structure, generate_unique, verbose,
+                   progress_callback, progress_rate, jobs, decode_threads) as converter:
+        convert = converter.verify_tree if verify else converter.convert_tree
+        return [os.path.basename(target_file) for target_file in convert(dir_of_interest, recursive)]
 
-    # Convert files to jpg while keeping the timestamp
-    for root, filename in tqdm(heic_files):
 
-        dir_prefix = ''
-        if preserve_folder_structure:
-            dir_prefix = os.path.relpath(root, dir_of_interest)
-            if dir_prefix != '.':
-                os.makedirs(os.path.join(target, dir_prefix), exist_ok=True)
-            else:
-                dir_prefix = ''
-
-        target_filename = os.path.join(dir_prefix, os.path.splitext(filename)[0] + ".jpg")
-        target_file = os.path.join(target, target_filename)
-        source_file = os.path.join(root, filename)
+def iter_convert(
+        dir_of_interest: str,
+        recursive: bool = True,
+        overwrite: bool = False,
+        remove: bool = False,
+        quality: int = 95,
+        target: Optional[str] = None,
+        preserve_folder_structure: bool = True,
+        progress_callback: Optional[ProgressCallback] = None,
+        generate_unique: bool = False,
+        verbose: bool = False,
+        progress_rate: float = 10.0,
+        jobs: Union[int, str] = 1,
+        decode_threads: Union[int, str, None] = None
+) -> Iterator[ProgressEvent]:
+    """
+    Convert all heic files in the directory of interest to jpeg while it is still being scanned
 
-        # Generate unique filename if requested and not overwriting
-        if generate_unique and not overwrite and os.path.exists(target_file):
-            target_file = generate_unique_filename(target_file)
-            if verbose:
-                print(f'Generated unique name: {os.path.basename(target_file)}')
+    Unlike convert_heic_to_jpeg, conversions start with the first file found and the results
+    are yielded as the files finish, so trees of any size need constant memory.
 
-        if convert_heic_file(source_file, target_file, overwrite, remove, quality, progress_callback, verbose):
-            success_files.append(os.path.basename(target_file))
+    :param dir_of_interest: The directory or URL to search
+    :param recursive: search subdirectories
+    :param overwrite: overwrite existing jpeg files
+    :param remove: remove converted heic files
+    :param quality: quality of jpeg files
+    :param target: the target directory or URL, the directory of interest by default
+    :param preserve_folder_structure: recreate the subdirectories in the target directory
+    :param progress_callback: Optional callback for progress events, the total is known once the scan is done
+    :param generate_unique: Generate unique filenames when target exists
+    :param verbose: Enable more detailed output
+    :param progress_rate: Maximum number of progress events per second
+    :param jobs: Number of files converted in parallel, 'auto' to tune it by the throughput
+    :param decode_threads: libheif decode threads per image, 'auto' to balance them against jobs
 
-    return success_files
+    :return: a generator of the finished, skipped or failed event of every file
+    """
+    with Converter(target, overwrite, remove, quality, preserve_folder_structure, generate_unique, verbose,
+                   progress_callback, progress_rate, jobs, decode_threads) as converter:
+        yield from converter.iter_tree(dir_of_interest, recursive)
@@ -1,14 +1,104 @@
 import os
 import argparse
 import re
-from typing import List, Optional
+import sys
+from datetime import datetime, timedelta
+from typing import Optional
 
 from converter import (
-    convert_heic_to_jpeg,
-    convert_heic_file,
-    convert_multiple_heic_files,
-    generate_unique_filename
+    BUFFER_POOL_BUDGET,
+    DEFAULT_EXCLUDES,
+    DITHER_MODES,
+    ENCODER_SPEEDS,
+    HEIC_QUALITY_PRESETS,
+    LARGE_IMAGE_PIXELS,
+    OUTPUT_FORMATS,
+    TONE_MAP_CURVES,
+    Converter,
+    FileFilter,
+    generate_unique_filename,
+    iter_path_list,
+    render_output_layout
 )
+from color import COLOR_MODES
+from prefetch import PREFETCH_BUDGET, PREFETCH_DEPTH, PREFETCH_MODES
+from progress import ProgressEvent, ProgressKind
+from report import ReportWriter
+from schedule import ORDER_POLICIES
+from storage import get_storage, is_url
+from throttle import apply_cpu_limits, parse_cpu_list
+
+
+def decode_threads_type(value: str):
+    """
+    Parse the --decode-threads value, a positive number or 'auto'
+    """
+    if value == 'auto':
+        return value
+    try:
+        threads = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number or 'auto', got '{value}'")
+    if threads < 1:
+        raise argparse.ArgumentTypeError('the number of decode threads must be at least 1')
+    return threads
+
+
+def jobs_type(value: str):
+    """
+    Parse the --jobs value, a positive number or 'auto'
+    """
+    if value == 'auto':
+        return value
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number or 'auto', got '{value}'")
+    if jobs < 1:
+        raise argparse.ArgumentTypeError('the number of jobs must be at least 1')
+    return jobs
+
+
+def size_type(value: str) -> int:
+    """
+    Parse a file size like 500k, 2M or 1G into bytes
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*', value, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(f"expected a size like 500k, 2M or 1G, got '{value}'")
+    factor = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[match.group(2).lower()]
+    return int(float(match.group(1)) * factor)
+
+
+def date_type(value: str) -> datetime:
+    """
+    Parse an ISO date or date and time, e.g. 2024-05-01 or 2024-05-01T12:00
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a date like 2024-05-01 or 2024-05-01T12:00, got '{value}'")
+
+
+def cpus_type(value: str):
+    """
+    Parse the --cpus value, a CPU list like 0-3,6 or a mask like 0xf
+    """
+    try:
+        return parse_cpu_list(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a CPU list like 0-3,6 or a mask like 0xf, got '{value}'")
+
+
+def layout_type(value: str) -> str:
+    """
+    Check an --output-layout template by filling it once
+    """
+    try:
+        render_output_layout(value, "name", datetime.now())
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
 
 
 def parse_args():
@@ -21,22 +111,164 @@ def parse_args():
 
     # Input selection options (mutually exclusive)
     input_group = parser.add_mutually_exclusive_group(required=True)
-    input_group.add_argument('--path', help='Path to directory or file to convert')
+    input_group.add_argument('--path', help='Path or URL (e.g. s3://bucket/photos) to directory or file to convert')
     input_group.add_argument('--files', nargs='+', help='List of specific HEIC files to convert')
+    input_group.add_argument('--files-from', metavar='PATH',
+                             help="Read the HEIC files to convert from this file, or from stdin with '-'; one path "
+                                  "per line or NUL separated like find -print0, converted while the list is read")
 
     # Conversion options
     parser.add_argument('-r', '--remove', help='Remove converted HEIC Files', action='store_true')
     parser.add_argument('-o', '--overwrite', help='Overwrite existing JPEG files', action='store_true')
     parser.add_argument('--not-recursive', help='Do not search subdirectories', action='store_true')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check the converted files of a directory without decoding them and only convert the '
+                             'files again whose target is missing or broken')
     parser.add_argument('--skip-prompt', help='Skip the prompt at the end', action='store_true')
-    parser.add_argument('-q', '--quality', help='Quality of the JPG Files, default: 95', type=int,
-                        default=95)
+    parser.add_argument('-q', '--quality', type=int,
+                        help='Quality of the JPG Files, default: 95, or that of --heic-preset with --to heic')
     parser.add_argument('-t', '--target',
-                        help='The target directory for the converted files')
+                        help='The target directory or URL for the converted files')
     parser.add_argument('--unique', help='Generate unique filenames when target exists', action='store_true')
     parser.add_argument('-v', '--verbose', help='Enable verbose output', action='store_true')
+    parser.add_argument('-j', '--jobs', type=jobs_type, default=1,
+                        help="Number of files converted in parallel, or 'auto' to find the fastest setting from the "
+                             "throughput of the first files, default: 1")
+    parser.add_argument('--decode-threads', type=decode_threads_type,
+                        help="libheif decode threads per image, a number or 'auto' to balance them against --jobs")
+    parser.add_argument('--tone-map', choices=TONE_MAP_CURVES,
+                        help='Tone map 10/12-bit HEIC files to 8 bit with this curve instead of truncating them')
+    parser.add_argument('--dither', choices=DITHER_MODES, default='ordered',
+                        help='Dithering used by --tone-map, default: ordered')
+    parser.add_argument('--color', choices=COLOR_MODES, default='none',
+                        help='Colour management of images with an ICC profile, like the Display P3 of iPhones: srgb '
+                             'converts the colours for the web, embed keeps the profile in the files, default: none')
+    parser.add_argument('--max-bytes', type=size_type, metavar='SIZE',
+                        help='Keep every converted file below this size, e.g. 2M, by lowering the quality as far as '
+                             'needed; --quality is the highest quality used')
+    parser.add_argument('--to', choices=OUTPUT_FORMATS, default='jpeg',
+                        help='Target format: jpeg converts HEIC files, heic re-encodes JPEG files to save space, '
+                             'default: jpeg')
+    parser.add_argument('--heic-preset', choices=HEIC_QUALITY_PRESETS, default='high',
+                        help='Quality of --to heic unless --quality is given: ' +
+                             ', '.join(f'{name} {quality}' for name, quality in HEIC_QUALITY_PRESETS.items()) +
+                             ', default: high')
+    parser.add_argument('--encoder-speed', choices=ENCODER_SPEEDS, default='medium',
+                        help='Speed of the HEIC encoder of --to heic, slower gives smaller files, default: medium')
+    parser.add_argument('--output-layout', type=layout_type, metavar='TEMPLATE',
+                        help='Place the converted files of a batch below the target directory by this template, '
+                             'filled from the EXIF capture date, e.g. {year}/{month}/{day}/{name}.jpg; fields: '
+                             '{year} {month} {day} {hour} {minute} {second} {name}')
+    parser.add_argument('--order', choices=ORDER_POLICIES, default='walk',
+                        help='Conversion order: largest-first keeps parallel jobs busy until the end, '
+                             'newest-first by capture date, walk as found, default: walk')
+
+    # Scan filters
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help='Only convert files whose name or relative path matches this glob, can be repeated')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help='Skip files and directories whose name or relative path matches this glob, '
+                             'can be repeated')
+    parser.add_argument('--no-default-excludes', action='store_true',
+                        help=f'Also scan the directories excluded by default: {", ".join(DEFAULT_EXCLUDES)}')
+    parser.add_argument('--min-size', type=size_type, help='Skip files smaller than this, e.g. 100k')
+    parser.add_argument('--max-size', type=size_type, help='Skip files larger than this, e.g. 50M')
+    parser.add_argument('--newer-than', type=date_type, metavar='DATE',
+                        help='Only convert files modified after this date, e.g. 2024-05-01')
+    parser.add_argument('--scan-threads', type=int, default=1, metavar='N',
+                        help='List this many directories at the same time, speeds up scanning network shares '
+                             'and object storage, default: 1')
+    parser.add_argument('--one-file-system', action='store_true',
+                        help='Do not scan directories on other filesystems, e.g. shares mounted below the path')
+    parser.add_argument('--follow-symlinks', action='store_true',
+                        help='Also scan symlinked directories, each one once and never in a loop; with --remove '
+                             'their originals are removed too')
+    # Resource limits
+    parser.add_argument('--nice', type=int, help='Lower the priority of the conversion by this niceness, e.g. 10')
+    parser.add_argument('--cpus', type=cpus_type,
+                        help='Run only on these CPUs, a list like 0-3,6 or an affinity mask like 0xf')
+    parser.add_argument('--max-read-mbps', type=float, metavar='MB_PER_S',
+                        help='Limit reading source files to this many MB per second')
+    parser.add_argument('--max-write-mbps', type=float, metavar='MB_PER_S',
+                        help='Limit writing JPEG files to this many MB per second')
+    parser.add_argument('--max-load', type=float,
+                        help='Pause starting conversions while the 1-minute load average is above this')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory-map local source files instead of reading them, saves a copy when they are '
+                             'cached; files on network mounts are still read')
+    parser.add_argument('--prefetch', choices=PREFETCH_MODES, default='auto',
+                        help='Fetch the next files while converting: read them into memory, or fadvise to have the '
+                             'kernel cache them; auto reads ahead from object storage and network mounts, '
+                             'default: auto')
+    parser.add_argument('--prefetch-depth', type=int, default=PREFETCH_DEPTH,
+                        help=f'Number of files fetched ahead, default: {PREFETCH_DEPTH}')
+    parser.add_argument('--prefetch-budget', type=size_type, default=PREFETCH_BUDGET,
+                        help=f'Maximum size of the files held in memory by --prefetch, default: '
+                             f'{PREFETCH_BUDGET // 2 ** 20}M')
+    parser.add_argument('--buffer-pool', type=size_type, default=BUFFER_POOL_BUDGET, metavar='SIZE',
+                        help=f'Memory kept for reusing decode buffers between images of the same size, 0 to '
+                             f'turn it off, default: {BUFFER_POOL_BUDGET // 2 ** 20}M')
+    parser.add_argument('--large-image-mp', type=float, default=LARGE_IMAGE_PIXELS / 1e6, metavar='MP',
+                        help=f'Convert images above this many megapixels one at a time, 0 to treat all images '
+                             f'alike, default: {LARGE_IMAGE_PIXELS / 1e6:.0f}')
+    parser.add_argument('--report', metavar='PATH',
+                        help='Write a JSON Lines report with one record per file and a summary record at the end')
+    parser.add_argument('--audit-sample', type=int, metavar='N',
+                        help='Decode N randomly picked converted files again and compare them with their source by '
+                             'PSNR and SSIM, recorded in the --report and shown at the end')
+    parser.add_argument('--progress-rate', help='Maximum progress updates per second, default: 10', type=float,
+                        default=10.0)
+
+    args = parser.parse_args()
+    if args.files_from and args.order != 'walk':
+        parser.error('--order needs the complete list of files and cannot be used with --files-from')
+    if args.verify and not args.path:
+        parser.error('--verify needs a directory given with --path')
+    if args.audit_sample is not None and args.audit_sample < 1:
+        parser.error('--audit-sample needs at least 1 file')
+    return args
+
+
+def create_progress_bar():
+    """
+    Create a tqdm progress bar that is driven by the converter's progress events
+
+    :return: the progress bar and the callback updating it
+    """
+    from tqdm.auto import tqdm
+
+    bar = tqdm(unit='file')
 
-    return parser.parse_args()
+    def on_progress(event: ProgressEvent):
+        if event.files_total is not None and bar.total != event.files_total:
+            bar.total = event.files_total
+        postfix = {'MB/s': f'{event.megabytes_per_second:.1f}', 'failed': event.files_failed}
+        if event.eta is not None:
+            postfix['eta'] = str(timedelta(seconds=round(event.eta)))
+        bar.set_postfix(postfix, refresh=False)
+        bar.update(event.files_done - bar.n)
+
+    return bar, on_progress
+
+
+def print_summary(converted: int, converter: Converter):
+    """
+    Print the outcome of a batch, with the prefetch hit rate if files were read ahead and the audit results
+    """
+    print(f'\nSuccessfully converted {converted} files')
+    if converter.output_format == 'heic' and converter.input_bytes:
+        saved = converter.input_bytes - converter.output_bytes
+        print(f'Saved {saved / 1e6:.1f} MB, {saved / converter.input_bytes:.0%} of '
+              f'{converter.input_bytes / 1e6:.1f} MB of JPEG files')
+    stats = converter.prefetch_stats
+    if stats and stats['prefetch_hit_rate'] is not None:
+        fetched = stats['prefetch_hits'] + stats['prefetch_misses']
+        print(f'Prefetched {fetched} files, {stats["prefetch_hit_rate"]:.0%} were ready in time')
+    stats = converter.audit_stats
+    if stats and stats['audited']:
+        print(f'Audited {stats["audited"]} files: PSNR {stats["psnr_mean"]:.2f} dB on average, '
+              f'{stats["psnr_min"]:.2f} dB at worst, SSIM {stats["ssim_mean"]:.4f} on average, '
+              f'{stats["ssim_min"]:.4f} at worst')
 
 
 def main():
@@ -44,66 +276,132 @@ def main():
     args = parse_args()
     current_path = os.path.abspath(os.getcwd())
 
+    # Limit the CPU usage before the worker threads are started, they inherit the limits
+    apply_cpu_limits(args.nice, args.cpus)
+
     # Validate quality value
+    if args.quality is None:
+        args.quality = HEIC_QUALITY_PRESETS[args.heic_preset] if args.to == 'heic' else 95
     quality = max(1, min(100, args.quality))
 
     # Process file or directory path
     if args.path:
-        path = os.path.abspath(args.path)
+        path = args.path if is_url(args.path) else os.path.abspath(args.path)
+        source_storage = get_storage(path)
 
         # Determine target directory
         if args.target:
             target = args.target
-        elif os.path.isdir(path):
+        elif source_storage.isdir(path):
             target = path
         else:
-            target = os.path.dirname(path)
+            target = source_storage.dirname(path)
     else:
-        # If using --files option
+        # If using the --files or --files-from option
         path = None
+        source_storage = None
         target = args.target or current_path
 
     # Ensure target directory exists
-    if not os.path.exists(target):
-        os.makedirs(target)
+    target_storage = get_storage(target)
+    if not target_storage.exists(target):
+        target_storage.makedirs(target)
         print(f"Created target directory: {target}")
 
+    excludes = list(args.exclude or [])
+    if not args.no_default_excludes:
+        excludes.extend(DEFAULT_EXCLUDES)
+    file_filter = FileFilter(args.include, excludes, args.min_size, args.max_size, args.newer_than)
+
+    converter = Converter(
+        target,
+        args.overwrite,
+        args.remove,
+        quality,
+        generate_unique=args.unique,
+        verbose=args.verbose,
+        progress_rate=args.progress_rate,
+        jobs=args.jobs,
+        decode_threads=args.decode_threads,
+        tone_map=args.tone_map,
+        dither=args.dither,
+        file_filter=file_filter,
+        max_read_mbps=args.max_read_mbps,
+        max_write_mbps=args.max_write_mbps,
+        max_load=args.max_load,
+        order=args.order,
+        report=ReportWriter(args.report) if args.report else None,
+        mmap_input=args.mmap,
+        prefetch=args.prefetch,
+        prefetch_depth=args.prefetch_depth,
+        prefetch_budget=args.prefetch_budget,
+        output_layout=args.output_layout,
+        pool_budget=args.buffer_pool,
+        output_format=args.to,
+        encoder_speed=args.encoder_speed,
+        max_bytes=args.max_bytes,
+        scan_threads=args.scan_threads,
+        one_device=args.one_file_system,
+        follow_symlinks=args.follow_symlinks,
+        large_pixels=int(args.large_image_mp * 1e6) or None,
+        color=args.color,
+        audit_sample=args.audit_sample
+    )
+
     # Handle conversion based on input type
-    if args.files:
-        print(f'Converting {len(args.files)} specified HEIC files to {target}')
-        converted = convert_multiple_heic_files(
-            args.files,
-            args.overwrite,
-            args.remove,
-            quality,
-            target,
-            generate_unique=args.unique,
-            verbose=args.verbose
-        )
-        print(f'\nSuccessfully converted {len(converted)} files')
-    elif os.path.isdir(path):
-        print(f'Converting HEIC files in directory {path} to {target}')
-        converted = convert_heic_to_jpeg(
-            path,
-            not args.not_recursive,
-            args.overwrite,
-            args.remove,
-            quality,
-            target,
-            generate_unique=args.unique,
-            verbose=args.verbose
-        )
-        print(f'\nSuccessfully converted {len(converted)} files')
-    elif os.path.isfile(path):
-        t_file = os.path.join(target, os.path.basename(path).split('.')[0]) + ".jpg"
-        if args.unique and os.path.exists(t_file) and not args.overwrite:
-            t_file = generate_unique_filename(t_file)
-
-        print(f'Converting HEIC file {path} to {t_file}')
-        success = convert_heic_file(path, t_file, args.overwrite, args.remove, quality, verbose=args.verbose)
-        print(f'\nSuccessfully converted file: {"Yes" if success else "No"}')
-    else:
-        print(f'Don\'t know what to do with {path}')
+    source_type = 'JPEG' if args.to == 'heic' else 'HEIC'
+    try:
+        with converter:
+            if args.files:
+                print(f'Converting {len(args.files)} specified {source_type} files to {target}')
+                bar, converter.progress_callback = create_progress_bar()
+                converted = converter.convert_files(args.files)
+                bar.close()
+                print_summary(len(converted), converter)
+            elif args.files_from:
+                print(f'Converting the {source_type} files listed in {args.files_from} to {target}')
+                bar, converter.progress_callback = create_progress_bar()
+                if args.files_from == '-':
+                    converted = converter.convert_stream(iter_path_list(sys.stdin.buffer))
+                else:
+                    with get_storage(args.files_from).open(args.files_from, 'rb') as f:
+                        converted = converter.convert_stream(iter_path_list(f))
+                bar.close()
+                print_summary(converted, converter)
+            elif args.verify and not source_storage.isdir(path):
+                print(f'--verify needs a directory, {path} is not one')
+            elif args.verify:
+                print(f'Verifying the converted {source_type} files of directory {path} in {target}')
+                bar, converter.progress_callback = create_progress_bar()
+                converted = converter.verify_tree(path, not args.not_recursive)
+                bar.close()
+                stats = converter.verify_stats
+                print(f'\nChecked {stats["verified"]} files: {stats["missing"]} missing, {stats["broken"]} broken')
+                print_summary(len(converted), converter)
+            elif source_storage.isdir(path):
+                print(f'Converting {source_type} files in directory {path} to {target}')
+                bar, converter.progress_callback = create_progress_bar()
+                # Streamed: the bar counts up without a total until the scan is done
+                converted = sum(result.kind is ProgressKind.FINISHED
+                                for result in converter.iter_tree(path, not args.not_recursive))
+                bar.close()
+                print_summary(converted, converter)
+            elif source_storage.isfile(path):
+                t_file = converter._target_for(path)
+                if args.unique and target_storage.exists(t_file) and not args.overwrite:
+                    t_file = generate_unique_filename(t_file)
+
+                print(f'Converting {source_type} file {path} to {t_file}')
+                success = converter.convert_file(path, t_file)
+                print(f'\nSuccessfully converted file: {"Yes" if success else "No"}')
+            else:
+                print(f'Don\'t know what to do with {path}')
+    finally:
+        if converter.report:
+            if converter.color_transforms:
+                converter.report.add_summary(converter.color_transforms.summary())
+            converter.report.close()
+            print(f'Report written to {args.report}')
 
     if not args.skip_prompt:
         input("Press Enter to continue...")
@@ -5,18 +5,15 @@ from tkinter import filedialog
 from tkinter import scrolledtext
 from tkinter import ttk
 import platform
-import io
 import sys
 import json
+import queue
 import subprocess
-from contextlib import redirect_stdout, redirect_stderr
+import threading
+from datetime import timedelta
 
-from converter import (
-    convert_heic_to_jpeg,
-    convert_heic_file,
-    convert_multiple_heic_files,
-    generate_unique_filename
-)
+from converter import HEIC_PATTERN, load_codecs
+from jobs import JOB_QUEUED, JOB_RUNNING, Job, JobQueue
 
 # Handle DPI awareness for Windows
 if platform.system() == "Windows":
@@ -58,32 +55,47 @@ en = {
     "opened_destination": "Opened destination folder: {path}",
     "error_opening_folder": "Error opening folder: {error}",
     "directory_selected": "Directory selected: {path}",
-    "multiple_directories": "Note: Multiple directories dropped. Using {path}.",
     "file_selected": "1 file selected: {filename}",
     "files_selected": "{count} files selected",
     "added_files": "Added {count} HEIC files for conversion.",
     "no_valid_files": "No valid HEIC files found in the dropped items.",
     "target_directory": "Target directory: {path}",
     "converting": "Converting...",
-    "conversion_settings": "Conversion settings:",
     "quality_percent": "- Quality: {quality}%",
     "remove_originals": "- Remove originals: {value}",
     "overwrite_existing_option": "- Overwrite existing: {value}",
     "generate_unique_filenames": "- Generate unique filenames: Yes",
     "search_subdirectories": "- Search subdirectories: {value}",
     "preserve_structure_option": "- Preserve structure: {value}",
-    "created_target_directory": "Created target directory: {path}",
-    "converting_selected_files": "Converting {count} selected file(s)...",
-    "successfully_converted": "Successfully converted {converted} out of {total} files",
-    "converted_files": "Converted {count} files",
-    "converting_directory": "Converting HEIC files in directory {path} to {target}",
-    "converting_file": "Converting HEIC file {path} to {target_file}",
-    "conversion_successful": "Conversion successful",
-    "conversion_failed": "Conversion failed",
     "invalid_path": "Invalid path: {path}",
     "error_invalid_path": "Error: Invalid path",
     "error_processing_drop": "Error processing dropped files: {error}",
     "select_language": "Select Language",
+    "progress_status": "{done}/{total} files ({failed} failed) - {files_per_second:.1f} files/s, {mb_per_second:.1f} MB/s, ETA {eta}",
+    "progress_started": "Converting {filename}",
+    "progress_finished": "Successfully converted {filename}",
+    "progress_skipped": "Skipped {filename}",
+    "progress_failed": "Failed to convert {filename}",
+    "job_queue": "Job Queue",
+    "job_source": "Source",
+    "job_target": "Target",
+    "job_status": "Status",
+    "job_progress": "Progress",
+    "move_up_button": "Up",
+    "move_down_button": "Down",
+    "cancel_job_button": "Cancel",
+    "clear_finished_button": "Clear Finished",
+    "parallel_jobs": "Parallel jobs:",
+    "job_added": "Added job: {source} -> {target}",
+    "job_started": "Started job: {source}",
+    "job_finished": "Job {status}: {source} ({converted} converted, {failed} failed)",
+    "job_status_queued": "Queued",
+    "job_status_running": "Running",
+    "job_status_done": "Done",
+    "job_status_failed": "Failed",
+    "job_status_cancelled": "Cancelled",
+    "queue_finished": "All jobs finished",
+    "files_count": "{count} files",
 }
 
 gui_settings = {
@@ -94,7 +106,9 @@ gui_settings = {
     "overwrite_existing": False,
     "quality": 95,
     "search_subdirectories": True,
-    "preserve_structure": True
+    "preserve_structure": True,
+    "max_concurrent_jobs": 1,
+    "jobs": []
 }
 
 
@@ -152,6 +166,8 @@ class HEICConverterGUI:
         self.settings["quality"] = int(self.quality_value.get())
         self.settings["search_subdirectories"] = self.recursive_var.get()
         self.settings["preserve_structure"] = self.preserve_structure_var.get()
+        self.settings["max_concurrent_jobs"] = self.job_queue.max_concurrent
+        self.settings["jobs"] = self.job_queue.pending_settings()
 
         try:
             with open(settings_file, "w", encoding="utf-8") as f:
@@ -162,6 +178,8 @@ class HEICConverterGUI:
 
     def on_close(self):
         self.save_settings()
+        # Running jobs finish the files they are converting, unfinished jobs are restored next time
+        self.job_queue.shutdown()
         self.master.destroy()
 
     def create_language_selector(self, parent):
@@ -224,6 +242,19 @@ class HEICConverterGUI:
         if hasattr(self, "quality_label"):
             self.quality_label.config(text=self.get_text("quality_label"))
 
+        # Update job queue texts
+        if hasattr(self, "queue_frame"):
+            self.queue_frame.config(text=self.get_text("job_queue"))
+            for column in ("source", "target", "status", "progress"):
+                self.job_tree.heading(column, text=self.get_text(f"job_{column}"))
+            self.move_up_button.config(text=self.get_text("move_up_button"))
+            self.move_down_button.config(text=self.get_text("move_down_button"))
+            self.cancel_job_button.config(text=self.get_text("cancel_job_button"))
+            self.clear_finished_button.config(text=self.get_text("clear_finished_button"))
+            self.parallel_jobs_label.config(text=self.get_text("parallel_jobs"))
+            for job in list(self.job_queue.jobs):
+                self.refresh_job(job)
+
         # Update language selector label if present
         if hasattr(self, "lang_label"):
             self.lang_label.config(text=self.get_text("select_language"))
@@ -251,11 +282,18 @@ class HEICConverterGUI:
         self.bg_color = "#f0f0f0"
         master.configure(bg=self.bg_color)
         self.selected_files = []
+        # Job updates arrive from worker threads and are applied to the widgets by poll_job_updates
+        self.job_updates = queue.Queue()
+        self.job_queue = JobQueue(
+            max_concurrent=self.settings.get("max_concurrent_jobs", 1),
+            on_update=lambda job, event: self.job_updates.put((job, event))
+        )
         self.create_custom_theme()
         main_frame = ttk.Frame(master, padding="10 10 10 10")
         main_frame.pack(fill='both', expand=True)
         self.create_paths_section(main_frame)
         self.create_options_section(main_frame)
+        self.create_queue_section(main_frame)
         self.create_language_selector(master)
         button_frame = ttk.Frame(main_frame)
         button_frame.pack(pady=10, fill='x')
@@ -292,6 +330,9 @@ class HEICConverterGUI:
         status_bar.pack(side=tk.BOTTOM, fill=tk.X)
         self.setup_drag_drop()
         self.log(self.get_text("log_initial"))
+        for job_settings in self.settings.get("jobs", []):
+            self.add_job(Job.from_settings(job_settings))
+        self.master.after(100, self.poll_job_updates)
 
     def create_custom_theme(self):
         style = ttk.Style()
@@ -394,6 +435,54 @@ class HEICConverterGUI:
         self.quality_scale.set(self.settings.get("quality", 95))
         self.quality_scale.pack(side='left', fill='x', expand=True, padx=5)
 
+    def create_queue_section(self, parent):
+        self.queue_frame = ttk.LabelFrame(parent, text=self.get_text("job_queue"), padding="10 5 10 10")
+        self.queue_frame.pack(fill='both', expand=True, padx=5, pady=5)
+        columns = ("source", "target", "status", "progress")
+        self.job_tree = ttk.Treeview(self.queue_frame, columns=columns, show="headings", height=5)
+        for column, width in zip(columns, (330, 330, 100, 100)):
+            self.job_tree.heading(column, text=self.get_text(f"job_{column}"))
+            self.job_tree.column(column, width=width, stretch=column in ("source", "target"))
+        self.job_tree.pack(fill='both', expand=True)
+        queue_buttons = ttk.Frame(self.queue_frame)
+        queue_buttons.pack(fill='x', pady=(5, 0))
+        self.move_up_button = ttk.Button(
+            queue_buttons,
+            text=self.get_text("move_up_button"),
+            command=lambda: self.move_selected_job(-1)
+        )
+        self.move_up_button.pack(side='left')
+        self.move_down_button = ttk.Button(
+            queue_buttons,
+            text=self.get_text("move_down_button"),
+            command=lambda: self.move_selected_job(1)
+        )
+        self.move_down_button.pack(side='left', padx=5)
+        self.cancel_job_button = ttk.Button(
+            queue_buttons,
+            text=self.get_text("cancel_job_button"),
+            command=self.cancel_selected_job
+        )
+        self.cancel_job_button.pack(side='left')
+        self.clear_finished_button = ttk.Button(
+            queue_buttons,
+            text=self.get_text("clear_finished_button"),
+            command=self.clear_finished_jobs
+        )
+        self.clear_finished_button.pack(side='left', padx=5)
+        self.parallel_jobs_var = tk.IntVar(value=self.job_queue.max_concurrent)
+        parallel_jobs = ttk.Spinbox(
+            queue_buttons,
+            from_=1,
+            to=8,
+            width=3,
+            textvariable=self.parallel_jobs_var,
+            command=self.on_parallel_jobs_change
+        )
+        parallel_jobs.pack(side='right')
+        self.parallel_jobs_label = ttk.Label(queue_buttons, text=self.get_text("parallel_jobs"))
+        self.parallel_jobs_label.pack(side='right')
+
     def setup_drag_drop(self):
         try:
             from tkinterdnd2 import TkinterDnD, DND_FILES
@@ -413,10 +502,127 @@ class HEICConverterGUI:
         self.console_output.see(tk.END)
         self.master.update_idletasks()
 
-    def update_progress(self, message):
+    def update_progress(self, event):
+        filename = os.path.basename(event.source)
+        message = self.get_text(f"progress_{event.kind.value}").format(filename=filename)
+        if event.error:
+            message += f" ({event.error})"
         self.log(message)
+        if event.files_total:
+            eta = str(timedelta(seconds=round(event.eta))) if event.eta is not None else "-"
+            message = self.get_text("progress_status").format(
+                done=event.files_done,
+                total=event.files_total,
+                failed=event.files_failed,
+                files_per_second=event.files_per_second,
+                mb_per_second=event.megabytes_per_second,
+                eta=eta
+            )
         self.status_var.set(message)
 
+    def describe_job(self, job):
+        if job.is_directory or len(job.sources) == 1:
+            return job.sources[0]
+        return self.get_text("files_count").format(count=len(job.sources))
+
+    def create_job(self, sources):
+        """Create a job for a directory or a set of files with the options currently selected"""
+        target = self.target_entry.get()
+        if not target:
+            target = sources[0] if os.path.isdir(sources[0]) else os.path.dirname(sources[0])
+        return Job(
+            list(sources),
+            target,
+            remove=self.remove_var.get(),
+            overwrite=self.overwrite_var.get(),
+            quality=int(self.quality_scale.get()),
+            recursive=self.recursive_var.get(),
+            preserve_structure=self.preserve_structure_var.get()
+        )
+
+    def add_job(self, job):
+        self.job_queue.add(job)
+        self.log(self.get_text("job_added").format(source=self.describe_job(job), target=job.target))
+        yes_no = {True: "Yes", False: "No"}
+        self.log(self.get_text("quality_percent").format(quality=job.quality))
+        self.log(self.get_text("remove_originals").format(value=yes_no[job.remove]))
+        self.log(self.get_text("overwrite_existing_option").format(value=yes_no[job.overwrite]))
+        if job.is_directory:
+            self.log(self.get_text("search_subdirectories").format(value=yes_no[job.recursive]))
+            self.log(self.get_text("preserve_structure_option").format(value=yes_no[job.preserve_structure]))
+
+    def refresh_job(self, job):
+        """Show the current state of a job in the queue panel"""
+        progress = ""
+        if job.files_total is not None:
+            progress = f"{job.files_done}/{job.files_total}"
+        values = (self.describe_job(job), job.target, self.get_text(f"job_status_{job.status}"), progress)
+        iid = str(job.id)
+        if self.job_tree.exists(iid):
+            self.job_tree.item(iid, values=values)
+        else:
+            self.job_tree.insert("", tk.END, iid=iid, values=values)
+
+    def poll_job_updates(self):
+        """Apply the job updates of the worker threads, in the Tk main loop"""
+        try:
+            while True:
+                job, event = self.job_updates.get_nowait()
+                previous_status = self.job_tree.set(str(job.id), "status") if self.job_tree.exists(str(job.id)) else None
+                self.refresh_job(job)
+                if event is not None:
+                    self.update_progress(event)
+                elif previous_status != self.get_text(f"job_status_{job.status}"):
+                    self.log_job_status(job)
+        except queue.Empty:
+            pass
+        self.master.after(100, self.poll_job_updates)
+
+    def log_job_status(self, job):
+        if job.status == JOB_RUNNING:
+            self.log(self.get_text("job_started").format(source=self.describe_job(job)))
+        elif job.finished:
+            message = self.get_text("job_finished").format(
+                status=self.get_text(f"job_status_{job.status}"),
+                source=self.describe_job(job),
+                converted=job.converted,
+                failed=job.files_failed
+            )
+            if job.error:
+                message += f" ({job.error})"
+            self.log(message)
+            if all(queued.finished for queued in self.job_queue.jobs):
+                self.status_var.set(self.get_text("queue_finished"))
+
+    def selected_job_ids(self):
+        return [int(iid) for iid in self.job_tree.selection()]
+
+    def move_selected_job(self, offset):
+        for job_id in self.selected_job_ids():
+            self.job_queue.move(job_id, offset)
+        for index, job in enumerate(list(self.job_queue.jobs)):
+            if self.job_tree.exists(str(job.id)):
+                self.job_tree.move(str(job.id), "", index)
+
+    def cancel_selected_job(self):
+        for job_id in self.selected_job_ids():
+            self.job_queue.cancel(job_id)
+
+    def clear_finished_jobs(self):
+        self.job_queue.clear_finished()
+        remaining = {str(job.id) for job in self.job_queue.jobs}
+        for iid in self.job_tree.get_children():
+            if iid not in remaining:
+                self.job_tree.delete(iid)
+
+    def on_parallel_jobs_change(self):
+        try:
+            self.job_queue.max_concurrent = max(1, int(self.parallel_jobs_var.get()))
+        except (ValueError, tk.TclError):
+            return
+        if self.job_queue.active:
+            self.job_queue.start()
+
     def open_destination_folder(self):
         target_path = self.target_entry.get()
         if not target_path or not os.path.exists(target_path):
@@ -454,71 +660,51 @@ class HEICConverterGUI:
             file_path = file_path.strip('"\'')
 
             if os.path.isfile(file_path):
-                if file_path.lower().endswith('.heic'):
+                if HEIC_PATTERN.search(file_path):
                     valid_files.append(file_path)
             elif os.path.isdir(file_path):
                 directories.append(file_path)
-        if directories:
-            directory = directories[0]
-            self.selected_files = []
-            self.path_entry.delete(0, tk.END)
-            self.path_entry.insert(0, directory)
-            if self.target_entry.get() == "":
-                self.target_entry.delete(0, tk.END)
-                self.target_entry.insert(0, directory)
-            self.recursive_check.state(['!disabled'])
-            self.status_var.set(self.get_text("directory_selected").format(path=directory))
-            if len(directories) > 1:
-                self.log(self.get_text("multiple_directories").format(path=directory))
-            return
+        # Every dropped directory becomes a job, the dropped files one more
+        for directory in directories:
+            self.select_directory(directory)
         if valid_files:
-            self.selected_files = valid_files
-            self.path_entry.delete(0, tk.END)
-            if len(valid_files) == 1:
-                self.path_entry.insert(0, valid_files[0])
-                self.status_var.set(self.get_text("file_selected").format(filename=os.path.basename(valid_files[0])))
-            else:
-                self.path_entry.insert(0, self.get_text("files_selected").format(count=len(valid_files)))
-                self.status_var.set(self.get_text("files_selected").format(count=len(valid_files)))
-            if self.target_entry.get() == "":
-                parent_dir = os.path.dirname(valid_files[0])
-                self.target_entry.delete(0, tk.END)
-                self.target_entry.insert(0, parent_dir)
-            self.recursive_check.state(['disabled'])
+            self.select_files(valid_files)
             self.log(self.get_text("added_files").format(count=len(valid_files)))
+        if directories or valid_files:
             return
         self.status_var.set(self.get_text("no_valid_files"))
         self.log(self.get_text("no_valid_files"))
 
+    def select_files(self, files):
+        self.selected_files = list(files)
+        self.path_entry.delete(0, tk.END)
+        if len(files) == 1:
+            self.path_entry.insert(0, files[0])
+            self.status_var.set(self.get_text("file_selected").format(filename=os.path.basename(files[0])))
+        else:
+            self.path_entry.insert(0, self.get_text("files_selected").format(count=len(files)))
+            self.status_var.set(self.get_text("files_selected").format(count=len(files)))
+        self.recursive_check.state(['disabled'])
+        self.add_job(self.create_job(files))
+
+    def select_directory(self, directory):
+        self.selected_files = []
+        self.path_entry.delete(0, tk.END)
+        self.path_entry.insert(0, directory)
+        self.status_var.set(self.get_text("directory_selected").format(path=directory))
+        self.recursive_check.state(['!disabled'])
+        self.add_job(self.create_job([directory]))
+
     def browse_files(self):
-        filetypes = [("HEIC files", "*.heic"), ("All files", "*.*")]
+        filetypes = [("HEIC files", "*.heic *.heif *.hif"), ("All files", "*.*")]
         files = filedialog.askopenfilenames(filetypes=filetypes)
         if files:
-            self.selected_files = files
-            self.path_entry.delete(0, tk.END)
-            if len(files) == 1:
-                self.path_entry.insert(0, files[0])
-                self.status_var.set(self.get_text("file_selected").format(filename=os.path.basename(files[0])))
-            else:
-                self.path_entry.insert(0, self.get_text("files_selected").format(count=len(files)))
-                self.status_var.set(self.get_text("files_selected").format(count=len(files)))
-            if self.target_entry.get() == "":
-                parent_dir = os.path.dirname(files[0])
-                self.target_entry.delete(0, tk.END)
-                self.target_entry.insert(0, parent_dir)
-            self.recursive_check.state(['disabled'])
+            self.select_files(files)
 
     def browse_directory(self):
         file_path = filedialog.askdirectory()
         if file_path:
-            self.selected_files = []
-            self.path_entry.delete(0, tk.END)
-            self.path_entry.insert(0, file_path)
-            self.status_var.set(self.get_text("directory_selected").format(path=file_path))
-            if self.target_entry.get() == "":
-                self.target_entry.delete(0, tk.END)
-                self.target_entry.insert(0, file_path)
-            self.recursive_check.state(['!disabled'])
+            self.select_directory(file_path)
 
     def browse_target(self):
         file_path = filedialog.askdirectory()
@@ -528,94 +714,19 @@ class HEICConverterGUI:
             self.status_var.set(self.get_text("target_directory").format(path=file_path))
 
     def convert(self):
-        target = self.target_entry.get()
-        remove = self.remove_var.get()
-        overwrite = self.overwrite_var.get()
-        recursive = self.recursive_var.get()
-        quality = int(self.quality_scale.get())
-        preserve_structure = self.preserve_structure_var.get()
-        generate_unique = True
-        verbose = True
-        self.console_output.delete(1.0, tk.END)
-        self.status_var.set(self.get_text("converting"))
-        self.master.update()
-        self.log(self.get_text("conversion_settings"))
-        self.log(self.get_text("quality_percent").format(quality=quality))
-        self.log(self.get_text("remove_originals").format(value="Yes" if remove else "No"))
-        self.log(self.get_text("overwrite_existing_option").format(value="Yes" if overwrite else "No"))
-        self.log(self.get_text("generate_unique_filenames"))
-        if not self.selected_files:
-            self.log(self.get_text("search_subdirectories").format(value="Yes" if recursive else "No"))
-        self.log(self.get_text("preserve_structure_option").format(value="Yes" if preserve_structure else "No"))
-        self.log("")
-        if not os.path.exists(target):
-            os.makedirs(target)
-            self.log(self.get_text("created_target_directory").format(path=target))
-        console_capture = io.StringIO()
-        if self.selected_files:
-            self.log(self.get_text("converting_selected_files").format(count=len(self.selected_files)))
-            with redirect_stdout(console_capture), redirect_stderr(console_capture):
-                converted = convert_multiple_heic_files(
-                    self.selected_files,
-                    overwrite,
-                    remove,
-                    quality,
-                    target,
-                    self.update_progress,
-                    generate_unique,
-                    verbose
-                )
-            captured = console_capture.getvalue()
-            if captured:
-                self.log(captured)
-            self.log(self.get_text("successfully_converted").format(converted=len(converted), total=len(self.selected_files)))
-            self.status_var.set(self.get_text("converted_files").format(count=len(converted)))
-        else:
+        if not any(job.status == JOB_QUEUED for job in self.job_queue.jobs):
+            # Nothing queued: convert what was typed into the path field
             path = self.path_entry.get()
-            if os.path.isdir(path):
-                self.log(self.get_text("converting_directory").format(path=path, target=target))
-                with redirect_stdout(console_capture), redirect_stderr(console_capture):
-                    converted = convert_heic_to_jpeg(
-                        path,
-                        recursive,
-                        overwrite,
-                        remove,
-                        quality,
-                        target,
-                        preserve_structure,
-                        self.update_progress,
-                        generate_unique,
-                        verbose
-                    )
-                captured = console_capture.getvalue()
-                if captured:
-                    self.log(captured)
-                self.log(self.get_text("successfully_converted").format(converted=len(converted), total=len(converted)))
-                self.status_var.set(self.get_text("converted_files").format(count=len(converted)))
-            elif os.path.isfile(path):
-                t_file = os.path.join(target, os.path.basename(path).split('.')[0]) + ".jpg"
-                if generate_unique and os.path.exists(t_file) and not overwrite:
-                    t_file = generate_unique_filename(t_file)
-                self.log(self.get_text("converting_file").format(path=path, target_file=t_file))
-                with redirect_stdout(console_capture), redirect_stderr(console_capture):
-                    success = convert_heic_file(
-                        path,
-                        t_file,
-                        overwrite,
-                        remove,
-                        quality,
-                        self.update_progress,
-                        verbose
-                    )
-                captured = console_capture.getvalue()
-                if captured:
-                    self.log(captured)
-                self.log(self.get_text("conversion_successful") if success else self.get_text("conversion_failed"))
-                self.status_var.set(self.get_text("conversion_successful") if success else self.get_text("conversion_failed"))
+            if os.path.isdir(path) or os.path.isfile(path):
+                self.add_job(self.create_job([path]))
             else:
                 self.log(self.get_text("invalid_path").format(path=path))
                 self.status_var.set(self.get_text("error_invalid_path"))
-        self.console_output.see(tk.END)
+                return
+        self.status_var.set(self.get_text("converting"))
+        self.log(self.get_text("generate_unique_filenames"))
+        self.log(self.get_text("parallel_jobs") + f" {self.job_queue.max_concurrent}")
+        self.job_queue.start()
 
 
 def main():
@@ -628,6 +739,8 @@ def main():
         print("tkinterdnd2 not available, basic drag and drop support will be limited")
     root.configure(bg="#f0f0f0")
     gui = HEICConverterGUI(root)
+    # Load the codecs in the background once the window is painted, so it appears without delay
+    root.after(200, lambda: threading.Thread(target=load_codecs, daemon=True).start())
     root.mainloop()
 
 
@@ -0,0 +1,248 @@
+import itertools
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from converter import Converter
+from progress import ProgressEvent
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+_job_ids = itertools.count(1)
+
+
+@dataclass
+class Job:
+    """
+    A conversion of one directory or one set of files, with the options it was added with
+    """
+    sources: List[str]
+    target: str
+    remove: bool = False
+    overwrite: bool = False
+    quality: int = 95
+    recursive: bool = True
+    preserve_structure: bool = True
+    id: int = field(default_factory=lambda: next(_job_ids))
+    status: str = JOB_QUEUED
+    files_done: int = 0
+    files_failed: int = 0
+    files_total: Optional[int] = None
+    converted: int = 0
+    error: Optional[str] = None
+
+    @property
+    def is_directory(self) -> bool:
+        return len(self.sources) == 1 and os.path.isdir(self.sources[0])
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+    def to_settings(self) -> dict:
+        """
+        Get the options of the job as saved with the GUI settings
+        """
+        return {
+            "sources": list(self.sources),
+            "target": self.target,
+            "remove": self.remove,
+            "overwrite": self.overwrite,
+            "quality": self.quality,
+            "recursive": self.recursive,
+            "preserve_structure": self.preserve_structure,
+        }
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> "Job":
+        """
+        Create a queued job from options saved by to_settings
+        """
+        return cls(
+            settings["sources"],
+            settings["target"],
+            settings.get("remove", False),
+            settings.get("overwrite", False),
+            settings.get("quality", 95),
+            settings.get("recursive", True),
+            settings.get("preserve_structure", True),
+        )
+
+
+class JobQueue:
+    """
+    Runs conversion jobs on background threads, in queue order and up to max_concurrent at once
+
+    Jobs can be added, moved and cancelled while the queue runs. on_update is called from the
+    worker threads whenever a job changes, with the job and the progress event if there is one;
+    GUI callers have to hand it over to their main loop.
+    """
+
+    def __init__(
+            self,
+            max_concurrent: int = 1,
+            on_update: Optional[Callable[[Job, Optional[ProgressEvent]], None]] = None,
+            progress_rate: float = 4.0
+    ):
+        """
+        :param max_concurrent: number of jobs run at the same time
+        :param on_update: callback receiving changed jobs and their progress events
+        :param progress_rate: maximum number of progress events per second and job
+        """
+        self.max_concurrent = max_concurrent
+        self.on_update = on_update
+        self.progress_rate = progress_rate
+        self.jobs: List[Job] = []
+        self.active = False
+        self._converters = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, job: Job) -> Job:
+        """
+        Append a job; it starts right away if the queue is running and has a free slot
+        """
+        with self._lock:
+            self.jobs.append(job)
+        self._notify(job)
+        if self.active:
+            self._dispatch()
+        return job
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self._lock:
+            return next((job for job in self.jobs if job.id == job_id), None)
+
+    def move(self, job_id: int, offset: int) -> None:
+        """
+        Move a job up (negative offset) or down in the queue, which is the order jobs start in
+        """
+        with self._lock:
+            index = next((i for i, job in enumerate(self.jobs) if job.id == job_id), None)
+            if index is None:
+                return
+            new_index = max(0, min(len(self.jobs) - 1, index + offset))
+            self.jobs.insert(new_index, self.jobs.pop(index))
+
+    def cancel(self, job_id: int) -> None:
+        """
+        Cancel a queued job, or stop a running one after the files it is converting
+        """
+        with self._lock:
+            job = next((job for job in self.jobs if job.id == job_id), None)
+            if job is None or job.finished:
+                return
+            converter = self._converters.get(job_id)
+            job.status = JOB_CANCELLED
+        if converter is not None:
+            converter.cancel()
+        self._notify(job)
+
+    def clear_finished(self) -> None:
+        """
+        Remove the jobs that are done, failed or cancelled
+        """
+        with self._lock:
+            self.jobs = [job for job in self.jobs if not job.finished]
+
+    def start(self) -> None:
+        """
+        Run the queued jobs, and the ones added later, until the queue is empty
+        """
+        self.active = True
+        self._dispatch()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the queue: queued jobs stay queued, running ones finish the files they are converting
+
+        :param timeout: maximum seconds to wait for each running job
+        """
+        self.active = False
+        with self._lock:
+            converters = list(self._converters.values())
+            threads = list(self._threads.values())
+        for converter in converters:
+            converter.cancel()
+        for thread in threads:
+            thread.join(timeout)
+
+    @property
+    def running(self) -> bool:
+        with self._lock:
+            return any(job.status == JOB_RUNNING for job in self.jobs)
+
+    def pending_settings(self) -> List[dict]:
+        """
+        Get the jobs that did not finish, to be saved with the settings and restored next time
+        """
+        with self._lock:
+            return [job.to_settings() for job in self.jobs if not job.finished]
+
+    def _dispatch(self) -> None:
+        started = []
+        with self._lock:
+            running = sum(job.status == JOB_RUNNING for job in self.jobs)
+            for job in self.jobs:
+                if running >= self.max_concurrent:
+                    break
+                if job.status == JOB_QUEUED:
+                    job.status = JOB_RUNNING
+                    running += 1
+                    started.append(job)
+            if not started and running == 0:
+                self.active = False
+
+        for job in started:
+            self._notify(job)
+            thread = threading.Thread(target=self._run, args=(job,), name=f"heic-job-{job.id}", daemon=True)
+            with self._lock:
+                self._threads[job.id] = thread
+            thread.start()
+
+    def _run(self, job: Job) -> None:
+        def on_progress(event: ProgressEvent):
+            job.files_done = event.files_done
+            job.files_failed = event.files_failed
+            if event.files_total is not None:
+                job.files_total = event.files_total
+            self._notify(job, event)
+
+        converter = Converter(job.target, job.overwrite, job.remove, job.quality, job.preserve_structure,
+                              generate_unique=True, progress_callback=on_progress, progress_rate=self.progress_rate)
+        with self._lock:
+            self._converters[job.id] = converter
+            cancelled = job.status == JOB_CANCELLED
+        try:
+            if not cancelled:
+                os.makedirs(job.target, exist_ok=True)
+                with converter:
+                    if job.is_directory:
+                        converted = converter.convert_tree(job.sources[0], job.recursive)
+                    else:
+                        converted = converter.convert_files(job.sources)
+                job.converted = len(converted)
+            with self._lock:
+                if job.status == JOB_RUNNING:
+                    job.status = JOB_FAILED if job.files_failed else JOB_DONE
+        except Exception as e:
+            with self._lock:
+                job.status = JOB_FAILED
+                job.error = f"{type(e).__name__}: {e}"
+        finally:
+            with self._lock:
+                self._converters.pop(job.id, None)
+                self._threads.pop(job.id, None)
+
+        self._notify(job)
+        if self.active:
+            self._dispatch()
+
+    def _notify(self, job: Job, event: Optional[ProgressEvent] = None) -> None:
+        if self.on_update:
+            self.on_update(job, event)
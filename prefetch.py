@@ -0,0 +1,150 @@
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from storage import get_storage, is_network_path, is_url
+
+PREFETCH_MODES = ('auto', 'off', 'read', 'fadvise')
+
+# Defaults: enough files to hide a NAS round trip per file behind the decoding of the previous ones
+PREFETCH_DEPTH = 4
+PREFETCH_BUDGET = 256 * 1024 * 1024
+
+
+class Prefetcher:
+    """
+    Fetches the next files of a plan while the current one is being converted
+
+    In 'read' mode the next files are read into memory by background threads, holding at most
+    depth files and, once their sizes are known, at most byte_budget bytes. In 'fadvise' mode
+    the kernel is asked to load them into the page cache (posix_fadvise WILLNEED), which costs
+    no memory here. 'auto' reads ahead from object storage and network mounts only; local
+    disks are fast enough that it would only add copies.
+
+    Hits are prefetched files that were ready when the converter asked for them, misses the
+    ones it still had to wait for.
+    """
+
+    def __init__(
+            self,
+            mode: str = 'auto',
+            depth: int = PREFETCH_DEPTH,
+            byte_budget: int = PREFETCH_BUDGET,
+            reader: Optional[Callable[[str], bytes]] = None
+    ):
+        """
+        :param mode: one of PREFETCH_MODES
+        :param depth: number of files fetched ahead of the converter
+        :param byte_budget: maximum size of the files held in memory in 'read' mode
+        :param reader: reads a whole source, defaults to the source storage's read_bytes
+        """
+        if mode not in PREFETCH_MODES:
+            raise ValueError(f"Unknown prefetch mode {mode}, expected one of {', '.join(PREFETCH_MODES)}")
+        if mode == 'fadvise' and not hasattr(os, "posix_fadvise"):
+            mode = 'read'
+        self.mode = mode
+        self.depth = max(1, depth)
+        self.byte_budget = byte_budget
+        self.reader = reader or (lambda source: get_storage(source).read_bytes(source))
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.advised = 0
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        """
+        Share of the prefetched reads that were complete when needed, None if nothing was read ahead
+        """
+        fetched = self.hits + self.misses
+        return self.hits / fetched if fetched else None
+
+    def summary(self) -> dict:
+        return {"prefetch_hits": self.hits, "prefetch_misses": self.misses, "prefetch_errors": self.errors,
+                "prefetch_advised": self.advised, "prefetch_hit_rate": self.hit_rate}
+
+    def mode_for(self, source: str) -> Optional[str]:
+        """
+        Get how a source is prefetched: 'read', 'fadvise' or None for not at all
+        """
+        if self.mode == 'off':
+            return None
+        storage = get_storage(source)
+        if self.mode == 'auto':
+            return 'read' if storage.remote or (not is_url(source) and is_network_path(source)) else None
+        if self.mode == 'fadvise' and storage.remote:
+            return 'read'
+        return self.mode
+
+    def iterate(self, plan: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str, Optional[bytes]]]:
+        """
+        Yield each planned conversion together with the prefetched source content
+
+        Sources that are not read ahead, or whose read failed, come with None and are read
+        by the converter as usual.
+
+        :param plan: (source, target) pairs in conversion order
+        :return: a generator of (source, target, data) triples
+        """
+        plan = iter(plan)
+        window = deque()
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=self.depth, thread_name_prefix="heic-prefetch") as executor:
+            try:
+                while True:
+                    # The current file plus depth files ahead, as long as the held bytes fit the budget
+                    while not exhausted and (not window or (len(window) <= self.depth and
+                                                            self._held_bytes(window) < self.byte_budget)):
+                        item = next(plan, None)
+                        if item is None:
+                            exhausted = True
+                            break
+                        source, target = item
+                        window.append((source, target, self._submit(executor, source)))
+                    if not window:
+                        return
+                    source, target, future = window.popleft()
+                    yield source, target, self._take(future)
+            finally:
+                for _, _, future in window:
+                    if future is not None:
+                        future.cancel()
+
+    def _submit(self, executor: ThreadPoolExecutor, source: str) -> Optional[Future]:
+        mode = self.mode_for(source)
+        if mode == 'read':
+            return executor.submit(self.reader, source)
+        if mode == 'fadvise':
+            executor.submit(self._advise, source)
+            self.advised += 1
+        return None
+
+    @staticmethod
+    def _advise(source: str) -> None:
+        fd = os.open(source, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _held_bytes(window: deque) -> int:
+        return sum(len(future.result()) for _, _, future in window
+                   if future is not None and future.done() and not future.exception())
+
+    def _take(self, future: Optional[Future]) -> Optional[bytes]:
+        """
+        Get a prefetched content, leaving errors to the regular read path
+        """
+        if future is None:
+            return None
+        if future.done():
+            self.hits += 1
+        else:
+            self.misses += 1
+        try:
+            return future.result()
+        except Exception:
+            self.errors += 1
+            return None
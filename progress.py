@@ -0,0 +1,143 @@
+import threading
+import time
+from dataclasses import dataclass, replace
+from enum import Enum
+from typing import Callable, Optional
+
+
+class ProgressKind(Enum):
+    STARTED = "started"
+    FINISHED = "finished"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    """
+    A progress update for one file, with the running totals of its batch
+
+    Events emitted by convert_heic_file only describe the file itself; the batch functions
+    fill in the totals and throughput through a ProgressTracker.
+    """
+    kind: ProgressKind
+    source: str
+    target: str
+    bytes: int = 0
+    duration: float = 0.0
+    error: Optional[str] = None
+    error_class: Optional[str] = None
+    output_bytes: int = 0
+    width: Optional[int] = None
+    height: Optional[int] = None
+    psnr: Optional[float] = None
+    ssim: Optional[float] = None
+    files_done: int = 0
+    files_failed: int = 0
+    files_skipped: int = 0
+    files_total: Optional[int] = None
+    bytes_done: int = 0
+    bytes_total: Optional[int] = None
+    files_per_second: float = 0.0
+    megabytes_per_second: float = 0.0
+    eta: Optional[float] = None
+
+
+ProgressCallback = Callable[[ProgressEvent], None]
+
+
+class ProgressTracker:
+    """
+    Adds batch totals, throughput and ETA to file events and delivers them at a limited rate
+
+    Events arriving faster than max_rate per second are coalesced: only the latest one is kept
+    and delivered once the interval has passed, or by flush() at the end of the batch.
+    The tracker is itself a progress callback and is safe to call from worker threads.
+    """
+
+    def __init__(
+            self,
+            callback: ProgressCallback,
+            files_total: Optional[int] = None,
+            bytes_total: Optional[int] = None,
+            max_rate: float = 10.0
+    ):
+        """
+        :param callback: the consumer of the coalesced events
+        :param files_total: number of files in the batch, if known
+        :param bytes_total: size of all files in the batch, if known
+        :param max_rate: maximum number of deliveries per second, 0 for no limit
+        """
+        self.callback = callback
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.files_done = 0
+        self.files_failed = 0
+        self.files_skipped = 0
+        self.bytes_done = 0
+        self._start = time.monotonic()
+        self._last_delivery = None
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def __call__(self, event: ProgressEvent) -> None:
+        with self._lock:
+            if event.kind is not ProgressKind.STARTED:
+                self.files_done += 1
+                self.bytes_done += event.bytes
+                if event.kind is ProgressKind.FAILED:
+                    self.files_failed += 1
+                elif event.kind is ProgressKind.SKIPPED:
+                    self.files_skipped += 1
+
+            now = time.monotonic()
+            self._pending = self._enrich(event, now)
+            if self._last_delivery is not None and now - self._last_delivery < self.interval:
+                return
+            self._last_delivery = now
+            event, self._pending = self._pending, None
+
+        self.callback(event)
+
+    def flush(self) -> None:
+        """
+        Deliver the last coalesced event, if any is still pending
+        """
+        with self._lock:
+            event, self._pending = self._pending, None
+        if event is not None:
+            self.callback(event)
+
+    def set_totals(self, files_total: Optional[int], bytes_total: Optional[int]) -> None:
+        """
+        Update the batch totals, e.g. once a running scan has finished
+        """
+        with self._lock:
+            self.files_total = files_total
+            self.bytes_total = bytes_total
+
+    def _enrich(self, event: ProgressEvent, now: float) -> ProgressEvent:
+        elapsed = max(now - self._start, 1e-9)
+        files_per_second = self.files_done / elapsed
+        bytes_per_second = self.bytes_done / elapsed
+
+        # Weight the ETA by bytes, since large files take proportionally longer to convert
+        eta = None
+        if self.bytes_total is not None and bytes_per_second > 0:
+            eta = max(self.bytes_total - self.bytes_done, 0) / bytes_per_second
+        elif self.files_total is not None and files_per_second > 0:
+            eta = max(self.files_total - self.files_done, 0) / files_per_second
+
+        return replace(
+            event,
+            files_done=self.files_done,
+            files_failed=self.files_failed,
+            files_skipped=self.files_skipped,
+            files_total=self.files_total,
+            bytes_done=self.bytes_done,
+            bytes_total=self.bytes_total,
+            files_per_second=files_per_second,
+            megabytes_per_second=bytes_per_second / 1e6,
+            eta=eta
+        )
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from typing import List
+
+from progress import ProgressEvent, ProgressKind
+from storage import get_storage
+
+
+class ReportWriter:
+    """
+    Streams a JSON Lines report of a run: one record per file, then a summary record
+
+    Records are written and flushed as the files finish, so a report of any size needs
+    constant memory and can be followed while the run is going on. The writer is safe
+    to use from worker threads.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: the report file or URL, overwritten if it exists
+        """
+        self.path = path
+        self._file = get_storage(path).open(path, "w")
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self.files = 0
+        self.counts = {kind.value: 0 for kind in ProgressKind if kind is not ProgressKind.STARTED}
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.extra = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_summary(self, fields: dict) -> None:
+        """
+        Add fields to the summary record, e.g. statistics of a batch; counters are summed up
+        """
+        with self._lock:
+            for key, value in fields.items():
+                if isinstance(value, int) and isinstance(self.extra.get(key), int):
+                    value += self.extra[key]
+                self.extra[key] = value
+
+    def write(self, event: ProgressEvent) -> None:
+        """
+        Write the record of a file that finished, was skipped or failed
+        """
+        if event.kind is ProgressKind.STARTED:
+            return
+        record = {
+            "type": "file",
+            "source": event.source,
+            "target": event.target,
+            "status": event.kind.value,
+            "error_class": event.error_class,
+            "error": event.error,
+            "input_bytes": event.bytes,
+            "output_bytes": event.output_bytes,
+            "width": event.width,
+            "height": event.height,
+            "duration": round(event.duration, 4),
+        }
+        if event.psnr is not None:
+            record.update(psnr=event.psnr, ssim=event.ssim)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.files += 1
+            self.counts[event.kind.value] += 1
+            self.input_bytes += event.bytes
+            self.output_bytes += event.output_bytes
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        """
+        Write the summary record and close the report
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            duration = max(time.monotonic() - self._start, 1e-9)
+            summary = {
+                "type": "summary",
+                "files": self.files,
+                **self.counts,
+                "input_bytes": self.input_bytes,
+                "output_bytes": self.output_bytes,
+                "duration": round(duration, 4),
+                "files_per_second": round(self.files / duration, 3),
+                "megabytes_per_second": round(self.input_bytes / duration / 1e6, 3),
+                **self.extra,
+            }
+            self._file.write(json.dumps(summary) + "\n")
+            self._file.close()
+            self._file = None
+
+
+def read_report(path: str) -> List[dict]:
+    """
+    Load all records of a report, e.g. for tests or post-processing
+
+    :param path: the report file or URL
+    :return: the records as dictionaries
+    """
+    with get_storage(path).open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
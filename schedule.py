@@ -0,0 +1,207 @@
+import heapq
+import struct
+from datetime import datetime
+from typing import Any, Iterator, List, NamedTuple, Optional, Tuple
+
+from storage import get_storage
+
+ORDER_POLICIES = ('walk', 'largest-first', 'newest-first')
+
+# The meta box of a HEIF file sits at its start; this much is read to find it
+HEADER_BYTES = 64 * 1024
+
+EXIF_DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+
+class HeifHeader(NamedTuple):
+    """
+    What the scheduler learns from the header of a HEIF file without decoding it
+    """
+    pixels: Optional[int]
+    taken: Optional[float]
+
+
+def _boxes(data: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    Iterate over the ISO BMFF boxes in data[start:end]
+
+    :return: a generator of (type, payload start, box end) triples
+    """
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield box_type, start + header, min(start + size, end)
+        start += size
+
+
+def _uint(data: bytes, offset: int, size: int) -> int:
+    return int.from_bytes(data[offset:offset + size], "big") if size else 0
+
+
+def _exif_location(data: bytes, iinf: Tuple[int, int], iloc: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+    """
+    Find the file offset and length of the Exif item from the iinf and iloc boxes
+    """
+    start, end = iinf
+    version = data[start]
+    exif_id = None
+    for box_type, payload, box_end in _boxes(data, start + (6 if version == 0 else 8), end):
+        if box_type != b"infe" or data[payload] < 2:
+            continue
+        id_size = 2 if data[payload] == 2 else 4
+        if data[payload + 6 + id_size:payload + 10 + id_size] == b"Exif":
+            exif_id = _uint(data, payload + 4, id_size)
+            break
+    if exif_id is None:
+        return None
+
+    start, _ = iloc
+    version = data[start]
+    offset_size, length_size = data[start + 4] >> 4, data[start + 4] & 15
+    base_offset_size, index_size = data[start + 5] >> 4, data[start + 5] & 15
+    if version == 0:
+        index_size = 0
+    id_size = 4 if version == 2 else 2
+    pos = start + 6
+    item_count = _uint(data, pos, id_size)
+    pos += id_size
+    for _ in range(item_count):
+        item_id = _uint(data, pos, id_size)
+        pos += id_size
+        construction_method = 0
+        if version in (1, 2):
+            construction_method = data[pos + 1] & 15
+            pos += 2
+        pos += 2  # data reference index
+        base_offset = _uint(data, pos, base_offset_size)
+        pos += base_offset_size
+        extent_count = _uint(data, pos, 2)
+        pos += 2
+        extents = []
+        for _ in range(extent_count):
+            pos += index_size
+            extent_offset = _uint(data, pos, offset_size)
+            extent_length = _uint(data, pos + offset_size, length_size)
+            pos += offset_size + length_size
+            extents.append((base_offset + extent_offset, extent_length))
+        if item_id == exif_id:
+            return extents[0] if construction_method == 0 and len(extents) == 1 else None
+    return None
+
+
+def _exif_date(exif: bytes) -> Optional[float]:
+    """
+    Get the capture time from the payload of a HEIF Exif item
+    """
+    import piexif
+
+    # The payload starts with the offset of the TIFF header
+    tiff = exif[4 + _uint(exif, 0, 4):]
+    exif_dict = piexif.load(tiff)
+    date = (exif_dict["Exif"].get(piexif.ExifIFD.DateTimeOriginal) or
+            exif_dict["0th"].get(piexif.ImageIFD.DateTime))
+    if not date:
+        return None
+    return datetime.strptime(date.decode(), EXIF_DATE_FORMAT).timestamp()
+
+
+def read_header(f, capture_time: bool = True) -> HeifHeader:
+    """
+    Read the image size and the capture time of a HEIF file from its boxes
+
+    Only the start of the file and the Exif item are read; the size is that of the largest
+    image in the file, which is the full image for grids of tiles.
+
+    :param f: the file opened for binary reading
+    :param capture_time: also read the Exif item for the capture time, which costs another read
+    :return: the header data, with None for what could not be found
+    """
+    data = f.read(HEADER_BYTES)
+    meta = next(((payload, end) for box_type, payload, end in _boxes(data, 0, len(data))
+                 if box_type == b"meta"), None)
+    if meta is None:
+        return HeifHeader(None, None)
+
+    pixels = None
+    children = {}
+    # meta is a full box: its children follow version and flags
+    for box_type, payload, end in _boxes(data, meta[0] + 4, meta[1]):
+        children[box_type] = (payload, end)
+        if box_type == b"iprp":
+            for ipco_type, ipco_payload, ipco_end in _boxes(data, payload, end):
+                if ipco_type != b"ipco":
+                    continue
+                for property_type, property_payload, _ in _boxes(data, ipco_payload, ipco_end):
+                    if property_type == b"ispe":
+                        width, height = struct.unpack_from(">II", data, property_payload + 4)
+                        pixels = max(pixels or 0, width * height)
+
+    taken = None
+    if capture_time and b"iinf" in children and b"iloc" in children:
+        try:
+            location = _exif_location(data, children[b"iinf"], children[b"iloc"])
+            if location:
+                f.seek(location[0])
+                taken = _exif_date(f.read(location[1]))
+        except Exception:
+            taken = None
+    return HeifHeader(pixels, taken)
+
+
+def _read_header_or_none(source: str) -> HeifHeader:
+    try:
+        with get_storage(source).open(source, "rb") as f:
+            return read_header(f)
+    except Exception:
+        return HeifHeader(None, None)
+
+
+def prioritize(candidates: List[Tuple[str, Any, Any]], policy: str) -> Iterator[Any]:
+    """
+    Order a batch by a scheduling policy and feed it from a priority queue
+
+    Headers are only read from local files; remote files are ranked by the size and
+    modification time of their listing.
+
+    - walk: the order of the candidates
+    - largest-first: by estimated decode cost, the header pixel count or else the file size
+      scaled by the typical bytes per pixel of the batch, so no large file is left for the end
+    - newest-first: by EXIF capture time or else modification time
+
+    :param candidates: (source, stat result, item) triples
+    :param policy: one of ORDER_POLICIES
+    :return: a generator of the items in conversion order
+    """
+    if policy not in ORDER_POLICIES:
+        raise ValueError(f"Unknown order {policy}, expected one of {', '.join(ORDER_POLICIES)}")
+    if policy == 'walk':
+        for _, _, item in candidates:
+            yield item
+        return
+
+    headers = [HeifHeader(None, None) if get_storage(source).remote else _read_header_or_none(source)
+               for source, _, _ in candidates]
+
+    if policy == 'largest-first':
+        ratios = sorted(header.pixels / stat.st_size for (_, stat, _), header in zip(candidates, headers)
+                        if header.pixels and stat.st_size)
+        pixels_per_byte = ratios[len(ratios) // 2] if ratios else 1.0
+        priorities = [-(header.pixels or stat.st_size * pixels_per_byte)
+                      for (_, stat, _), header in zip(candidates, headers)]
+    else:
+        priorities = [-(header.taken if header.taken is not None else stat.st_mtime)
+                      for (_, stat, _), header in zip(candidates, headers)]
+
+    # The index keeps equal priorities in walk order and spares comparing the items
+    queue = [(priority, index) for index, priority in enumerate(priorities)]
+    heapq.heapify(queue)
+    while queue:
+        _, index = heapq.heappop(queue)
+        yield candidates[index][2]
@@ -0,0 +1,252 @@
+import mmap
+import os
+import posixpath
+import sys
+from datetime import datetime
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple, Union
+
+# Filesystems on which a mapped file can change or vanish under the reader, raising SIGBUS
+NETWORK_FILESYSTEMS = (
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "lustre", "davfs",
+    "fuse.sshfs", "fuse.rclone", "fuse.s3fs", "fuse.gcsfuse", "fuse.glusterfs",
+)
+
+
+def is_url(path: str) -> bool:
+    """
+    Check whether a path is a URL such as memory://, file:// or s3://
+
+    :param path: the path to check
+    :return: True if the path carries a protocol prefix
+    """
+    return "://" in path
+
+
+@lru_cache(maxsize=1)
+def _mount_table() -> List[Tuple[str, str]]:
+    """
+    Get the (mount point, filesystem type) pairs of Linux
+    """
+    mounts = []
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    # Spaces in mount points are escaped as \040
+                    mounts.append((fields[1].replace("\\040", " "), fields[2]))
+    except OSError:
+        pass
+    return mounts
+
+
+def is_network_path(path: str) -> bool:
+    """
+    Check whether a local path lives on a network filesystem, where every open costs a round trip
+
+    :param path: the local file or directory
+    :return: True for network mounts and Windows UNC paths
+    """
+    path = os.path.abspath(path)
+    if sys.platform == "win32":
+        return path.startswith("\\\\")
+
+    # The file lives on the filesystem of the longest mount point containing it
+    mount_fs_type, mount_length = None, -1
+    for mount_point, fs_type in _mount_table():
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > mount_length:
+            mount_fs_type, mount_length = fs_type, len(mount_point)
+    return mount_fs_type in NETWORK_FILESYSTEMS
+
+
+def is_mmap_safe(path: str) -> bool:
+    """
+    Check whether a local file may be memory-mapped, i.e. it is not on a network filesystem
+
+    :param path: the local file
+    :return: False for network mounts and Windows UNC paths
+    """
+    return not is_network_path(path)
+
+
+class LocalStorage:
+    """
+    Filesystem access for plain local paths, implemented with os
+    """
+    remote = False
+
+    def normpath(self, path: str) -> str:
+        return os.path.normpath(path)
+
+    def join(self, *parts: str) -> str:
+        return os.path.join(*parts)
+
+    def dirname(self, path: str) -> str:
+        return os.path.dirname(path)
+
+    def relpath(self, path: str, start: str) -> str:
+        return os.path.relpath(path, start)
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def isfile(self, path: str) -> bool:
+        return os.path.isfile(path)
+
+    def isdir(self, path: str) -> bool:
+        return os.path.isdir(path)
+
+    def makedirs(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+
+    def remove(self, path: str) -> None:
+        os.remove(path)
+
+    def size(self, path: str) -> int:
+        return os.path.getsize(path)
+
+    def stat(self, path: str) -> os.stat_result:
+        return os.stat(path)
+
+    def scandir(self, path: str) -> Iterator[os.DirEntry]:
+        with os.scandir(path) as entries:
+            yield from entries
+
+    def open(self, path: str, mode: str = "rb"):
+        return open(path, mode)
+
+    def read_bytes(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def map(self, path: str) -> Optional[mmap.mmap]:
+        """
+        Memory-map a file read-only, or return None where that is unsafe or impossible
+        """
+        if not is_mmap_safe(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files and special files cannot be mapped
+            return None
+
+
+class _RemoteStat:
+    """
+    The subset of os.stat_result the converter looks at
+    """
+
+    def __init__(self, info: dict):
+        self.st_size = info.get("size") or 0
+        mtime = info.get("mtime", info.get("LastModified", info.get("created")))
+        if isinstance(mtime, datetime):
+            mtime = mtime.timestamp()
+        self.st_mtime = float(mtime or 0)
+
+
+class _RemoteEntry:
+    """
+    An os.DirEntry look-alike built from an fsspec ``ls(detail=True)`` record
+    """
+
+    def __init__(self, fs, info: dict):
+        self.path = fs.unstrip_protocol(info["name"])
+        self.name = posixpath.basename(info["name"].rstrip("/"))
+        self._info = info
+
+    def is_dir(self, follow_symlinks: bool = True) -> bool:
+        return self._info.get("type") == "directory"
+
+    def is_file(self, follow_symlinks: bool = True) -> bool:
+        return self._info.get("type") == "file"
+
+    def is_symlink(self) -> bool:
+        return False
+
+    def stat(self, follow_symlinks: bool = True) -> _RemoteStat:
+        return _RemoteStat(self._info)
+
+
+class FsspecStorage:
+    """
+    Filesystem access for URLs, backed by an fsspec filesystem
+
+    Paths stay full URLs throughout, so targets can be reported and reused as given.
+    """
+
+    def __init__(self, url: str):
+        try:
+            import fsspec
+        except ImportError:
+            raise ImportError(f"fsspec is required to access {url}, install it with 'pip install fsspec'")
+
+        self.fs, _ = fsspec.core.url_to_fs(url)
+        protocols = self.fs.protocol if isinstance(self.fs.protocol, tuple) else (self.fs.protocol,)
+        self.remote = "file" not in protocols
+
+    def normpath(self, path: str) -> str:
+        return self.fs.unstrip_protocol(self.fs._strip_protocol(path))
+
+    def join(self, *parts: str) -> str:
+        return posixpath.join(*parts)
+
+    def dirname(self, path: str) -> str:
+        return posixpath.dirname(path)
+
+    def relpath(self, path: str, start: str) -> str:
+        return posixpath.relpath(self.fs._strip_protocol(path), self.fs._strip_protocol(start))
+
+    def exists(self, path: str) -> bool:
+        return self.fs.exists(path)
+
+    def isfile(self, path: str) -> bool:
+        return self.fs.isfile(path)
+
+    def isdir(self, path: str) -> bool:
+        return self.fs.isdir(path)
+
+    def makedirs(self, path: str) -> None:
+        self.fs.makedirs(path, exist_ok=True)
+
+    def remove(self, path: str) -> None:
+        self.fs.rm_file(path)
+
+    def size(self, path: str) -> int:
+        return self.fs.size(path)
+
+    def stat(self, path: str) -> _RemoteStat:
+        return _RemoteStat(self.fs.info(path))
+
+    def scandir(self, path: str) -> Iterator[_RemoteEntry]:
+        for info in self.fs.ls(path, detail=True):
+            yield _RemoteEntry(self.fs, info)
+
+    def open(self, path: str, mode: str = "rb"):
+        return self.fs.open(path, mode)
+
+    def read_bytes(self, path: str) -> bytes:
+        return self.fs.cat_file(path)
+
+    def map(self, path: str) -> None:
+        # URLs are always read, even file:// ones, their filesystem is not known here
+        return None
+
+
+Storage = Union[LocalStorage, FsspecStorage]
+
+_local_storage = LocalStorage()
+
+
+def get_storage(path: str) -> Storage:
+    """
+    Get the filesystem access object for a path or URL
+
+    :param path: a local path or a URL such as memory://, file:// or s3://
+    :return: the storage that serves the path
+    """
+    if is_url(path):
+        return FsspecStorage(path)
+    return _local_storage
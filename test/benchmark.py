@@ -0,0 +1,202 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def best_of(repeat, func, *args):
+    """Run func repeat times and return the fastest duration in seconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def bench_tonemap(args):
+    """Throughput of the 16-bit to 8-bit conversion on a 48 MP image"""
+    from tonemap import DITHER_MODES, TONE_MAP_CURVES, TRANSFER_PQ, to_8bit
+
+    width, height = 8064, 6048
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 65536, size=(height, width, 3), dtype=np.uint16)
+    megapixels = width * height / 1e6
+    print(f'Image: {width}x{height} ({megapixels:.1f} MP), best of {args.repeat}')
+
+    for nclx in ({}, {'transfer_characteristics': TRANSFER_PQ, 'color_primaries': 9}):
+        for tone_map in TONE_MAP_CURVES:
+            for dither in DITHER_MODES:
+                duration = best_of(args.repeat, to_8bit, data, nclx, tone_map, dither)
+                label = 'PQ/BT.2020' if nclx else 'sRGB'
+                print(f'{label:10} {tone_map:8} {dither:10} {duration:6.2f} s  {megapixels / duration:6.1f} MP/s')
+
+
+def bench_read(args):
+    """Opening a 12 MP HEIC from the page cache, read through a file object versus memory-mapped"""
+    import tempfile
+    from PIL import Image
+    from converter import load_codecs
+    from storage import get_storage
+
+    load_codecs()
+    rng = np.random.default_rng(0)
+    path = os.path.join(tempfile.mkdtemp(), 'noise.heic')
+    Image.fromarray(rng.integers(0, 256, size=(3024, 4032, 3), dtype=np.uint8)).save(path, quality=90)
+    print(f'File: {os.path.getsize(path) / 1e6:.1f} MB, best of {args.repeat} x 20 opens')
+
+    def open_read():
+        for _ in range(20):
+            Image.open(path)
+
+    def open_mapped():
+        for _ in range(20):
+            mapping = get_storage(path).map(path)
+            Image.open(mapping)
+            mapping.close()
+
+    for label, func in (('read', open_read), ('mmap', open_mapped)):
+        duration = best_of(args.repeat, func) / 20
+        print(f'{label:5} {duration * 1000:6.2f} ms per open')
+    os.remove(path)
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes, the peak where the current one is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_pool(args):
+    """Allocations and RSS of converting same-size 12 MP images with and without the buffer pool"""
+    import subprocess
+
+    if args.budget is not None:
+        return pool_run(args)
+    print(f'{args.files} files of 4032x3024, {"tone mapped 10-bit" if args.tone_map else "8-bit"}, '
+          f'each configuration in a fresh process')
+    for label, budget in (('no pool', '0'), ('pool', '256M')):
+        command = [sys.executable, os.path.abspath(__file__), 'pool', '--budget', budget, '--files', str(args.files)]
+        if args.tone_map:
+            command.append('--tone-map')
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        print(f'{label:8} {output.strip()}')
+
+
+def pool_run(args):
+    import tempfile
+    from PIL import Image
+    import pillow_heif
+    from converter import Converter, load_codecs
+    from heicConverter import size_type
+
+    load_codecs()
+    test_dir = tempfile.mkdtemp()
+    # Gradients with a little noise, full-range noise makes libheif give up on decoding 12 MP
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:3024, 0:4032]
+    data = np.stack([x / 4032, y / 3024, (x + y) / 7056], axis=-1) * 0.9 + rng.random((3024, 4032, 3)) * 0.1
+    source = os.path.join(test_dir, 'source.heic')
+    if args.tone_map:
+        data = (data * 65535).astype(np.uint16)
+        pillow_heif.from_bytes('RGB;16', (4032, 3024), data.tobytes()).save(source, quality=90)
+    else:
+        Image.fromarray((data * 255).astype(np.uint8)).save(source, quality=90)
+
+    converter = Converter(test_dir, tone_map='clip' if args.tone_map else None, pool_budget=size_type(args.budget))
+    stats_before = Image.core.get_stats()
+    start = time.perf_counter()
+    peak = 0
+    for i in range(args.files):
+        converter.convert_file(source, os.path.join(test_dir, f'{i}.jpg'))
+        peak = max(peak, current_rss())
+    duration = time.perf_counter() - start
+    stats = {key: value - stats_before[key] for key, value in Image.core.get_stats().items()}
+    pool = converter._buffer_pool
+    pool_counts = f'pool {pool.allocations} new/{pool.reuses} reused' if pool else 'pool -'
+    print(f'{duration / args.files * 1000:6.0f} ms/file  Pillow blocks {stats["allocated_blocks"]} new/'
+          f'{stats["reused_blocks"]} reused  {pool_counts}  RSS {current_rss() / 2 ** 20:.0f} MB, '
+          f'peak {peak / 2 ** 20:.0f} MB')
+    converter.close()
+    for name in os.listdir(test_dir):
+        os.remove(os.path.join(test_dir, name))
+    os.rmdir(test_dir)
+
+
+def bench_walk(args):
+    """Scanning a tree of many directories: os.walk against the sequential and the parallel walker"""
+    import shutil
+    import tempfile
+    from converter import HEIC_PATTERN, get_file_list
+
+    root = args.root
+    if root is None:
+        # Per-day folders with one photo each, 1000 folders per parent like an archive of years
+        root = tempfile.mkdtemp()
+        for i in range(args.dirs):
+            folder = os.path.join(root, f'{i // 1000:03}', f'{i % 1000:03}')
+            os.makedirs(folder)
+            open(os.path.join(folder, 'IMG_0001.heic'), 'wb').close()
+    if args.latency:
+        # Every directory listing waits for a round trip, as on NFS; os.walk looks scandir up in os as well
+        scandir = os.scandir
+
+        def slow_scandir(path):
+            time.sleep(args.latency / 1000)
+            return scandir(path)
+
+        os.scandir = slow_scandir
+    print(f'Tree: {args.root or f"{args.dirs} synthetic directories"}, {args.latency} ms per listing, '
+          f'best of {args.repeat}')
+
+    def os_walk():
+        return [[dirpath, name] for dirpath, _, names in os.walk(root) for name in names if HEIC_PATTERN.search(name)]
+
+    runs = [('os.walk', os_walk), ('get_file_list', lambda: get_file_list(root, True))]
+    for workers in args.workers:
+        runs.append((f'{workers} workers', lambda workers=workers: get_file_list(root, True, workers=workers)))
+        runs.append((f'{workers} unordered', lambda workers=workers: get_file_list(root, True, workers=workers,
+                                                                                   ordered=False)))
+    for label, func in runs:
+        duration = best_of(args.repeat, func)
+        print(f'{label:16} {duration:6.2f} s  {len(func())} files')
+
+    if args.root is None:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the HEIC converter')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement, default: 3')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    subparsers.add_parser('tonemap', help=bench_tonemap.__doc__).set_defaults(func=bench_tonemap)
+    subparsers.add_parser('read', help=bench_read.__doc__).set_defaults(func=bench_read)
+    pool_parser = subparsers.add_parser('pool', help=bench_pool.__doc__)
+    pool_parser.add_argument('--files', type=int, default=20, help='Files converted per configuration, default: 20')
+    pool_parser.add_argument('--tone-map', action='store_true', help='Convert 10-bit sources through the tone mapping')
+    pool_parser.add_argument('--budget', help=argparse.SUPPRESS)
+    pool_parser.set_defaults(func=bench_pool)
+    walk_parser = subparsers.add_parser('walk', help=bench_walk.__doc__)
+    walk_parser.add_argument('--dirs', type=int, default=100000,
+                             help='Directories of the synthetic tree, default: 100000')
+    walk_parser.add_argument('--root', help='Scan this tree instead, e.g. on a network share')
+    walk_parser.add_argument('--latency', type=float, default=0,
+                             help='Simulated round trip per directory listing in ms, default: 0')
+    walk_parser.add_argument('--workers', type=int, nargs='+', default=[4, 16],
+                             help='Worker counts of the parallel walker, default: 4 16')
+    walk_parser.set_defaults(func=bench_walk)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
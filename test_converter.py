@@ -1,20 +1,55 @@
 import unittest
 import os
+import importlib
+import io
+import random
 import shutil
+import subprocess
+import struct
+import sys
 import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
 from unittest.mock import patch, MagicMock
 
 import PIL.Image
 from PIL import Image
 import piexif
+import numpy as np
+import pillow_heif
 
 from converter import (
+    BufferPool,
+    DECODE_THREADS_SAMPLE,
+    DEFAULT_EXCLUDES,
+    Converter,
+    FileFilter,
+    balance_decode_threads,
+    _sample_pixel_counts,
     generate_unique_filename,
     get_file_list,
+    iter_convert,
+    iter_path_list,
+    load_codecs,
+    render_output_layout,
     convert_heic_file,
     convert_heic_to_jpeg,
     convert_multiple_heic_files
 )
+from schedule import prioritize, read_header
+from storage import LocalStorage, get_storage, is_mmap_safe
+from report import ReportWriter, read_report
+import audit
+from audit import AuditSampler, psnr, ssim
+from color import TransformCache, to_srgb
+from jobs import JOB_CANCELLED, JOB_DONE, JOB_QUEUED, Job, JobQueue
+from prefetch import Prefetcher
+from progress import ProgressEvent, ProgressKind, ProgressTracker
+from throttle import ConcurrencyTuner, LoadGovernor, TokenBucket, parse_cpu_list
+from tonemap import TRANSFER_PQ, to_8bit
+from verify import check_heif, check_jpeg, check_target
 
 
 class TestConverter(unittest.TestCase):
@@ -96,6 +131,32 @@ class TestConverter(unittest.TestCase):
         invalid_files = get_file_list(os.path.join(self.test_dir, "nonexistent"), True)
         self.assertEqual(len(invalid_files), 0)
 
+    def test_get_file_list_parallel(self):
+        """The parallel walk finds the same files, in the same order if asked; symlinks are only followed on request"""
+        for i in range(3):
+            nested = os.path.join(self.test_dir, f"subdir_{i}", "a", "b")
+            os.makedirs(nested)
+            with open(os.path.join(nested, f"nested_{i}.heic"), 'w') as f:
+                f.write("Nested HEIC file")
+        os.symlink(self.test_dir, os.path.join(self.test_dir, "subdir_0", "a", "loop"))
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        with open(os.path.join(outside, "linked.heic"), 'w') as f:
+            f.write("Linked HEIC file")
+        os.symlink(outside, os.path.join(self.test_dir, "linked"))
+        os.symlink(outside, os.path.join(self.test_dir, "subdir_1", "linked_again"))
+
+        # Like os.walk, symlinked directories are not entered by default
+        self.assertEqual(len(get_file_list(self.test_dir, True)), 6)
+        self.assertEqual(len(get_file_list(self.test_dir, True, workers=4)), 6)
+
+        # Followed, each target is walked once and the loop is never entered
+        sequential = get_file_list(self.test_dir, True, follow_symlinks=True)
+        self.assertEqual(len(sequential), 7)
+        self.assertEqual(get_file_list(self.test_dir, True, workers=4, follow_symlinks=True), sequential)
+        self.assertEqual(sorted(get_file_list(self.test_dir, True, workers=4, ordered=False, follow_symlinks=True)),
+                         sorted(sequential))
+
     @patch('converter.Image.open')
     @patch('converter.piexif.load')
     @patch('converter.piexif.dump')
@@ -131,7 +192,8 @@ class TestConverter(unittest.TestCase):
         )
 
         self.assertTrue(result)
-        callback.assert_called()
+        kinds = [call.args[0].kind for call in callback.call_args_list]
+        self.assertEqual(kinds, [ProgressKind.STARTED, ProgressKind.FINISHED])
         mock_image.save.assert_called_with(target_file, "jpeg", exif=b"new_exif", quality=95)
 
         # Test with invalid file
@@ -142,7 +204,7 @@ class TestConverter(unittest.TestCase):
         result = convert_heic_file(invalid_file, target_file, True, False, 95)
         self.assertFalse(result)
 
-    @patch('converter.convert_heic_file')
+    @patch('converter.Converter.convert_file')
     def test_convert_multiple_heic_files(self, mock_convert):
         """Test converting multiple HEIC files"""
         # Setup mock to return success for all conversions
@@ -178,7 +240,7 @@ class TestConverter(unittest.TestCase):
         # Callback should be called for each file
         self.assertEqual(callback.call_count, 0)  # It's passed through but not called directly
 
-    @patch('converter.convert_heic_file')
+    @patch('converter.Converter.convert_file')
     def test_convert_heic_to_jpeg(self, mock_convert):
         """Test the directory-based conversion function"""
         # Setup mock
@@ -212,5 +274,1135 @@ class TestConverter(unittest.TestCase):
         self.assertEqual(mock_convert.call_count, 0)  # We mocked get_file_list
 
 
+class TestProgress(unittest.TestCase):
+    """Tests for the progress event tracker"""
+
+    def test_events_are_coalesced(self):
+        """Events arriving faster than the rate limit are merged into the next delivery"""
+        delivered = []
+        clock = iter([0.0, 0.0, 0.01, 0.02, 0.5])
+        with patch('progress.time.monotonic', side_effect=lambda: next(clock)):
+            tracker = ProgressTracker(delivered.append, files_total=3, bytes_total=300, max_rate=10)
+            tracker(ProgressEvent(ProgressKind.FINISHED, "a.heic", "a.jpg", 100))
+            tracker(ProgressEvent(ProgressKind.FAILED, "b.heic", "b.jpg", 100))
+            tracker(ProgressEvent(ProgressKind.SKIPPED, "c.heic", "c.jpg", 100))
+        self.assertEqual(len(delivered), 1)
+
+        tracker.flush()
+        self.assertEqual(len(delivered), 2)
+        last = delivered[-1]
+        self.assertEqual(last.source, "c.heic")
+        self.assertEqual((last.files_done, last.files_failed, last.files_skipped), (3, 1, 1))
+        self.assertEqual(last.eta, 0)
+
+        tracker.flush()
+        self.assertEqual(len(delivered), 2)
+
+    def test_eta_is_weighted_by_bytes(self):
+        """The ETA is derived from the remaining bytes, not the remaining file count"""
+        delivered = []
+        clock = iter([0.0, 2.0])
+        with patch('progress.time.monotonic', side_effect=lambda: next(clock)):
+            tracker = ProgressTracker(delivered.append, files_total=2, bytes_total=1000, max_rate=0)
+            tracker(ProgressEvent(ProgressKind.FINISHED, "small.heic", "small.jpg", 100))
+
+        event = delivered[0]
+        self.assertAlmostEqual(event.files_per_second, 0.5)
+        self.assertAlmostEqual(event.megabytes_per_second, 50 / 1e6)
+        self.assertAlmostEqual(event.eta, 18.0)
+
+
+def make_heic_bytes(size=(64, 48), exif: bytes = None, icc_profile: bytes = None) -> bytes:
+    """Encode a small solid-colour image as HEIC"""
+    load_codecs()
+    buffer = io.BytesIO()
+    options = {"icc_profile": icc_profile} if icc_profile else {}
+    Image.new("RGB", size, (200, 80, 40)).save(buffer, "HEIF", quality=90, exif=exif, **options)
+    return buffer.getvalue()
+
+
+def make_display_p3_profile() -> bytes:
+    """Build a minimal ICC v2 matrix profile with the Display P3 primaries, adapted to D50"""
+    def xyz(x, y, z):
+        return b"XYZ \0\0\0\0" + struct.pack(">3i", *(round(v * 65536) for v in (x, y, z)))
+
+    description = b"Display P3 test"
+    tags = [
+        (b"desc", b"desc\0\0\0\0" + struct.pack(">I", len(description) + 1) + description + b"\0" +
+         b"\0" * 8 + b"\0" * 70),
+        (b"wtpt", xyz(0.9642, 1.0, 0.8249)),
+        (b"rXYZ", xyz(0.5151, 0.2412, -0.0011)),
+        (b"gXYZ", xyz(0.2919, 0.6922, 0.0419)),
+        (b"bXYZ", xyz(0.1572, 0.0666, 0.7841)),
+        # The three channels share one gamma 2.2 curve
+        (b"rTRC", b"curv\0\0\0\0" + struct.pack(">IH", 1, 0x0233) + b"\0\0"),
+    ]
+    tags += [(b"gTRC", tags[-1][1]), (b"bTRC", tags[-1][1])]
+    offset = 128 + 4 + 12 * len(tags)
+    table = struct.pack(">I", len(tags))
+    data = b""
+    for signature, content in tags:
+        table += signature + struct.pack(">II", offset + len(data), len(content))
+        data += content
+    size = offset + len(data)
+    header = (struct.pack(">I", size) + b"\0" * 4 + struct.pack(">I", 0x02100000) + b"mntrRGB XYZ " + b"\0" * 12 +
+              b"acsp" + b"\0" * 24 + struct.pack(">I", 0) + xyz(0.9642, 1.0, 0.8249)[8:] + b"\0" * 48)
+    return header + table + data
+
+
+class TestToneMapping(unittest.TestCase):
+    """Tests for the high bit-depth conversion"""
+
+    def test_dithering_keeps_fractional_levels(self):
+        """A flat area between two 8-bit levels averages to its true value instead of banding"""
+        value = int(round(100.25 * 257))
+        data = np.full((64, 64, 3), value, dtype=np.uint16)
+
+        for dither in ('ordered', 'blue-noise'):
+            out = to_8bit(data, tone_map='clip', dither=dither)
+            self.assertEqual(set(np.unique(out)), {100, 101})
+            self.assertAlmostEqual(out.mean(), 100.25, delta=0.05)
+
+        out = to_8bit(data, tone_map='clip', dither='none')
+        self.assertEqual(set(np.unique(out)), {100})
+
+    def test_sdr_is_unchanged_by_reinhard(self):
+        """Without highlights above SDR white the extended Reinhard curve is the identity"""
+        ramp = np.linspace(0, 65535, 256 * 4, dtype=np.uint16).reshape(4, 256, 1).repeat(3, axis=2)
+        out = to_8bit(ramp, tone_map='reinhard', dither='none')
+        np.testing.assert_allclose(out.astype(int), np.round(ramp / 257), atol=1)
+
+    def test_pq_highlights_are_compressed(self):
+        """PQ highlights are rolled off into range rather than clipped"""
+        codes = np.array([[[0.58, 0.58, 0.58], [0.75, 0.75, 0.75], [0.9, 0.9, 0.9]]]) * 65535
+        out = to_8bit(codes.astype(np.uint16), {"transfer_characteristics": TRANSFER_PQ}, 'reinhard', 'none')
+        levels = out[0, :, 0]
+        self.assertTrue(levels[0] < levels[1] < levels[2] == 255)
+
+    def test_convert_10_bit_heic(self):
+        """A 10-bit HEIC is tone mapped into an 8-bit JPEG"""
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        source = os.path.join(test_dir, "hdr.heic")
+        gradient = np.linspace(0, 65535, 128 * 3, dtype=np.uint16).reshape(1, 128, 3).repeat(64, axis=0)
+        pillow_heif.from_bytes("RGB;16", (128, 64), gradient.tobytes()).save(source, quality=90)
+
+        target = os.path.join(test_dir, "hdr.jpg")
+        converter = Converter(tone_map='hable', dither='blue-noise')
+        self.assertTrue(converter.convert_file(source, target))
+        with Image.open(target) as image:
+            self.assertEqual((image.mode, image.size), ("RGB", (128, 64)))
+
+        # A second image of the same size is tone mapped into the pooled buffer of the first
+        self.assertTrue(converter.convert_file(source, os.path.join(test_dir, "hdr2.jpg")))
+        self.assertEqual((converter._buffer_pool.allocations, converter._buffer_pool.reuses), (1, 1))
+        converter.close()
+        self.assertEqual(converter._buffer_pool.held_bytes, 0)
+
+    def test_to_8bit_rgbx(self):
+        """RGB data can be written into a four-channel buffer, which Pillow maps as RGBX without a copy"""
+        data = np.full((4, 8, 3), 65535, dtype=np.uint16)
+        out = np.zeros((4, 8, 4), dtype=np.uint8)
+        self.assertIs(to_8bit(data, None, 'clip', 'none', out=out), out)
+        self.assertTrue((out == 255).all())
+        with self.assertRaises(ValueError):
+            to_8bit(data, None, 'clip', 'none', out=np.zeros((4, 8, 2), dtype=np.uint8))
+
+    def test_buffer_pool(self):
+        """The pool reuses buffers by size and mode, evicts the least recently used and empties when idle"""
+        pool = BufferPool(max_bytes=2 * 100 * 100 * 3, idle_seconds=0.05)
+        first = pool.acquire(100, 100, "RGB")
+        pool.release(first)
+        self.assertIs(pool.acquire(100, 100, "RGB"), first)
+        self.assertEqual(pool.acquire(100, 100, "RGBA").shape, (100, 100, 4))
+        self.assertEqual((pool.allocations, pool.reuses), (2, 1))
+
+        pool.release(first)
+        pool.release(np.empty((100, 100, 3), dtype=np.uint8))
+        pool.release(np.empty((50, 100, 3), dtype=np.uint8))
+        # The least recently used size made room for the new one
+        self.assertEqual(pool.held_bytes, 100 * 100 * 3 + 50 * 100 * 3)
+
+        for _ in range(100):
+            if not pool.held_bytes:
+                break
+            time.sleep(0.01)
+        self.assertEqual(pool.held_bytes, 0)
+
+    def test_buffer_pools_share_block_cache(self):
+        """Pools running side by side restore Pillow's cache limit only when the last one is cleared"""
+        blocks_max = Image.core.get_blocks_max()
+        first = BufferPool(max_bytes=16 * Image.core.get_block_size())
+        second = BufferPool(max_bytes=8 * Image.core.get_block_size())
+        self.addCleanup(first.clear)
+        self.addCleanup(second.clear)
+        first.begin()
+        second.begin()
+        self.assertEqual(Image.core.get_blocks_max(), max(16, blocks_max))
+        first.end()
+        second.end()
+        first.clear()
+        self.assertEqual(Image.core.get_blocks_max(), max(16, blocks_max))
+        second.clear()
+        self.assertEqual(Image.core.get_blocks_max(), blocks_max)
+        self.assertEqual(Image.core.get_stats()["blocks_cached"], 0)
+
+
+class TestConverterObject(unittest.TestCase):
+    """Tests for the reusable Converter"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.addCleanup(shutil.rmtree, self.target_dir)
+
+        # The same file name in several folders, so flattened targets collide
+        self.sources = []
+        heic = make_heic_bytes()
+        for i in range(4):
+            subdir = os.path.join(self.test_dir, f"day_{i}")
+            os.makedirs(subdir)
+            source = os.path.join(subdir, "IMG_0001.heic")
+            with open(source, "wb") as f:
+                f.write(heic)
+            self.sources.append(source)
+
+    def test_parallel_unique_names(self):
+        """Parallel workers never pick the same unique target name"""
+        with Converter(self.target_dir, generate_unique=True, jobs=4) as converter:
+            converted = converter.convert_files(self.sources)
+
+        self.assertEqual(len(set(converted)), 4)
+        self.assertEqual(sorted(os.listdir(self.target_dir)),
+                         ["IMG_0001(1).jpg", "IMG_0001(2).jpg", "IMG_0001(3).jpg", "IMG_0001.jpg"])
+
+    def test_balance_decode_threads(self):
+        """Cores go to parallel images first, and to tiles within an image only if it has them"""
+        twelve_mp = [4032 * 3024] * 8
+        self.assertEqual(balance_decode_threads(4, 1000, twelve_mp, cpu_count=16), (4, 4))
+        self.assertEqual(balance_decode_threads(16, 1000, twelve_mp, cpu_count=16), (16, 1))
+
+        # Two panoramas cannot keep eight workers busy, so they get the cores as decode threads
+        self.assertEqual(balance_decode_threads(8, 2, [20000 * 5000] * 2, cpu_count=16), (2, 8))
+
+        # Images of a single tile gain nothing from extra threads
+        self.assertEqual(balance_decode_threads(2, 100, [500 * 400] * 8, cpu_count=16), (2, 1))
+
+        # Streams of unknown length do not limit the parallel images
+        self.assertEqual(balance_decode_threads(12, None, twelve_mp, cpu_count=16), (12, 1))
+
+    def test_decode_threads_auto_stream(self):
+        """Streamed trees and lists run all requested jobs, not just as many as the files sampled for the headers"""
+        heic = make_heic_bytes()
+        stream_dir = os.path.join(self.test_dir, "stream")
+        os.makedirs(stream_dir)
+        sources = []
+        for i in range(DECODE_THREADS_SAMPLE + 2):
+            sources.append(os.path.join(stream_dir, f"IMG_{i}.heic"))
+            with open(sources[-1], "wb") as f:
+                f.write(heic)
+        jobs = DECODE_THREADS_SAMPLE + 4
+
+        with Converter(os.path.join(self.target_dir, "tree"), jobs=jobs, decode_threads='auto') as converter, \
+                patch.object(converter, "_run_batch", wraps=converter._run_batch) as run_batch:
+            self.assertEqual(sum(1 for _ in converter.iter_tree(stream_dir)), len(sources))
+        self.assertEqual(run_batch.call_args.args[3], jobs)
+
+        with Converter(os.path.join(self.target_dir, "list"), jobs=jobs, decode_threads='auto') as converter, \
+                patch.object(converter, "_run_batch", wraps=converter._run_batch) as run_batch:
+            self.assertEqual(converter.convert_stream(iter(sources)), len(sources))
+            self.assertEqual(run_batch.call_args.args[3], jobs)
+            # A stream that ends within the sample has a known length
+            self.assertEqual(converter.convert_stream(iter(sources[:2])), 0)
+            self.assertEqual(run_batch.call_args.args[3], 2)
+
+    def test_sample_pixel_counts(self):
+        """The image sizes for the decode threads come from the headers, without decoding or downloading the files"""
+        with open(self.sources[0], "ab") as f:
+            f.write(b"\0" * 1024 * 1024)
+        reads = []
+        open_file = LocalStorage.open
+
+        def counting_open(storage, path, mode="rb"):
+            f = open_file(storage, path, mode)
+            read = f.read
+            f.read = lambda size=-1: reads.append(read(size)) or reads[-1]
+            return f
+
+        with patch("pillow_heif.open_heif", side_effect=AssertionError), \
+                patch.object(LocalStorage, "open", counting_open):
+            self.assertEqual(_sample_pixel_counts(self.sources), [64 * 64] * 4)
+        self.assertLessEqual(max(len(data) for data in reads), 64 * 1024)
+
+    def test_report(self):
+        """The report tells converted, skipped and failed files apart, with full target paths"""
+        broken = os.path.join(self.test_dir, "broken.heic")
+        with open(broken, "wb") as f:
+            f.write(b"not an image")
+
+        report_path = os.path.join(self.target_dir, "report.jsonl")
+        with ReportWriter(report_path) as report, \
+                Converter(self.target_dir, report=report, jobs=2) as converter:
+            converter.convert_tree(self.test_dir)
+            converter.convert_file(self.sources[0], os.path.join(self.target_dir, "day_0", "IMG_0001.jpg"))
+
+        records = read_report(report_path)
+        files, summary = records[:-1], records[-1]
+        converted = [record for record in files if record["status"] == "finished"]
+        self.assertEqual(sorted(record["target"] for record in converted),
+                         sorted(os.path.join(self.target_dir, f"day_{i}", "IMG_0001.jpg") for i in range(4)))
+        for record in converted:
+            self.assertEqual((record["width"], record["height"]), (64, 48))
+            self.assertEqual(record["output_bytes"], os.path.getsize(record["target"]))
+            self.assertGreater(record["input_bytes"], 0)
+
+        failed = [record for record in files if record["status"] == "failed"]
+        self.assertEqual([record["source"] for record in failed], [broken])
+        self.assertEqual(failed[0]["error_class"], "UnidentifiedImageError")
+
+        self.assertEqual(summary["type"], "summary")
+        self.assertEqual((summary["files"], summary["finished"], summary["failed"], summary["skipped"]), (6, 4, 1, 1))
+        self.assertEqual(summary["output_bytes"], sum(record["output_bytes"] for record in converted))
+
+    def test_mmap_input(self):
+        """Mapped sources convert like read ones and the mapping is released after decoding"""
+        storage = get_storage(self.sources[0])
+        mappings = []
+
+        def recording_map(path):
+            mapping = type(storage).map(storage, path)
+            mappings.append(mapping)
+            return mapping
+
+        with patch.object(storage, "map", side_effect=recording_map):
+            with Converter(self.target_dir, mmap_input=True) as converter:
+                converted = converter.convert_files(self.sources[:2])
+
+        self.assertEqual(len(converted), 1)  # same target name, the second one is skipped
+        self.assertEqual(len(mappings), 1)
+        self.assertTrue(mappings[0].closed)
+        with Image.open(converted[0]) as image:
+            self.assertEqual(image.size, (64, 48))
+
+    @patch("storage._mount_table", return_value=[("/", "ext4"), ("/mnt/share", "nfs4")])
+    def test_mmap_safety(self, _):
+        """Files on network mounts are read instead of mapped"""
+        self.assertTrue(is_mmap_safe("/home/user/a.heic"))
+        self.assertTrue(is_mmap_safe("/mnt/shared/a.heic"))
+        self.assertFalse(is_mmap_safe("/mnt/share/a.heic"))
+
+    def test_reuse_between_calls(self):
+        """The worker pool survives between calls and is shut down on close"""
+        converter = Converter(self.target_dir, preserve_folder_structure=True, jobs=2)
+        with converter:
+            first = converter.convert_tree(self.test_dir)
+            executor = converter._executor
+            second = converter.convert_tree(self.test_dir)
+            self.assertIs(converter._executor, executor)
+
+        self.assertEqual(len(first), 4)
+        self.assertEqual(second, [])  # targets exist and overwrite is off
+        self.assertIsNone(converter._executor)
+        self.assertTrue(os.path.isfile(os.path.join(self.target_dir, "day_2", "IMG_0001.jpg")))
+
+    @patch("converter.PATH_LIST_CHUNK", 7)
+    def test_iter_path_list(self):
+        """Path lists are split on NUL or newlines, also across chunk boundaries"""
+        paths = ["/photos/a b.heic", "/photos/sub/IMG_0001.heic", "/photos/c.heic"]
+        self.assertEqual(list(iter_path_list(io.BytesIO("\0".join(paths).encode() + b"\0"))), paths)
+        self.assertEqual(list(iter_path_list(io.BytesIO("\r\n".join(paths).encode() + b"\n\n"))), paths)
+        self.assertEqual(list(iter_path_list(io.BytesIO(b""))), [])
+
+    def test_convert_stream(self):
+        """A streamed list is converted while it is read, skipping what is not a HEIC file"""
+        consumed = []
+        finished_while_reading = []
+
+        def file_list():
+            for source in self.sources + ["/missing.heic", os.path.join(self.test_dir, "x.txt")]:
+                consumed.append(source)
+                yield source
+
+        def on_progress(event):
+            if event.kind is ProgressKind.FINISHED:
+                finished_while_reading.append(len(consumed) < 6)
+
+        with Converter(self.target_dir, generate_unique=True, progress_callback=on_progress,
+                       progress_rate=0, prefetch='off', prefetch_depth=1) as converter:
+            converted = converter.convert_stream(file_list())
+
+        self.assertEqual(converted, 4)
+        self.assertEqual(len(os.listdir(self.target_dir)), 4)
+        self.assertTrue(finished_while_reading[0])
+
+    def test_buffer_pool_releases_block_cache(self):
+        """Pillow's block cache is emptied after idle 8-bit conversions too, and its previous limit restored"""
+        blocks_max = Image.core.get_blocks_max()
+        converter = Converter(self.target_dir)
+        converter._buffer_pool.idle_seconds = 0.1
+        self.assertTrue(converter.convert_file(self.sources[0]))
+        self.assertGreater(Image.core.get_blocks_max(), blocks_max)
+        for _ in range(100):
+            if Image.core.get_blocks_max() == blocks_max:
+                break
+            time.sleep(0.01)
+        self.assertEqual(Image.core.get_blocks_max(), blocks_max)
+        self.assertEqual(Image.core.get_stats()["blocks_cached"], 0)
+        self.assertIsNone(converter._buffer_pool._timer)
+
+        # Used again, the cache comes back until the converter is closed
+        self.assertTrue(converter.convert_file(self.sources[1], os.path.join(self.target_dir, "again.jpg")))
+        self.assertGreater(Image.core.get_blocks_max(), blocks_max)
+        converter.close()
+        self.assertEqual(Image.core.get_blocks_max(), blocks_max)
+
+        # One-shot conversions leave the allocator alone
+        self.assertTrue(convert_heic_file(self.sources[2], os.path.join(self.target_dir, "single.jpg"), False, False,
+                                          90))
+        self.assertEqual(Image.core.get_blocks_max(), blocks_max)
+
+    def test_large_images_one_at_a_time(self):
+        """Images above the pixel threshold of their header are converted one at a time"""
+        with Converter(self.target_dir, generate_unique=True, jobs=4, large_pixels=1000) as converter:
+            converter._large_lock = MagicMock(wraps=threading.Lock())
+            self.assertEqual(len(converter.convert_files(self.sources)), 4)
+        self.assertEqual(converter._large_lock.acquire.call_count, 4)
+        self.assertEqual(converter._large_lock.release.call_count, 4)
+
+        with Converter(self.target_dir, overwrite=True, jobs=2, large_pixels=64 * 64) as converter:
+            converter._large_lock = MagicMock(wraps=threading.Lock())
+            self.assertTrue(converter.convert_file(self.sources[0]))
+        converter._large_lock.acquire.assert_not_called()
+
+        # A single worker has nobody to wait for and does not read the header at all
+        with Converter(self.target_dir, overwrite=True, large_pixels=1000) as converter, \
+                patch.object(converter, "_header_pixels", side_effect=AssertionError):
+            self.assertTrue(converter.convert_file(self.sources[0]))
+
+    def test_iter_tree(self):
+        """Files are converted while the tree is scanned, and the total is known once the scan is done"""
+        totals = []
+
+        def on_progress(event):
+            if event.kind is ProgressKind.FINISHED:
+                totals.append(event.files_total)
+
+        with Converter(self.target_dir, progress_callback=on_progress, progress_rate=0, prefetch='off',
+                       prefetch_depth=1) as converter:
+            results = list(converter.iter_tree(self.test_dir))
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result.kind is ProgressKind.FINISHED for result in results))
+        self.assertEqual(sorted(result.source for result in results), sorted(self.sources))
+        self.assertIsNone(totals[0])
+        self.assertEqual(totals[-1], 4)
+        for i in range(4):
+            self.assertTrue(os.path.exists(os.path.join(self.target_dir, f"day_{i}", "IMG_0001.jpg")))
+
+    def test_iter_convert_closed_early(self):
+        """Closing the generator stops the batch after the files in flight"""
+        flat = os.path.join(self.test_dir, "flat")
+        os.makedirs(flat)
+        for i in range(12):
+            shutil.copy(self.sources[0], os.path.join(flat, f"IMG_{i:04}.heic"))
+
+        results = iter_convert(flat, target=self.target_dir)
+        first = next(results)
+        results.close()
+
+        self.assertIs(first.kind, ProgressKind.FINISHED)
+        self.assertLess(len(os.listdir(self.target_dir)), 12)
+
+    def test_output_layout(self):
+        """Targets are placed by capture date, or modification time, in directories created once"""
+        exif = piexif.dump({"0th": {}, "Exif": {piexif.ExifIFD.DateTimeOriginal: "2021:05:06 07:08:09"}})
+        sources = os.path.join(self.test_dir, "dated")
+        os.makedirs(sources)
+        for name, data in (("a.heic", make_heic_bytes(exif=exif)), ("b.heic", make_heic_bytes(exif=exif)),
+                           ("c.heic", make_heic_bytes())):
+            with open(os.path.join(sources, name), "wb") as f:
+                f.write(data)
+        mtime = datetime(2020, 1, 2, 12).timestamp()
+        os.utime(os.path.join(sources, "c.heic"), (mtime, mtime))
+
+        with patch.object(LocalStorage, "makedirs", autospec=True,
+                          side_effect=lambda storage, path: os.makedirs(path, exist_ok=True)) as makedirs:
+            converter = Converter(self.target_dir, output_layout="{year}/{month}/{day}/{name}.jpg")
+            converted = converter.convert_tree(sources)
+
+        self.assertEqual(len(converted), 3)
+        for path in ("2021/05/06/a.jpg", "2021/05/06/b.jpg", "2020/01/02/c.jpg"):
+            self.assertTrue(os.path.isfile(os.path.join(self.target_dir, *path.split("/"))), path)
+        self.assertEqual(makedirs.call_count, 2)
+
+        # A single file given to the CLI is placed by the layout as well
+        import heicConverter
+        argv = ["heicConverter.py", "--path", os.path.join(sources, "c.heic"),
+                "-t", os.path.join(self.target_dir, "cli"), "--output-layout", "{year}/{name}.jpg", "--skip-prompt"]
+        with patch.object(sys, "argv", argv), patch("builtins.print"):
+            heicConverter.main()
+        self.assertTrue(os.path.isfile(os.path.join(self.target_dir, "cli", "2020", "c.jpg")))
+
+        self.assertEqual(render_output_layout("{year}-{month}/{hour}{minute}_{name}.jpg", "IMG",
+                                              datetime(2024, 3, 4, 5, 6)), "2024-03/0506_IMG.jpg")
+        for template in ("{yr}/{name}.jpg", "/{name}.jpg", "{year}/../{name}.jpg", "{year}/"):
+            with self.assertRaises(ValueError):
+                Converter(self.target_dir, output_layout=template)
+
+
+    def test_jpeg_to_heic(self):
+        """The reverse direction compacts JPEG files into HEIC, keeping EXIF and applying the orientation"""
+        exif = piexif.dump({"0th": {piexif.ImageIFD.Make: b"Camera", piexif.ImageIFD.Orientation: 6},
+                            "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2020:01:02 03:04:05"}})
+        Image.new("RGB", (64, 48), (30, 120, 200)).save(os.path.join(self.test_dir, "day_0", "photo.jpg"),
+                                                         quality=95, exif=exif)
+
+        with Converter(self.target_dir, output_format='heic', quality=60, encoder_speed='fastest') as converter:
+            converted = converter.convert_tree(self.test_dir)
+
+        self.assertEqual(converted, [os.path.join(self.target_dir, "day_0", "photo.heic")])
+        self.assertGreater(converter.input_bytes, 0)
+        self.assertGreater(converter.output_bytes, 0)
+        with Image.open(converted[0]) as image:
+            self.assertEqual((image.format, image.size), ("HEIF", (48, 64)))
+            exif_dict = piexif.load(image.info["exif"])
+        self.assertEqual(exif_dict["0th"][piexif.ImageIFD.Make], b"Camera")
+        self.assertEqual(exif_dict["0th"][piexif.ImageIFD.Orientation], 1)
+        self.assertEqual(exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal], b"2020:01:02 03:04:05")
+
+        with self.assertRaises(ValueError):
+            Converter(output_format='png')
+
+
+    def test_max_bytes(self):
+        """Targets stay below the size limit, and later files start from the quality found before"""
+        rng = np.random.default_rng(0)
+        noise = Image.fromarray(rng.integers(0, 256, size=(96, 128, 3), dtype=np.uint8))
+        for i in range(2):
+            buffer = io.BytesIO()
+            noise.save(buffer, "HEIF", quality=90)
+            with open(os.path.join(self.test_dir, f"noise_{i}.heic"), "wb") as f:
+                f.write(buffer.getvalue())
+
+        converter = Converter(self.target_dir, max_bytes=12000)
+        save = Image.Image.save
+        with patch.object(Image.Image, "save", autospec=True, side_effect=save) as image_save:
+            self.assertTrue(converter.convert_file(os.path.join(self.test_dir, "noise_0.heic")))
+            first_encodes = image_save.call_count
+            image_save.reset_mock()
+            self.assertTrue(converter.convert_file(os.path.join(self.test_dir, "noise_1.heic")))
+
+        self.assertGreater(first_encodes, 2)
+        self.assertLessEqual(image_save.call_count, 2)
+        quality = converter._quality_history[0]
+        self.assertLess(quality, 95)
+        for i in range(2):
+            self.assertLessEqual(os.path.getsize(os.path.join(self.target_dir, f"noise_{i}.jpg")), 12000)
+
+        self.assertFalse(Converter(self.target_dir, overwrite=True, max_bytes=100).convert_file(
+            os.path.join(self.test_dir, "noise_0.heic")))
+
+
+class TestFileFilter(unittest.TestCase):
+    """Tests for the scan filters"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        for relative_path, size in [
+            ("a.heic", 10), ("b.HEIF", 2000), ("c.hif", 10), ("d.jpg", 10),
+            ("trip/e.heic", 10), ("trip/raw/f.heic", 10), ("@eaDir/a.heic", 10),
+        ]:
+            path = os.path.join(self.test_dir, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"x" * size)
+
+    def scan(self, **kwargs):
+        files = get_file_list(self.test_dir, True, FileFilter(**kwargs))
+        return sorted(os.path.relpath(os.path.join(root, name), self.test_dir).replace(os.sep, "/")
+                      for root, name in files)
+
+    def test_all_heif_extensions(self):
+        """All HEIF extensions are found in any case, and default excludes skip NAS folders"""
+        self.assertEqual(self.scan(exclude=DEFAULT_EXCLUDES),
+                         ["a.heic", "b.HEIF", "c.hif", "trip/e.heic", "trip/raw/f.heic"])
+
+    def test_excluded_directories_are_pruned(self):
+        """Excluded directories are not listed at all"""
+        listed = []
+        real_scandir = os.scandir
+
+        def recording_scandir(path):
+            listed.append(os.path.relpath(path, self.test_dir))
+            return real_scandir(path)
+
+        with patch("storage.os.scandir", side_effect=recording_scandir):
+            files = self.scan(exclude=["raw", "@eaDir"])
+
+        self.assertEqual(files, ["a.heic", "b.HEIF", "c.hif", "trip/e.heic"])
+        self.assertEqual(sorted(listed), [".", "trip"])
+
+    def test_include_relative_path_and_size(self):
+        """Include globs match relative paths, sizes bound the selection"""
+        self.assertEqual(self.scan(include=["trip/*"]), ["trip/e.heic", "trip/raw/f.heic"])
+        self.assertEqual(self.scan(min_size=1000), ["b.HEIF"])
+        self.assertEqual(self.scan(max_size=100, exclude=["trip", "@eaDir"]), ["a.heic", "c.hif"])
+
+    def test_newer_than(self):
+        """Only files modified after the date are selected"""
+        old = os.path.join(self.test_dir, "a.heic")
+        os.utime(old, (946684800, 946684800))  # 2000-01-01
+        files = self.scan(newer_than=datetime(2010, 1, 1))
+        self.assertNotIn("a.heic", files)
+        self.assertIn("c.hif", files)
+
+
+class TestThrottle(unittest.TestCase):
+    """Tests for the resource limits"""
+
+    @patch('throttle.time.sleep')
+    @patch('throttle.time.monotonic', return_value=100.0)
+    def test_token_bucket(self, monotonic, sleep):
+        """A full second of tokens passes at once, beyond that consumers wait for the refill"""
+        bucket = TokenBucket(1000)
+        bucket.consume(1000)
+        sleep.assert_not_called()
+
+        bucket.consume(500)
+        sleep.assert_called_once_with(0.5)
+
+        # Half a second later the debt is paid, another 250 bytes wait a quarter second
+        monotonic.return_value = 100.5
+        bucket.consume(250)
+        self.assertEqual(sleep.call_args.args[0], 0.25)
+
+    @patch('throttle.time.sleep')
+    @patch('throttle.os.getloadavg', create=True, side_effect=[(9.0, 0, 0), (5.0, 0, 0), (1.5, 0, 0)])
+    def test_load_governor(self, getloadavg, sleep):
+        """Dispatching waits until the load average drops below the threshold"""
+        LoadGovernor(2.0, poll_interval=1.0).wait()
+        self.assertEqual(getloadavg.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_parse_cpu_list(self):
+        """CPU lists and hexadecimal masks select the same CPUs"""
+        self.assertEqual(parse_cpu_list("0-2,5"), [0, 1, 2, 5])
+        self.assertEqual(parse_cpu_list("0x27"), [0, 1, 2, 5])
+        with self.assertRaises(ValueError):
+            parse_cpu_list("0x0")
+
+    def test_throttled_conversion(self):
+        """Source and target bytes pass through the buckets"""
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        source = os.path.join(test_dir, "image.heic")
+        heic = make_heic_bytes()
+        with open(source, "wb") as f:
+            f.write(heic)
+
+        converter = Converter(test_dir, max_read_mbps=100, max_write_mbps=100)
+        with patch.object(converter._read_bucket, 'consume') as read, \
+                patch.object(converter._write_bucket, 'consume') as write:
+            self.assertTrue(converter.convert_file(source))
+
+        target = os.path.join(test_dir, "image.jpg")
+        self.assertEqual(sum(call.args[0] for call in read.call_args_list), len(heic))
+        self.assertEqual(sum(call.args[0] for call in write.call_args_list), os.path.getsize(target))
+        with Image.open(target) as image:
+            self.assertEqual(image.size, (64, 48))
+
+    def run_tuner(self, tuner, megabytes_per_second, clock, windows=20):
+        """Feed a tuner windows of files at the throughput that megabytes_per_second gives for its limit"""
+        for _ in range(windows):
+            files = 2 * tuner.limit
+            for _ in range(files - 1):
+                tuner.record(0)
+            clock[0] += tuner.interval
+            tuner.record(int(megabytes_per_second(tuner.limit) * tuner.interval * 1e6))
+
+    def test_concurrency_tuner(self):
+        """The tuner climbs to the fastest setting and backs off under memory pressure"""
+        clock = [0.0]
+        # Faster up to 6 jobs, slower beyond as the jobs compete for memory bandwidth
+        throughput = lambda jobs: min(jobs, 6) - 0.5 * max(0, jobs - 6)
+        with patch("throttle.time.monotonic", lambda: clock[0]), patch("throttle.cpu_times", return_value=None), \
+                patch("throttle.memory_available", return_value=0.5), patch("builtins.print") as output:
+            tuner = ConcurrencyTuner(16)
+            self.run_tuner(tuner, throughput, clock)
+            self.assertTrue(tuner.settled)
+            self.assertEqual(tuner.limit, 6)
+            self.assertIn("--jobs 6", output.call_args.args[0])
+
+            with patch("throttle.memory_available", return_value=0.05):
+                self.run_tuner(tuner, throughput, clock, windows=1)
+            self.assertEqual(tuner.limit, 5)
+            self.assertEqual(tuner.maximum, 5)
+
+
+class TestSchedule(unittest.TestCase):
+    """Tests for the batch ordering policies"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+
+    def write(self, name, size, taken=None, mtime=None):
+        exif = None
+        if taken:
+            exif = piexif.dump({"0th": {}, "Exif": {piexif.ExifIFD.DateTimeOriginal: taken}})
+        path = os.path.join(self.test_dir, name)
+        with open(path, "wb") as f:
+            f.write(make_heic_bytes(size, exif))
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def candidates(self, paths):
+        return [(path, os.stat(path), os.path.basename(path)) for path in paths]
+
+    def test_read_header(self):
+        """Size and capture time come from the boxes, without decoding"""
+        path = self.write("a.heic", (640, 480), "2021:05:06 07:08:09")
+        with open(path, "rb") as f:
+            header = read_header(f)
+        self.assertGreaterEqual(header.pixels, 640 * 480)
+        self.assertEqual(datetime.fromtimestamp(header.taken), datetime(2021, 5, 6, 7, 8, 9))
+
+    def test_largest_first(self):
+        """The largest images are converted first"""
+        paths = [self.write("small.heic", (64, 48)), self.write("large.heic", (1024, 768)),
+                 self.write("medium.heic", (320, 240))]
+        self.assertEqual(list(prioritize(self.candidates(paths), "largest-first")),
+                         ["large.heic", "medium.heic", "small.heic"])
+        self.assertEqual(list(prioritize(self.candidates(paths), "walk")),
+                         ["small.heic", "large.heic", "medium.heic"])
+
+    def test_newest_first(self):
+        """Capture time wins over modification time, which is the fallback"""
+        paths = [self.write("old_shot.heic", (64, 48), "2015:01:01 00:00:00", mtime=1700000000),
+                 self.write("no_exif.heic", (64, 48), mtime=1600000000),
+                 self.write("new_shot.heic", (64, 48), "2024:01:01 00:00:00", mtime=1500000000)]
+        self.assertEqual(list(prioritize(self.candidates(paths), "newest-first")),
+                         ["new_shot.heic", "no_exif.heic", "old_shot.heic"])
+
+
+class TestStartup(unittest.TestCase):
+    """Start-up cost of the entry points, measured with python -X importtime"""
+
+    # Cumulative import time budget of an entry point in microseconds, generous for slow CI machines
+    BUDGET_US = 300_000
+    HEAVY_MODULES = ("PIL", "pillow_heif", "piexif", "numpy", "tqdm")
+
+    def import_times(self, module):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            times[name.strip()] = int(cumulative)
+        return times
+
+    def check_entry_point(self, module):
+        times = self.import_times(module)
+        heavy = [name for name in times if name.split(".")[0] in self.HEAVY_MODULES]
+        self.assertEqual(heavy, [], f"{module} imports codecs at start-up")
+        self.assertLess(times[module], self.BUDGET_US)
+
+    def test_cli_startup(self):
+        """The CLI loads no codec before the first conversion"""
+        self.check_entry_point("heicConverter")
+
+    def test_gui_startup(self):
+        """The GUI window comes up without loading any codec"""
+        try:
+            import tkinter  # noqa: F401
+        except ImportError:
+            self.skipTest("tkinter is not available")
+        self.check_entry_point("heicConverterGui")
+
+    def test_codecs_load_on_demand(self):
+        """The codec modules are still reachable as attributes of the converter module"""
+        import converter
+        self.assertIs(converter.Image, PIL.Image)
+        self.assertIs(converter.pillow_heif, pillow_heif)
+
+
+class TestPrefetch(unittest.TestCase):
+    """Tests for the read-ahead of sources"""
+
+    def setUp(self):
+        self.plan = [(f"/photos/{i}.heic", f"/jpeg/{i}.jpg") for i in range(10)]
+
+    def test_read_ahead(self):
+        """Every file comes with its content, in plan order, counted as hit or miss"""
+        prefetcher = Prefetcher("read", depth=3, reader=lambda source: source.encode())
+        items = list(prefetcher.iterate(self.plan))
+
+        self.assertEqual([(source, target) for source, target, _ in items], self.plan)
+        self.assertEqual([data for _, _, data in items], [source.encode() for source, _ in self.plan])
+        self.assertEqual(prefetcher.hits + prefetcher.misses, 10)
+
+    def test_budget_still_feeds_current_file(self):
+        """A budget smaller than a file limits the read-ahead, but never stalls the plan"""
+        prefetcher = Prefetcher("read", depth=3, byte_budget=1, reader=lambda source: b"x" * 100)
+        self.assertEqual(len([data for _, _, data in prefetcher.iterate(self.plan) if data]), 10)
+
+    def test_failed_reads_fall_back(self):
+        """A failed read-ahead hands the file to the regular read path"""
+        def reader(source):
+            raise OSError("connection reset")
+
+        prefetcher = Prefetcher("read", reader=reader)
+        self.assertEqual([data for _, _, data in prefetcher.iterate(self.plan[:2])], [None, None])
+        self.assertEqual(prefetcher.errors, 2)
+
+    @patch("prefetch.is_network_path", side_effect=lambda path: path.startswith("/mnt/nas"))
+    def test_auto_mode(self, _):
+        """Auto reads ahead from network mounts and object storage, not from local disks"""
+        prefetcher = Prefetcher("auto")
+        self.assertIsNone(prefetcher.mode_for("/home/user/a.heic"))
+        self.assertEqual(prefetcher.mode_for("/mnt/nas/a.heic"), "read")
+        self.assertEqual(prefetcher.mode_for("memory://photos/a.heic"), "read")
+        self.assertIsNone(Prefetcher("off").mode_for("memory://photos/a.heic"))
+
+
+class TestRemoteStorage(unittest.TestCase):
+    """Tests for converting from and to fsspec URLs"""
+
+    def setUp(self):
+        fsspec = self._import_or_skip("fsspec")
+        self.fs = fsspec.filesystem("memory")
+        self.root = f"memory://{uuid.uuid4().hex}"
+        self.fs.makedirs(f"{self.root}/src/sub", exist_ok=True)
+        self.fs.pipe_file(f"{self.root}/src/a.heic", make_heic_bytes())
+        self.fs.pipe_file(f"{self.root}/src/sub/b.heic", make_heic_bytes())
+        self.fs.pipe_file(f"{self.root}/src/notes.txt", b"not an image")
+
+    def tearDown(self):
+        self.fs.rm(self.root, recursive=True)
+
+    def _import_or_skip(self, name):
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            self.skipTest(f"{name} is not installed")
+
+    def test_get_file_list_memory(self):
+        """Listing a memory:// tree finds the HEIC files only"""
+        files = get_file_list(f"{self.root}/src", True)
+        self.assertEqual(sorted(name for _, name in files), ["a.heic", "b.heic"])
+
+        files = get_file_list(f"{self.root}/src", False)
+        self.assertEqual([name for _, name in files], ["a.heic"])
+
+    def test_convert_tree_memory_to_memory(self):
+        """A tree on memory:// is converted into another memory:// tree"""
+        target = f"{self.root}/out"
+        converted = convert_heic_to_jpeg(f"{self.root}/src", True, False, False, 90, target)
+
+        self.assertEqual(sorted(converted), ["a.jpg", "b.jpg"])
+        self.assertTrue(self.fs.isfile(f"{target}/sub/b.jpg"))
+        with Image.open(io.BytesIO(self.fs.cat_file(f"{target}/a.jpg"))) as image:
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(image.size, (64, 48))
+
+    def test_convert_memory_to_local(self):
+        """Remote sources can be converted into a local directory and removed afterwards"""
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+
+        converted = convert_multiple_heic_files([f"{self.root}/src/a.heic"], False, True, 90, target_dir)
+
+        self.assertEqual(converted, ["a.jpg"])
+        self.assertTrue(os.path.isfile(os.path.join(target_dir, "a.jpg")))
+        self.assertFalse(self.fs.exists(f"{self.root}/src/a.heic"))
+
+    def test_convert_s3(self):
+        """Conversion works against an S3-compatible store served by moto"""
+        self._import_or_skip("s3fs")
+        moto_server = self._import_or_skip("moto.server")
+        import s3fs
+        from fsspec import config as fsspec_config
+
+        server = moto_server.ThreadedMotoServer(port=0, verbose=False)
+        server.start()
+        self.addCleanup(server.stop)
+        host, port = server.get_host_and_port()
+        endpoint = f"http://{host}:{port}"
+
+        credentials = {"AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test", "AWS_DEFAULT_REGION": "us-east-1"}
+        with patch.dict(os.environ, credentials), \
+                patch.dict(fsspec_config.conf, {"s3": {"endpoint_url": endpoint, "skip_instance_cache": True}}):
+            fs = s3fs.S3FileSystem(endpoint_url=endpoint, skip_instance_cache=True)
+            fs.mkdir("photos")
+            fs.pipe_file("photos/src/a.heic", make_heic_bytes())
+
+            converted = convert_heic_to_jpeg("s3://photos/src", True, False, False, 90, "s3://photos/out")
+
+            self.assertEqual(converted, ["a.jpg"])
+            fs.invalidate_cache()
+            self.assertTrue(fs.isfile("photos/out/a.jpg"))
+
+
+class TestVerify(unittest.TestCase):
+    """Tests for checking converted files without decoding them"""
+
+    def test_check_files(self):
+        """Complete files pass, truncated and damaged ones are reported"""
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 48), (200, 80, 40)).save(buffer, "JPEG", exif=piexif.dump({"0th": {}}))
+        jpeg = buffer.getvalue()
+        heic = make_heic_bytes()
+
+        self.assertIsNone(check_jpeg(io.BytesIO(jpeg), len(jpeg)))
+        self.assertIsNone(check_jpeg(io.BytesIO(jpeg + b"\0" * 16), len(jpeg) + 16))
+        self.assertIn("truncated", check_jpeg(io.BytesIO(jpeg[:-100]), len(jpeg) - 100))
+        self.assertIn("too small", check_jpeg(io.BytesIO(jpeg[:100]), 100))
+        # The frame header is overwritten with a comment segment of the same length
+        damaged = jpeg.replace(b"\xff\xc0", b"\xff\xfe", 1)
+        self.assertIn("frame header", check_jpeg(io.BytesIO(damaged), len(damaged)))
+        self.assertIsNone(check_heif(io.BytesIO(heic), len(heic)))
+        self.assertIn("truncated", check_heif(io.BytesIO(heic[:-10]), len(heic) - 10))
+
+    def test_verify_tree(self):
+        """Only sources with a missing or broken target are converted again"""
+        source_dir = tempfile.mkdtemp()
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir)
+        self.addCleanup(shutil.rmtree, target_dir)
+        heic = make_heic_bytes()
+        for i in range(4):
+            os.makedirs(os.path.join(source_dir, f"day_{i}"))
+            with open(os.path.join(source_dir, f"day_{i}", f"IMG_{i}.heic"), "wb") as f:
+                f.write(heic)
+        with Converter(target_dir) as converter:
+            self.assertEqual(len(converter.convert_tree(source_dir)), 4)
+
+        os.remove(os.path.join(target_dir, "day_0", "IMG_0.jpg"))
+        truncated = os.path.join(target_dir, "day_1", "IMG_1.jpg")
+        os.truncate(truncated, os.path.getsize(truncated) // 2)
+        untouched = os.path.getmtime(os.path.join(target_dir, "day_2", "IMG_2.jpg"))
+
+        with Converter(target_dir) as converter:
+            converted = converter.verify_tree(source_dir)
+
+        self.assertEqual(sorted(os.path.basename(target) for target in converted), ["IMG_0.jpg", "IMG_1.jpg"])
+        self.assertEqual(converter.verify_stats, {"verified": 4, "missing": 1, "broken": 1})
+        self.assertIsNone(check_target(truncated))
+        self.assertEqual(os.path.getmtime(os.path.join(target_dir, "day_2", "IMG_2.jpg")), untouched)
+
+
+class TestColor(unittest.TestCase):
+    """Tests for the colour management of sources with an ICC profile"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.profile = make_display_p3_profile()
+        self.sources = []
+        heic = make_heic_bytes(icc_profile=self.profile)
+        for i in range(3):
+            source = os.path.join(self.test_dir, f"IMG_{i}.heic")
+            with open(source, "wb") as f:
+                f.write(heic)
+            self.sources.append(source)
+
+    def test_transform_cache(self):
+        """Transforms are built once per profile and mode and applied in place; sRGB sources are left alone"""
+        from PIL import ImageCms
+
+        cache = TransformCache()
+        image = Image.new("RGB", (8, 8), (255, 0, 0))
+        self.assertTrue(to_srgb(image, self.profile, cache))
+        red = image.getpixel((0, 0))
+        # Display P3 red lies outside sRGB: it stays the most saturated red, green and blue cannot go lower
+        self.assertEqual(red[0], 255)
+        self.assertTrue(to_srgb(Image.new("RGB", (8, 8)), self.profile, cache))
+        self.assertTrue(to_srgb(Image.new("RGBX", (8, 8)), self.profile, cache))
+        self.assertEqual((cache.built, cache.hits), (2, 1))
+
+        srgb = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+        untouched = Image.new("RGB", (8, 8), (255, 0, 0))
+        self.assertFalse(to_srgb(untouched, srgb, cache))
+        self.assertFalse(to_srgb(untouched, b"not a profile", cache))
+        self.assertFalse(to_srgb(Image.new("L", (8, 8)), self.profile, cache))
+        self.assertEqual(untouched.getpixel((0, 0)), (255, 0, 0))
+        self.assertEqual((cache.built, cache.errors), (2, 1))
+
+    def test_convert_color_modes(self):
+        """srgb converts the colours with one transform for the batch, embed keeps the profile"""
+        targets = {}
+        for mode in ('none', 'srgb', 'embed'):
+            target_dir = os.path.join(self.test_dir, mode)
+            with Converter(target_dir, color=mode, jobs=2) as converter:
+                targets[mode] = converter.convert_files(self.sources)
+            self.assertEqual(len(targets[mode]), 3)
+            if mode == 'srgb':
+                self.assertEqual(converter.color_transforms.built, 1)
+
+        with Image.open(targets['none'][0]) as none, Image.open(targets['srgb'][0]) as srgb, \
+                Image.open(targets['embed'][0]) as embed:
+            self.assertNotIn("icc_profile", none.info)
+            self.assertNotIn("icc_profile", srgb.info)
+            self.assertEqual(embed.info.get("icc_profile"), self.profile)
+            self.assertNotEqual(none.getpixel((32, 24)), srgb.getpixel((32, 24)))
+
+        with self.assertRaises(ValueError):
+            Converter(self.test_dir, color='p3')
+
+
+class TestAudit(unittest.TestCase):
+    """Tests for the sampled quality audit"""
+
+    def test_metrics(self):
+        """PSNR and SSIM of known differences, independent of the bands they are computed in"""
+        rng = np.random.default_rng(7)
+        reference = rng.integers(0, 256, (40, 60, 3), dtype=np.uint8)
+        noisy = np.clip(reference.astype(np.int16) + rng.integers(-20, 21, reference.shape), 0, 255).astype(np.uint8)
+
+        self.assertEqual((psnr(reference, reference), ssim(reference, reference)), (100.0, 1.0))
+        off_by_one = np.where(reference < 255, reference + 1, reference - 1).astype(np.uint8)
+        self.assertAlmostEqual(psnr(reference, off_by_one), 10 * np.log10(255 ** 2), places=6)
+        similarity = ssim(reference, noisy)
+        self.assertLess(similarity, 1.0)
+        with patch.object(audit, "BAND_ROWS", 8):
+            self.assertAlmostEqual(ssim(reference, noisy), similarity, places=9)
+        with self.assertRaises(ValueError):
+            psnr(reference, noisy[:20])
+
+    def test_sampler(self):
+        """The sample holds the latest conversion audited for each slot, uniformly over all conversions"""
+        sampler = AuditSampler(3, random.Random(1))
+        picks = [sampler.pick() for _ in range(1000)]
+        self.assertEqual([picked[1] for picked in picks[:3]], [0, 1, 2])
+        for picked in picks:
+            if picked:
+                sampler.record(picked, picked[0], 1.0)
+        # The sample ends up with the latest conversion audited for each slot
+        latest = {}
+        for picked in filter(None, picks):
+            latest[picked[1]] = picked[0]
+        summary = sampler.summary()
+        self.assertEqual((summary["audited"], summary["psnr_min"]), (3, min(latest.values())))
+        self.assertGreater(summary["audits"], 3)
+        self.assertGreater(min(latest.values()), 3)
+
+    def test_audit_sample(self):
+        """Audited conversions carry PSNR and SSIM in their report records, and the summary aggregates them"""
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        heic = make_heic_bytes()
+        sources = []
+        for i in range(4):
+            sources.append(os.path.join(test_dir, f"IMG_{i}.heic"))
+            with open(sources[-1], "wb") as f:
+                f.write(heic)
+        report_path = os.path.join(test_dir, "report.jsonl")
+
+        with ReportWriter(report_path) as report:
+            with Converter(os.path.join(test_dir, "jpeg"), report=report, audit_sample=2, jobs=2) as converter:
+                self.assertEqual(len(converter.convert_files(sources)), 4)
+
+        records = read_report(report_path)
+        audited = [record for record in records if "psnr" in record]
+        self.assertEqual(len(audited), records[-1]["audits"])
+        self.assertTrue(all(record["psnr"] > 30 and record["ssim"] > 0.9 for record in audited))
+        self.assertEqual(records[-1]["audited"], 2)
+        self.assertIn(records[-1]["psnr_min"], [record["psnr"] for record in audited])
+        self.assertEqual(converter.audit_stats, {key: records[-1][key] for key in converter.audit_stats})
+
+        # Streamed directories keep a sample of the same size
+        with ReportWriter(report_path) as report:
+            with Converter(os.path.join(test_dir, "stream"), report=report, audit_sample=2) as converter:
+                self.assertEqual(sum(1 for _ in converter.iter_tree(test_dir, recursive=False)), 4)
+        self.assertEqual(read_report(report_path)[-1]["audited"], 2)
+
+    def test_audit_sample_skipped(self):
+        """Files that are skipped or fail do not take places of the sample"""
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        target_dir = os.path.join(test_dir, "jpeg")
+        os.makedirs(target_dir)
+        heic = make_heic_bytes()
+        sources = []
+        for i in range(6):
+            sources.append(os.path.join(test_dir, f"IMG_{i}.heic"))
+            with open(sources[-1], "wb") as f:
+                f.write(heic if i != 5 else b"broken")
+            if i < 3:
+                open(os.path.join(target_dir, f"IMG_{i}.jpg"), "wb").close()
+        report_path = os.path.join(test_dir, "report.jsonl")
+
+        with ReportWriter(report_path) as report:
+            with Converter(target_dir, report=report, audit_sample=2, jobs=2) as converter:
+                converter.convert_files(sources)
+
+        records = read_report(report_path)
+        audited = [record["source"] for record in records if "psnr" in record]
+        self.assertEqual(len(audited), 2)
+        self.assertTrue(set(audited) <= set(sources[3:5]))
+        self.assertEqual((records[-1]["audited"], records[-1]["audits"]), (2, 2))
+
+
+class TestJobQueue(unittest.TestCase):
+    """Tests for the job queue of the GUI"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        heic = make_heic_bytes()
+        self.folders = []
+        for i in range(3):
+            folder = os.path.join(self.test_dir, f"album_{i}")
+            os.makedirs(folder)
+            for name in ("a.heic", "b.heic"):
+                with open(os.path.join(folder, name), "wb") as f:
+                    f.write(heic)
+            self.folders.append(folder)
+
+    def test_jobs_run_with_own_options(self):
+        """Queued jobs run concurrently with their own options and report their progress"""
+        idle = threading.Event()
+
+        def on_update(job, event):
+            if all(queued.finished for queued in queue.jobs):
+                idle.set()
+
+        queue = JobQueue(max_concurrent=2, on_update=on_update)
+        jobs = [queue.add(Job([folder], os.path.join(folder, "out"), quality=50 + i * 10))
+                for i, folder in enumerate(self.folders[:2])]
+        file_job = queue.add(Job([os.path.join(self.folders[2], "a.heic")], self.folders[2]))
+        queue.start()
+        self.assertTrue(idle.wait(30))
+        queue.shutdown()
+
+        self.assertEqual([job.status for job in jobs + [file_job]], [JOB_DONE] * 3)
+        self.assertEqual([(job.converted, job.files_done, job.files_total) for job in jobs], [(2, 2, 2)] * 2)
+        self.assertEqual(file_job.converted, 1)
+        self.assertTrue(os.path.isfile(os.path.join(self.folders[0], "out", "b.jpg")))
+
+    def test_reorder_cancel_and_settings(self):
+        """Queued jobs can be moved and cancelled; unfinished ones are saved with the settings"""
+        queue = JobQueue()
+        first, second, third = (queue.add(Job([folder], folder)) for folder in self.folders)
+        queue.move(third.id, -5)
+        queue.cancel(second.id)
+
+        self.assertEqual([job.id for job in queue.jobs], [third.id, first.id, second.id])
+        self.assertEqual(second.status, JOB_CANCELLED)
+        self.assertEqual([settings["sources"] for settings in queue.pending_settings()],
+                         [[self.folders[2]], [self.folders[0]]])
+        restored = Job.from_settings(queue.pending_settings()[0])
+        self.assertEqual((restored.sources, restored.status), ([self.folders[2]], JOB_QUEUED))
+
+        queue.clear_finished()
+        self.assertEqual(len(queue.jobs), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,310 @@
+import os
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+# Size of the pieces that pass a token bucket, small enough to keep the rate smooth
+CHUNK_SIZE = 256 * 1024
+
+# Autotuning of the parallel jobs: the shortest measurement per setting, the gain that counts as
+# better, the number of settings tried at most, and the system state that makes it back off
+TUNE_INTERVAL = 2.0
+TUNE_TOLERANCE = 0.05
+TUNE_MAX_STEPS = 12
+MIN_MEMORY_AVAILABLE = 0.1
+MAX_IOWAIT = 0.3
+
+
+class TokenBucket:
+    """
+    Limits a byte rate shared by all threads that consume from the bucket
+
+    The bucket holds up to one second worth of tokens. A consumer may overdraw it, and then
+    sleeps until the debt is paid back, so large reads never stall forever and the
+    long-term rate stays exact.
+    """
+
+    def __init__(self, rate: float):
+        """
+        :param rate: the allowed rate in bytes per second
+        """
+        if rate <= 0:
+            raise ValueError("The rate of a token bucket must be positive")
+        self.rate = rate
+        self.capacity = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        """
+        Take tokens for amount bytes, sleeping if the rate is exceeded
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def read_throttled(f, bucket: TokenBucket) -> bytes:
+    """
+    Read a file object to the end at the rate of the bucket
+    """
+    chunks = []
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        bucket.consume(len(chunk))
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def write_throttled(f, data, bucket: TokenBucket) -> None:
+    """
+    Write a bytes-like object to a file object at the rate of the bucket
+    """
+    view = memoryview(data)
+    for offset in range(0, len(view), CHUNK_SIZE):
+        chunk = view[offset:offset + CHUNK_SIZE]
+        bucket.consume(len(chunk))
+        f.write(chunk)
+
+
+class LoadGovernor:
+    """
+    Holds back dispatching new conversions while the system load average is too high
+    """
+
+    def __init__(self, max_load: float, poll_interval: float = 5.0, verbose: bool = False):
+        """
+        :param max_load: the 1-minute load average above which dispatching pauses
+        :param poll_interval: seconds between load checks while paused
+        :param verbose: print when dispatching pauses
+        """
+        self.max_load = max_load
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        self.supported = hasattr(os, "getloadavg")
+        if not self.supported:
+            print("Load average is not available on this platform, --max-load is ignored")
+
+    def wait(self) -> None:
+        """
+        Return once the load average is at or below the threshold
+        """
+        if not self.supported:
+            return
+        announced = False
+        while os.getloadavg()[0] > self.max_load:
+            if self.verbose and not announced:
+                print(f"Load average above {self.max_load}, pausing")
+                announced = True
+            time.sleep(self.poll_interval)
+
+
+def memory_available() -> Optional[float]:
+    """
+    Get the share of the memory that is available without swapping, None where it is not known
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            info = dict(line.split(":", 1) for line in f)
+        return int(info["MemAvailable"].split()[0]) / int(info["MemTotal"].split()[0])
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+def cpu_times() -> Optional[Tuple[int, int]]:
+    """
+    Get the CPU time spent waiting for I/O and the total CPU time since boot, in ticks
+    """
+    try:
+        with open("/proc/stat") as f:
+            ticks = [int(value) for value in f.readline().split()[1:]]
+        return ticks[4], sum(ticks)
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class ConcurrencyTuner:
+    """
+    Finds the number of parallel conversions with the highest throughput by hill-climbing
+
+    Starting from two, the number of jobs is doubled as long as the throughput of a
+    measurement window (MB/s, or files/s if no sizes are known) grows by more than
+    TUNE_TOLERANCE. Then the neighbours of the best setting are tried with half its value
+    as step, halving the step whenever both were tried, until the step reaches zero or
+    TUNE_MAX_STEPS settings were measured; the tuner settles on the best one. Whenever the
+    available memory falls below MIN_MEMORY_AVAILABLE or the CPUs spend more than MAX_IOWAIT
+    waiting for I/O, the limit is lowered by a quarter and not raised again. The system
+    state is read from /proc; where it is not available only the throughput counts.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, interval: float = TUNE_INTERVAL, verbose: bool = False):
+        """
+        :param maximum: the largest number of jobs tried
+        :param minimum: the smallest number of jobs tried
+        :param interval: the shortest measurement per setting in seconds
+        :param verbose: print every setting that is tried
+        """
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.interval = interval
+        self.verbose = verbose
+        self.limit = max(self.minimum, min(2, self.maximum))
+        self.best_limit = self.limit
+        self.settled = False
+        self._best_score = None
+        self._best_rates = (0.0, 0.0)
+        self._ramping = True
+        self._step = 0
+        self._measured = set()
+        self._lock = threading.Lock()
+        self._start_window()
+
+    def record(self, size: int) -> None:
+        """
+        Count a file that finished, failed or was skipped, and adjust the limit at the end of a window
+
+        :param size: the size of the source file in bytes
+        """
+        with self._lock:
+            self._files += 1
+            self._bytes += size
+            elapsed = time.monotonic() - self._window_start
+            if elapsed < self.interval or self._files < 2 * self.limit:
+                return
+            files_per_second = self._files / elapsed
+            megabytes_per_second = self._bytes / elapsed / 1e6
+            if self._under_pressure():
+                self._back_off()
+            elif not self.settled:
+                self._climb(megabytes_per_second or files_per_second, (files_per_second, megabytes_per_second))
+            self._start_window()
+
+    def finish(self) -> None:
+        """
+        Report the best setting at the end of a batch that was too short to settle
+        """
+        with self._lock:
+            if not self.settled and self._measured:
+                print(f'Tuning did not finish, {self.best_limit} images in parallel were fastest so far')
+
+    def _start_window(self) -> None:
+        self._window_start = time.monotonic()
+        self._files = 0
+        self._bytes = 0
+        self._cpu_times = cpu_times()
+
+    def _under_pressure(self) -> bool:
+        available = memory_available()
+        if available is not None and available < MIN_MEMORY_AVAILABLE:
+            return True
+        now = cpu_times()
+        if now is None or self._cpu_times is None or now[1] <= self._cpu_times[1]:
+            return False
+        return (now[0] - self._cpu_times[0]) / (now[1] - self._cpu_times[1]) > MAX_IOWAIT
+
+    def _back_off(self) -> None:
+        limit = max(self.minimum, self.limit - max(1, self.limit // 4))
+        if self.verbose or self.settled:
+            print(f'Memory or I/O under pressure, converting {limit} images in parallel instead of {self.limit}')
+        # The measurements so far were taken under other conditions
+        self.maximum = self.limit = self.best_limit = limit
+        self._best_score = None
+        self._ramping = False
+        self._step = max(1, limit // 2)
+        self._measured.clear()
+
+    def _climb(self, score: float, rates: Tuple[float, float]) -> None:
+        self._measured.add(self.limit)
+        if self._best_score is None or score > self._best_score * (1 + TUNE_TOLERANCE):
+            self._best_score = score
+            self._best_rates = rates
+            self.best_limit = self.limit
+        elif self._ramping:
+            self._ramping = False
+
+        if self._ramping and self.limit < self.maximum:
+            candidate = min(2 * self.limit, self.maximum)
+        else:
+            self._ramping = False
+            if not self._step:
+                self._step = max(1, self.best_limit // 2)
+            candidate = self._next_neighbour()
+        if candidate is None or len(self._measured) >= TUNE_MAX_STEPS:
+            self._settle()
+            return
+        self.limit = candidate
+        if self.verbose:
+            print(f'Trying {self.limit} images in parallel, best so far {self.best_limit} at '
+                  f'{self._best_rates[0]:.1f} files/s and {self._best_rates[1]:.1f} MB/s')
+
+    def _next_neighbour(self) -> Optional[int]:
+        while self._step:
+            for candidate in (self.best_limit + self._step, self.best_limit - self._step):
+                if self.minimum <= candidate <= self.maximum and candidate not in self._measured:
+                    return candidate
+            self._step //= 2
+        return None
+
+    def _settle(self) -> None:
+        self.settled = True
+        self.limit = self.best_limit
+        files_per_second, megabytes_per_second = self._best_rates
+        print(f'Settled on {self.limit} images in parallel ({files_per_second:.1f} files/s, '
+              f'{megabytes_per_second:.1f} MB/s), pin it with --jobs {self.limit}')
+
+
+def parse_cpu_list(value: str) -> List[int]:
+    """
+    Parse a CPU affinity given as list (0-3,6) or as hexadecimal mask (0xf)
+
+    :return: the sorted CPU numbers
+    """
+    value = value.strip()
+    if value.lower().startswith("0x"):
+        mask = int(value, 16)
+        cpus = [cpu for cpu in range(mask.bit_length()) if mask >> cpu & 1]
+    else:
+        cpus = set()
+        for part in value.split(","):
+            first, _, last = part.partition("-")
+            cpus.update(range(int(first), int(last or first) + 1))
+        cpus = sorted(cpus)
+    if not cpus:
+        raise ValueError(f"No CPU selected by '{value}'")
+    return cpus
+
+
+def available_cpus() -> int:
+    """
+    Get the number of CPUs this process may run on, respecting its affinity
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def apply_cpu_limits(nice: Optional[int] = None, cpus: Optional[Iterable[int]] = None) -> None:
+    """
+    Lower the priority and restrict the CPUs of the current process and its threads
+
+    :param nice: increment of the niceness, e.g. 10
+    :param cpus: the CPUs the process may run on
+    """
+    if nice:
+        if hasattr(os, "nice"):
+            os.nice(nice)
+        else:
+            print("Changing the niceness is not supported on this platform, --nice is ignored")
+    if cpus is not None:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, set(cpus))
+        else:
+            print("CPU affinity is not supported on this platform, --cpus is ignored")
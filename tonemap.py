@@ -0,0 +1,228 @@
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+
+from converter import DITHER_MODES, TONE_MAP_CURVES
+
+# nclx transfer characteristics and colour primaries, see pillow_heif.HeifTransferCharacteristics
+TRANSFER_LINEAR = 8
+TRANSFER_PQ = 16
+TRANSFER_HLG = 18
+PRIMARIES_BT2020 = 9
+PRIMARIES_DISPLAY_P3 = 12
+
+# SDR reference white in nits (ITU-R BT.2408), PQ code values are absolute up to 10000 nits
+PQ_REFERENCE_WHITE = 203.0
+# Scene light of the HLG reference white (75% signal)
+HLG_REFERENCE_WHITE = 0.2647
+
+# Linear-light conversions into the BT.709/sRGB primaries
+TO_BT709 = {
+    PRIMARIES_BT2020: np.array([
+        [1.6605, -0.5876, -0.0728],
+        [-0.1246, 1.1329, -0.0083],
+        [-0.0182, -0.1006, 1.1187],
+    ], dtype=np.float32),
+    PRIMARIES_DISPLAY_P3: np.array([
+        [1.2249, -0.2247, 0.0],
+        [-0.0420, 1.0419, 0.0],
+        [-0.0197, -0.0786, 1.0979],
+    ], dtype=np.float32),
+}
+
+BT709_LUMINANCE = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+# Rows converted at once; a multiple of the dither mask sizes so the pattern continues across bands
+BAND_ROWS = 64
+
+
+def _srgb_to_linear(v: np.ndarray) -> np.ndarray:
+    return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+
+def _linear_to_srgb(v: np.ndarray) -> np.ndarray:
+    return np.where(v <= 0.0031308, v * 12.92, 1.055 * np.power(v, 1 / 2.4) - 0.055)
+
+
+def _pq_to_linear(v: np.ndarray) -> np.ndarray:
+    m1, m2 = 0.1593017578125, 78.84375
+    c1, c2, c3 = 0.8359375, 18.8515625, 18.6875
+    p = np.power(v, 1 / m2)
+    nits = 10000.0 * np.power(np.maximum(p - c1, 0) / (c2 - c3 * p), 1 / m1)
+    return nits / PQ_REFERENCE_WHITE
+
+
+def _hlg_to_linear(v: np.ndarray) -> np.ndarray:
+    a, b, c = 0.17883277, 0.28466892, 0.55991073
+    scene = np.where(v <= 0.5, v * v / 3, (np.exp((v - c) / a) + b) / 12)
+    return scene / HLG_REFERENCE_WHITE
+
+
+@lru_cache(maxsize=None)
+def _decode_lut(transfer: int) -> np.ndarray:
+    """
+    Lookup table from 16-bit code values to linear light, 1.0 being SDR white
+    """
+    codes = np.arange(65536, dtype=np.float64) / 65535
+    if transfer == TRANSFER_PQ:
+        linear = _pq_to_linear(codes)
+    elif transfer == TRANSFER_HLG:
+        linear = _hlg_to_linear(codes)
+    elif transfer == TRANSFER_LINEAR:
+        linear = codes
+    else:
+        linear = _srgb_to_linear(codes)
+    return linear.astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def _encode_lut() -> np.ndarray:
+    """
+    Lookup table from 16-bit linear light to sRGB, scaled to 8-bit code values
+    """
+    linear = np.arange(65536, dtype=np.float64) / 65535
+    return (_linear_to_srgb(linear) * 255).astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def _clip_lut(transfer: int) -> np.ndarray:
+    """
+    Lookup table from 16-bit code values straight to clipped sRGB, for channel-independent mappings
+    """
+    linear = np.clip(_decode_lut(transfer), 0, 1)
+    return _encode_lut()[(linear * 65535 + 0.5).astype(np.uint16)]
+
+
+def _hable(x):
+    a, b, c, d, e, f = 0.15, 0.50, 0.10, 0.20, 0.02, 0.30
+    return (x * (a * x + c * b) + d * e) / (x * (a * x + b) + d * f) - e / f
+
+
+def _tone_map_luminance(luminance: np.ndarray, curve: str, white: float) -> np.ndarray:
+    """
+    Map linear luminance into [0, 1], with white being the brightest value of the image
+    """
+    if curve == 'reinhard':
+        # Extended Reinhard: identity for SDR content, white maps exactly to 1
+        return luminance * (1 + luminance / (white * white)) / (1 + luminance)
+    if curve == 'hable':
+        return _hable(luminance) / _hable(white)
+    return np.minimum(luminance, 1)
+
+
+@lru_cache(maxsize=None)
+def bayer_matrix(size: int = 8) -> np.ndarray:
+    """
+    Ordered dithering thresholds in (0, 1) for a power-of-two matrix size
+    """
+    matrix = np.zeros((1, 1), dtype=np.int64)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return ((matrix + 0.5) / matrix.size).astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def blue_noise_mask(size: int = 64, seed: int = 7) -> np.ndarray:
+    """
+    Dithering thresholds in (0, 1) with a blue-noise spectrum
+
+    White noise is high-pass filtered in the frequency domain and rank-ordered, which gives
+    uniformly distributed thresholds without the low-frequency clumps of plain noise.
+    """
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((size, size))
+    fy = np.fft.fftfreq(size)[:, None]
+    fx = np.fft.fftfreq(size)[None, :]
+    high_pass = np.sqrt(fx * fx + fy * fy)
+    shaped = np.real(np.fft.ifft2(np.fft.fft2(noise) * high_pass))
+    ranks = np.empty(size * size)
+    ranks[np.argsort(shaped, axis=None)] = np.arange(size * size)
+    return ((ranks + 0.5) / (size * size)).reshape(size, size).astype(np.float32)
+
+
+@lru_cache(maxsize=8)
+def _dither_thresholds(dither: str, rows: int, width: int) -> np.ndarray:
+    if dither == 'ordered':
+        mask = bayer_matrix()
+    elif dither == 'blue-noise':
+        mask = blue_noise_mask()
+    else:
+        return np.full((1, 1), 0.5, dtype=np.float32)
+    reps = (-(-rows // mask.shape[0]), -(-width // mask.shape[1]))
+    return np.tile(mask, reps)[:rows, :width]
+
+
+def to_8bit(
+        data: np.ndarray,
+        nclx: Optional[dict] = None,
+        tone_map: str = 'reinhard',
+        dither: str = 'ordered',
+        out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Convert a high bit-depth image to 8-bit sRGB with tone mapping and dithering
+
+    The image is processed in bands of rows with whole-array NumPy operations, so the float
+    intermediates stay small even for 48 MP images.
+
+    :param data: uint16 array of shape (height, width, 3 or 4), scaled to the full 16-bit range
+    :param nclx: the nclx colour profile of the image, selects transfer function and primaries
+    :param tone_map: one of TONE_MAP_CURVES
+    :param dither: one of DITHER_MODES
+    :param out: uint8 array of the same shape to write the result to, e.g. a reused buffer; for
+                RGB data it may also have a fourth channel, which is set to 255 (RGBX)
+    :return: uint8 array of the same shape, or the shape of out
+    """
+    if tone_map not in TONE_MAP_CURVES:
+        raise ValueError(f"Unknown tone map curve {tone_map}, expected one of {', '.join(TONE_MAP_CURVES)}")
+    if dither not in DITHER_MODES:
+        raise ValueError(f"Unknown dither mode {dither}, expected one of {', '.join(DITHER_MODES)}")
+
+    nclx = nclx or {}
+    transfer = nclx.get('transfer_characteristics', 0)
+    decode = _decode_lut(transfer)
+    encode = _encode_lut()
+    matrix = TO_BT709.get(nclx.get('color_primaries'))
+    height, width, channels = data.shape
+
+    # The brightest code value bounds the luminance, it becomes the white point of the curve
+    white = max(float(decode[data[..., :3].max()]), 1.0)
+
+    # Clipping, and Reinhard without highlights, leave the channels independent: one lookup does it all
+    direct = None
+    if matrix is None and (tone_map == 'clip' or (tone_map == 'reinhard' and white == 1.0)):
+        direct = _clip_lut(transfer)
+
+    if out is None:
+        out = np.empty((height, width, channels), dtype=np.uint8)
+    elif out.dtype != np.uint8 or out.shape[:2] != (height, width) or out.shape[2] not in (channels, 4):
+        raise ValueError(f"The output array must be uint8 of shape {data.shape}")
+    elif out.shape[2] > channels:
+        out[..., 3] = 255
+    for top in range(0, height, BAND_ROWS):
+        band = data[top:top + BAND_ROWS]
+        rows = band.shape[0]
+
+        if direct is not None:
+            srgb = direct[band[..., :3]]
+        else:
+            linear = decode[band[..., :3]]
+            if matrix is not None:
+                linear = np.maximum(linear @ matrix.T, 0)
+
+            luminance = linear @ BT709_LUMINANCE
+            mapped = _tone_map_luminance(luminance, tone_map, white)
+            linear *= (mapped / np.maximum(luminance, 1e-6))[..., None]
+            np.clip(linear, 0, 1, out=linear)
+
+            srgb = encode[(linear * 65535 + 0.5).astype(np.uint16)]
+        srgb += _dither_thresholds(dither, rows, width)[..., None]
+        np.clip(srgb, 0, 255, out=srgb)
+        out[top:top + rows, :, :3] = srgb
+
+        if channels == 4:
+            alpha = band[..., 3] * np.float32(255 / 65535) + _dither_thresholds(dither, rows, width)
+            out[top:top + rows, :, 3] = np.clip(alpha, 0, 255)
+
+    return out
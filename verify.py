@@ -0,0 +1,125 @@
+import struct
+from typing import Optional
+
+from storage import get_storage
+
+# The smallest baseline JPEG files written by common encoders are a little larger than this
+MIN_JPEG_BYTES = 128
+# Encoders may pad a file after its end marker; this much of the end is searched for it
+JPEG_TAIL_BYTES = 64
+
+# Start of frame markers, except the DHT, JPG and DAC ones in the same range
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field: TEM and the restart markers
+STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+
+
+def check_jpeg(f, size: int) -> Optional[str]:
+    """
+    Check a JPEG file for truncation and damage without decoding it
+
+    The start and end markers are looked at, and the header segments are walked up to the
+    start of the image data, which must come after a frame header with a valid image size.
+    Only a few hundred bytes are read, seeking over the Exif and other large segments.
+
+    :param f: the file opened for binary reading
+    :param size: the size of the file
+    :return: what is wrong with the file, None if it looks complete
+    """
+    if size < MIN_JPEG_BYTES:
+        return f"too small ({size} bytes)"
+    if f.read(2) != b"\xff\xd8":
+        return "no JPEG start marker"
+    f.seek(max(size - JPEG_TAIL_BYTES, 0))
+    if not f.read(JPEG_TAIL_BYTES).rstrip(b"\x00").endswith(b"\xff\xd9"):
+        return "no JPEG end marker, the file is truncated"
+
+    position = 2
+    frame = False
+    while position + 4 <= size:
+        f.seek(position)
+        marker = f.read(4)
+        if marker[0] != 0xFF:
+            return f"broken JPEG header at byte {position}"
+        code = marker[1]
+        if code == 0xFF:
+            # Fill byte before a marker
+            position += 1
+            continue
+        if code in STANDALONE_MARKERS:
+            position += 2
+            continue
+        if code == 0xDA:
+            return None if frame else "no JPEG frame header before the image data"
+        if code == 0xD9:
+            return "no image data in the JPEG file"
+        length = struct.unpack(">H", marker[2:4])[0]
+        if length < 2 or position + 2 + length > size:
+            return f"broken JPEG segment at byte {position}"
+        if code in SOF_MARKERS:
+            header = f.read(5)
+            if len(header) < 5:
+                return "broken JPEG frame header"
+            width = struct.unpack(">H", header[3:5])[0]
+            if width == 0:
+                return "no image size in the JPEG frame header"
+            frame = True
+        position += 2 + length
+    return "no image data in the JPEG file"
+
+
+def check_heif(f, size: int) -> Optional[str]:
+    """
+    Check a HEIF file for truncation without decoding it
+
+    The top-level boxes are walked by their headers; the file must start with an ftyp box,
+    contain meta and mdat boxes and end exactly where its last box ends.
+
+    :param f: the file opened for binary reading
+    :param size: the size of the file
+    :return: what is wrong with the file, None if it looks complete
+    """
+    position = 0
+    found = set()
+    while position < size:
+        f.seek(position)
+        header = f.read(16)
+        if len(header) < 8:
+            return f"broken HEIF box at byte {position}"
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        if box_size == 1:
+            if len(header) < 16:
+                return f"broken HEIF box at byte {position}"
+            box_size = struct.unpack(">Q", header[8:16])[0]
+        elif box_size == 0:
+            box_size = size - position
+        if box_size < 8 or position + box_size > size:
+            return f"HEIF box {box_type.decode('latin-1')} runs past the end, the file is truncated"
+        if position == 0 and box_type != b"ftyp":
+            return "no HEIF file type box"
+        found.add(box_type)
+        position += box_size
+    missing = [box_type.decode() for box_type in (b"ftyp", b"meta", b"mdat") if box_type not in found]
+    if missing:
+        return f"no HEIF {', '.join(missing)} box"
+    return None
+
+
+def check_target(path: str) -> Optional[str]:
+    """
+    Check a converted file by its extension, JPEG or HEIF
+
+    :param path: the file or URL
+    :return: what is wrong with the file, 'missing' if it does not exist, None if it looks complete
+    """
+    storage = get_storage(path)
+    try:
+        size = storage.stat(path).st_size
+        with storage.open(path, "rb") as f:
+            if path.lower().endswith((".heic", ".heif")):
+                return check_heif(f, size)
+            return check_jpeg(f, size)
+    except FileNotFoundError:
+        return "missing"
+    except OSError as e:
+        return f"unreadable: {e}"